@@ -0,0 +1,97 @@
+import argparse
+import copy
+import json
+import time
+
+import numpy as np
+
+from benchmarks.corpus import load_corpus
+from recipe_estimator.compiled_recipe import get_compiled_recipe
+from recipe_estimator.estimation_methods import ESTIMATION_METHODS
+from recipe_estimator.fitness import get_penalties
+from recipe_estimator.log import configure_logging
+from recipe_estimator.nutrients import get_nutrient_table, prepare_product
+from recipe_estimator.recipe_estimator_auto import TIERS, estimate_recipe as estimate_recipe_auto, get_tiers
+from recipe_estimator import settings
+
+# Reports what the auto method saves over always running one of the other methods on the benchmark corpus: which tier
+# produced each estimate, the mean time of auto and of each of the other methods, and the objective function penalties
+# of their estimates, so the saving can be weighed against any loss of accuracy. Use it to choose the tiers and thresholds.
+# Run with: python -m benchmarks.auto_tiers [--compare cvxpy,scipy] [--nutrient-threshold 1e6] [--order-threshold 1e6] [--output auto.json]
+# Comparing with scipy takes a few minutes as differential evolution is run on every product.
+# cvxpy is run once on each product first so the time to compile its problems isn't counted against whichever method uses them first
+
+
+def estimate(product, method, **kwargs):
+    product = copy.deepcopy(product)
+    start = time.perf_counter()
+    prepare_product(product)
+    compiled = get_compiled_recipe(product)
+    if method == "auto":
+        estimate_recipe_auto(product, compiled=compiled, **kwargs)
+    else:
+        ESTIMATION_METHODS[method](product, compiled=compiled)
+    elapsed = time.perf_counter() - start
+    penalties = get_penalties(product, compiled=compiled)
+    return {
+        "time_ms": elapsed * 1000,
+        "nutrient_penalty": float(penalties["nutrient_penalty"]),
+        "total_penalty": float(penalties["total"]),
+        "tier": product["recipe_estimator"].get("tier"),
+    }
+
+
+def run(compare, auto_options):
+    get_nutrient_table()
+    results = {}
+    for group, products in load_corpus().items():
+        results[group] = []
+        for product in products:
+            estimate(product, "cvxpy")
+            methods = {"auto": estimate(product, "auto", **auto_options)}
+            for method in compare:
+                methods[method] = estimate(product, method)
+            results[group].append({"code": product["code"], "methods": methods})
+    return results
+
+
+def summarise(results, compare, tiers):
+    all_products = [product for products in results.values() for product in products]
+    for group, products in list(results.items()) + [("all", all_products)]:
+        auto = [product["methods"]["auto"] for product in products]
+        counts = {tier: sum(result["tier"] == tier for result in auto) for tier in tiers}
+        auto_time = np.mean([result["time_ms"] for result in auto])
+        print(f"{group}: tiers {', '.join(f'{tier} {count}' for tier, count in counts.items())}")
+        print(f"  {'auto':10} mean {auto_time:10.1f} ms  median nutrient penalty {np.median([result['nutrient_penalty'] for result in auto]):12.0f}  median total penalty {np.median([result['total_penalty'] for result in auto]):14.0f}")
+        for method in compare:
+            solved = [product["methods"][method] for product in products]
+            method_time = np.mean([result["time_ms"] for result in solved])
+            print(
+                f"  {method:10} mean {method_time:10.1f} ms  median nutrient penalty {np.median([result['nutrient_penalty'] for result in solved]):12.0f}  median total penalty {np.median([result['total_penalty'] for result in solved]):14.0f}"
+                f"  auto saves {100 * (1 - auto_time / method_time):6.1f}% of the time"
+            )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.auto_tiers", description="Report the cost saving of the auto method on the product corpus")
+    parser.add_argument("--compare", default="cvxpy,scipy", help="comma separated methods to compare with")
+    parser.add_argument("--tiers", default=",".join(TIERS), help="comma separated tiers, cheapest first")
+    parser.add_argument("--nutrient-threshold", type=float, default=settings.AUTO_NUTRIENT_PENALTY)
+    parser.add_argument("--order-threshold", type=float, default=settings.AUTO_ORDER_PENALTY)
+    parser.add_argument("--output", help="write the results for each product to this JSON file")
+    args = parser.parse_args(argv)
+    compare = [method for method in args.compare.split(",") if method]
+    for method in compare:
+        if method not in ESTIMATION_METHODS or method == "auto":
+            parser.error(f"unknown method {method}")
+    tiers = get_tiers(args.tiers)
+    configure_logging("ERROR", "")
+    results = run(compare, {"tiers": tiers, "nutrient_threshold": args.nutrient_threshold, "order_threshold": args.order_threshold})
+    summarise(results, compare, tiers)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
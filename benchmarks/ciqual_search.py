@@ -0,0 +1,72 @@
+import random
+import sys
+import time
+
+import numpy as np
+
+from recipe_estimator.ciqual_search import CiqualSearchIndex
+from recipe_estimator.nutrients import get_ciqual_ingredients
+
+# Typeahead latency for /ciqual/{name}: the previous linear scan of every food vs the token index, with the CIQUAL table
+# as it is and copied to several times its size. The query log is what the frontend sends while a user types the first
+# words of a food name, one request per keystroke.
+# Run with: python -m benchmarks.ciqual_search [number of searches typed]
+
+num_searches = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+random.seed(0)
+
+
+def linear_search(ciqual_ingredients, name):
+    search_terms = name.casefold().split()
+    results = []
+    for i in ciqual_ingredients.values():
+        if all(search_term in (i['alim_nom_eng'] + i['ciqual_food_code']).casefold() for search_term in search_terms):
+            results.append(i)
+            if len(results) == 20:
+                break
+    return results
+
+
+def make_query_log(ciqual_ingredients):
+    names = [food["alim_nom_eng"] for food in ciqual_ingredients.values()]
+    queries = []
+    for _ in range(num_searches):
+        words = random.choice(names).replace(",", "").split()[:random.randint(1, 2)]
+        typed = " ".join(words).lower()
+        queries.extend(typed[:length] for length in range(1, len(typed) + 1) if not typed[:length].endswith(" "))
+    return queries
+
+
+def scale_table(ciqual_ingredients, copies):
+    table = {}
+    for copy in range(copies):
+        for food_code, food in ciqual_ingredients.items():
+            scaled_code = f"{food_code}{copy:02}" if copy else food_code
+            table[scaled_code] = dict(food, ciqual_food_code=scaled_code)
+    return table
+
+
+def percentiles(function, queries):
+    timings = []
+    for query in queries:
+        start = time.perf_counter()
+        function(query)
+        timings.append(time.perf_counter() - start)
+    return np.percentile(timings, [50, 95, 99]) * 1e6
+
+
+ciqual_ingredients = get_ciqual_ingredients()
+queries = make_query_log(ciqual_ingredients)
+print(f"{len(queries)} queries")
+for copies in (1, 4, 16):
+    table = scale_table(ciqual_ingredients, copies)
+    start = time.perf_counter()
+    index = CiqualSearchIndex(((food_code, food["alim_nom_eng"]) for food_code, food in table.items()), table)
+    build_time = time.perf_counter() - start
+    linear = percentiles(lambda query: linear_search(table, query), queries)
+    # Measure the index without its result cache
+    indexed = percentiles(lambda query: index.search.__wrapped__(query), queries)
+    print(
+        f"{len(table):6} foods: linear p50/p95/p99 {linear[0]:7.0f} {linear[1]:7.0f} {linear[2]:7.0f} us,"
+        f" index {indexed[0]:4.0f} {indexed[1]:4.0f} {indexed[2]:4.0f} us (built in {build_time:.2f} s)"
+    )
@@ -0,0 +1,193 @@
+import argparse
+import gzip
+import json
+import random
+from pathlib import Path
+
+from recipe_estimator.nutrients import get_ciqual_code_index, get_ciqual_ingredients
+
+# The product corpus used by benchmarks.suite, one JSONL file per range of leaf ingredient counts in benchmarks/corpus.
+# Products are anonymised: only the ingredient ids, stated percentages, nutrition facts per 100g and countries are kept,
+# and the product code is replaced with a sequence number.
+#
+# Rebuild from real products (a test set directory of <code>.json files or a JSONL dump, optionally gzipped) with:
+#   python -m benchmarks.corpus <path> [--per-group 10]
+# or generate synthetic products from the CIQUAL table, with nutrition facts calculated from a random recipe, with:
+#   python -m benchmarks.corpus --synthetic [--per-group 10]
+
+CORPUS_DIR = Path(__file__).parent / "corpus"
+
+# (name, fewest leaf ingredients, most leaf ingredients)
+LEAF_GROUPS = (
+    ("leaves_01_04", 1, 4),
+    ("leaves_05_09", 5, 9),
+    ("leaves_10_19", 10, 19),
+    ("leaves_20_39", 20, 39),
+)
+
+NUTRIENT_KEYS = ("proteins", "carbohydrates", "fat", "saturated-fat", "sugars", "fiber", "salt")
+
+
+def count_leaf_ingredients(ingredients):
+    return sum(count_leaf_ingredients(ingredient["ingredients"]) if ingredient.get("ingredients") else 1 for ingredient in ingredients)
+
+
+def get_leaf_group(leaf_count):
+    for name, fewest, most in LEAF_GROUPS:
+        if fewest <= leaf_count <= most:
+            return name
+    return None
+
+
+def anonymise_ingredients(ingredients):
+    anonymised = []
+    for ingredient in ingredients:
+        entry = {"id": ingredient["id"]}
+        if ingredient.get("percent") is not None:
+            entry["percent"] = ingredient["percent"]
+        if ingredient.get("ingredients"):
+            entry["ingredients"] = anonymise_ingredients(ingredient["ingredients"])
+        anonymised.append(entry)
+    return anonymised
+
+
+def anonymise(product, number):
+    nutriments = product.get("nutriments", {})
+    anonymised = {
+        "code": str(number),
+        "ingredients": anonymise_ingredients(product["ingredients"]),
+        "nutriments": {
+            key: round(float(value), 3)
+            for key, value in nutriments.items()
+            if key.endswith("_100g") and isinstance(value, (int, float)) and not isinstance(value, bool)
+        },
+    }
+    if product.get("countries_tags"):
+        anonymised["countries_tags"] = product["countries_tags"]
+    return anonymised
+
+
+def read_products(path):
+    path = Path(path)
+    if path.is_dir():
+        for file in sorted(path.rglob("*.json")):
+            with open(file, encoding="utf-8") as f:
+                yield json.load(f)
+        return
+    with (gzip.open(path, "rt", encoding="utf-8") if path.suffix == ".gz" else open(path, encoding="utf-8")) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+# Ingredient percentages in order, largest first, adding up to total
+def random_percentages(rng, count, total):
+    weights = sorted((rng.expovariate(1) for _ in range(count)), reverse=True)
+    return [total * weight / sum(weights) for weight in weights]
+
+
+def synthetic_ingredients(rng, leaf_count, total, ingredient_ids, leaves):
+    # Split the leaves between the ingredients, some of which have sub-ingredients
+    sizes = []
+    remaining = leaf_count
+    while remaining:
+        size = min(remaining, rng.randint(2, 4)) if remaining > 2 and rng.random() < 0.25 else 1
+        sizes.append(size)
+        remaining -= size
+    ingredients = []
+    for size, percent in zip(sizes, random_percentages(rng, len(sizes), total)):
+        ingredient = {"id": rng.choice(ingredient_ids)}
+        if size > 1:
+            ingredient["ingredients"] = synthetic_ingredients(rng, size, percent, ingredient_ids, leaves)
+        else:
+            leaves.append((ingredient["id"], percent))
+        if rng.random() < 0.15:
+            ingredient["percent"] = round(percent, 1)
+        ingredients.append(ingredient)
+    return ingredients
+
+
+def synthetic_product(rng, leaf_count, number, ingredient_ids):
+    ciqual_index = get_ciqual_code_index()
+    ciqual_ingredients = get_ciqual_ingredients()
+    leaves = []
+    ingredients = synthetic_ingredients(rng, leaf_count, 100, ingredient_ids, leaves)
+    totals = dict.fromkeys(NUTRIENT_KEYS, 0.0)
+    for ingredient_id, percent in leaves:
+        nutrients = ciqual_ingredients[ciqual_index[ingredient_id][0]]["nutrients"]
+        for key in NUTRIENT_KEYS:
+            if key in nutrients:
+                totals[key] += nutrients[key]["percent_nom"] * percent / 100
+    # Nutrition facts are rounded and not exactly what the recipe gives
+    nutriments = {key + "_100g": round(total * rng.uniform(0.9, 1.1), 1) for key, total in totals.items()}
+    return {"code": str(number), "ingredients": ingredients, "nutriments": nutriments}
+
+
+def write_groups(groups):
+    CORPUS_DIR.mkdir(exist_ok=True)
+    for name, products in groups.items():
+        with open(CORPUS_DIR / (name + ".jsonl"), "w", encoding="utf-8") as f:
+            for product in products:
+                f.write(json.dumps(product, separators=(",", ":")) + "\n")
+        print(f"{name}: {len(products)} products")
+
+
+def build_from_products(path, per_group):
+    groups = {name: [] for name, _, _ in LEAF_GROUPS}
+    number = 0
+    for product in read_products(path):
+        if not product.get("ingredients"):
+            continue
+        name = get_leaf_group(count_leaf_ingredients(product["ingredients"]))
+        if name is not None and len(groups[name]) < per_group:
+            number += 1
+            groups[name].append(anonymise(product, number))
+        if all(len(products) >= per_group for products in groups.values()):
+            break
+    return groups
+
+
+def build_synthetic(per_group, seed=0):
+    rng = random.Random(seed)
+    ciqual_ingredients = get_ciqual_ingredients()
+    ingredient_ids = sorted(
+        ingredient_id for ingredient_id, codes in get_ciqual_code_index().items() if codes[0] in ciqual_ingredients
+    )
+    groups = {}
+    number = 0
+    for name, fewest, most in LEAF_GROUPS:
+        groups[name] = []
+        for _ in range(per_group):
+            number += 1
+            groups[name].append(synthetic_product(rng, rng.randint(fewest, most), number, ingredient_ids))
+    return groups
+
+
+def load_corpus(groups=None):
+    corpus = {}
+    for name, _, _ in LEAF_GROUPS:
+        if groups and name not in groups:
+            continue
+        with open(CORPUS_DIR / (name + ".jsonl"), encoding="utf-8") as f:
+            corpus[name] = [json.loads(line) for line in f if line.strip()]
+    return corpus
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.corpus", description="Build the benchmark product corpus")
+    parser.add_argument("path", nargs="?", help="test set directory or JSONL dump of products")
+    parser.add_argument("--synthetic", action="store_true", help="generate products from the CIQUAL table instead")
+    parser.add_argument("--per-group", type=int, default=10, help="products per leaf ingredient count group")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+    if args.synthetic:
+        groups = build_synthetic(args.per_group, args.seed)
+    elif args.path:
+        groups = build_from_products(args.path, args.per_group)
+    else:
+        parser.error("give a path to products or --synthetic")
+    write_groups(groups)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+import copy
+import json
+import os
+import random
+import sys
+import time
+from pathlib import Path
+
+from recipe_estimator.nutrients import get_ciqual_code_index, prepare_product
+from recipe_estimator.recipe_estimator_cvxpy import clear_problem_cache, estimate_recipe, get_problem_cache_info
+
+# Compares the cvxpy estimator with an empty problem cache for every product (i.e. compiling each problem from scratch)
+# with a warm cache where products with the same ingredient tree structure re-use the compiled problem.
+# Uses the products in the metrics test set if it is available, otherwise generates products from the taxonomy.
+# Run with: python -m benchmarks.cvxpy_cache [test set input directory] [number of products]
+
+corpus_dir = Path(sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(__file__), "../../recipe-estimator-metrics/test-sets/input"))
+num_products = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+
+
+def load_corpus():
+    products = []
+    for filename in sorted(corpus_dir.rglob("*.json"))[:num_products]:
+        with open(filename, "r", encoding="utf-8") as f:
+            products.append(json.load(f))
+    return products
+
+
+def make_products():
+    # Nested recipes with a handful of distinct shapes, as in real data where most products have a few top level ingredients
+    random.seed(0)
+    ingredient_ids = [ingredient_id for ingredient_id, codes in get_ciqual_code_index().items() if codes[0]]
+    products = []
+    for n in range(num_products):
+        num_ingredients = random.randint(2, 8)
+        ingredients = []
+        for i in range(num_ingredients):
+            ingredient = {"id": random.choice(ingredient_ids)}
+            if i == 1 and num_ingredients > 4:
+                ingredient["ingredients"] = [{"id": random.choice(ingredient_ids)} for _ in range(3)]
+            if i == 0:
+                ingredient["percent"] = random.randint(30, 60)
+            ingredients.append(ingredient)
+        products.append({
+            "code": str(n),
+            "ingredients": ingredients,
+            "nutriments": {"proteins_100g": random.uniform(0, 20), "carbohydrates_100g": random.uniform(0, 60), "fat_100g": random.uniform(0, 30)},
+        })
+    return products
+
+
+products = load_corpus() if corpus_dir.is_dir() else []
+if not products:
+    print(f"{corpus_dir} not found, using generated products")
+    products = make_products()
+
+for product in products:
+    prepare_product(product)
+
+
+def run(cached):
+    clear_problem_cache()
+    start = time.perf_counter()
+    for product in products:
+        if not cached:
+            clear_problem_cache()
+        estimate_recipe(copy.deepcopy(product))
+    return time.perf_counter() - start
+
+
+cold_time = run(False)
+warm_time = run(True)
+info = get_problem_cache_info()
+
+print(f"{len(products)} products, {info['size']} distinct structures ({info['hits']} cache hits, {info['misses']} misses)")
+print(f"Compile every product: {cold_time / len(products) * 1000:.1f} ms per product")
+print(f"Cached problems:       {warm_time / len(products) * 1000:.1f} ms per product")
@@ -0,0 +1,100 @@
+import argparse
+import copy
+import json
+
+import numpy as np
+
+from benchmarks.corpus import load_corpus
+from recipe_estimator.log import configure_logging
+from recipe_estimator.nutrients import get_nutrient_table, prepare_product
+from recipe_estimator.recipe_estimator_cvxpy import SOLVERS, estimate_recipe, problem_cache
+from recipe_estimator.spans import Spans
+
+# Calibrates the automatic choice of solver in recipe_estimator_cvxpy (get_solvers). Solves every product in the benchmark
+# corpus with each solver and records the solve time, the status and the objective value, by leaf ingredient count group
+# and by the size of the problem (leaf ingredients, water loss variables and constraints).
+# The objective value is compared with the lowest any solver found for the product, so a fast solver that stops
+# early shows up as a gap.
+# Run with: python -m benchmarks.cvxpy_solvers [--repeat 5] [--output solvers.json]
+
+
+def solve_product(product, solver, repeat):
+    times = []
+    for run in range(repeat + 1):
+        estimated = copy.deepcopy(product)
+        prepare_product(estimated)
+        with Spans() as spans:
+            estimate_recipe(estimated, solver=solver)
+        # The first run compiles the problem for the solver
+        if run:
+            times.append(spans.timings.get("solve", 0) * 1000)
+    # The template that was just used is the most recent in the cache
+    template = next(reversed(problem_cache.values()))
+    problem = next(problem for (name, problem_solver), problem in template.problems.items() if problem_solver == solver)
+    recipe_estimator = estimated["recipe_estimator"]
+    return {
+        "time_ms": float(np.median(times)),
+        "status": recipe_estimator["status_message"],
+        # The solver that found the solution, which is another one if the solver being measured failed
+        "solver_used": recipe_estimator["solver"],
+        "objective": problem.value if problem.value is not None else None,
+        "leaf_ingredients": template.leaf_ingredient_count,
+        "water_losses": template.water_loss_count,
+        "constraints": template.constraint_count,
+    }
+
+
+def run(solvers, repeat):
+    get_nutrient_table()
+    results = {}
+    for group, products in load_corpus().items():
+        results[group] = []
+        for product in products:
+            by_solver = {solver: solve_product(product, solver, repeat) for solver in solvers}
+            objectives = [result["objective"] for result in by_solver.values() if result["objective"] is not None]
+            best = min(objectives) if objectives else None
+            for result in by_solver.values():
+                if best is not None and result["objective"] is not None:
+                    result["gap"] = (result["objective"] - best) / max(abs(best), 1)
+                else:
+                    result["gap"] = None
+            results[group].append({"code": product["code"], "solvers": by_solver})
+    return results
+
+
+def summarise(results, solvers):
+    for group, products in results.items():
+        sizes = [product["solvers"][solvers[0]] for product in products]
+        print(
+            f"{group}: leaf ingredients {min(size['leaf_ingredients'] for size in sizes)}-{max(size['leaf_ingredients'] for size in sizes)}, "
+            f"constraints {min(size['constraints'] for size in sizes)}-{max(size['constraints'] for size in sizes)}, "
+            f"products with water losses {sum(size['water_losses'] > 0 for size in sizes)}"
+        )
+        for solver in solvers:
+            solved = [product["solvers"][solver] for product in products]
+            times = [result["time_ms"] for result in solved]
+            not_optimal = sum(result["status"] != "optimal" or result["solver_used"] != solver for result in solved)
+            gaps = [result["gap"] for result in solved if result["gap"] is not None]
+            print(
+                f"  {solver:10} p50 {np.percentile(times, 50):8.2f} ms  p95 {np.percentile(times, 95):8.2f} ms  "
+                f"not optimal {not_optimal:3}  max objective gap {max(gaps) if gaps else float('nan'):.2e}"
+            )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.cvxpy_solvers", description="Compare the cvxpy solvers on the product corpus")
+    parser.add_argument("--solvers", default=",".join(SOLVERS), help="comma separated solvers")
+    parser.add_argument("--repeat", type=int, default=5, help="timed solves of each product")
+    parser.add_argument("--output", help="write the results for each product to this JSON file")
+    args = parser.parse_args(argv)
+    solvers = args.solvers.split(",")
+    configure_logging("ERROR", "")
+    results = run(solvers, args.repeat)
+    summarise(results, solvers)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
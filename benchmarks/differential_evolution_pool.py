@@ -0,0 +1,53 @@
+import copy
+import io
+import random
+import sys
+import time
+from contextlib import redirect_stdout
+
+from recipe_estimator import recipe_estimator_scipy
+from recipe_estimator.differential_evolution_pool import pool_map, shutdown_pool
+from recipe_estimator.nutrients import get_ciqual_code_index, prepare_product
+
+# Compares differential evolution latency on large recipes (where the population is evaluated in parallel)
+# with a pool created for every call (workers=-1) and with the persistent pool. In process evaluation is shown for reference.
+# Run with: python -m benchmarks.differential_evolution_pool [number of products] [number of leaf ingredients]
+
+num_products = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+num_leaves = int(sys.argv[2]) if len(sys.argv) > 2 else 25
+
+random.seed(0)
+ingredient_ids = [ingredient_id for ingredient_id, codes in get_ciqual_code_index().items() if codes[0]]
+products = []
+for n in range(num_products):
+    products.append({
+        "code": str(n),
+        "ingredients": [{"id": random.choice(ingredient_ids)} for _ in range(num_leaves)],
+        "nutriments": {"proteins_100g": random.uniform(0, 20), "carbohydrates_100g": random.uniform(0, 60), "fat_100g": random.uniform(0, 30)},
+    })
+for product in products:
+    prepare_product(product)
+
+
+def run(workers):
+    recipe_estimator_scipy.pool_map = workers
+    times = []
+    for product in products:
+        start = time.perf_counter()
+        with redirect_stdout(io.StringIO()):
+            recipe_estimator_scipy.estimate_recipe(copy.deepcopy(product))
+        times.append(time.perf_counter() - start)
+    return sum(times) / len(times)
+
+
+in_process_time = run(1)
+per_call_time = run(-1)
+# Start the persistent pool before timing as the server would already have one
+run(pool_map)
+persistent_time = run(pool_map)
+shutdown_pool()
+
+print(f"{num_products} products with {num_leaves} leaf ingredients")
+print(f"In process (workers=1):     {in_process_time * 1000:.0f} ms per product")
+print(f"Pool per call (workers=-1): {per_call_time * 1000:.0f} ms per product")
+print(f"Persistent pool:            {persistent_time * 1000:.0f} ms per product")
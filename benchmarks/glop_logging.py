@@ -0,0 +1,56 @@
+import copy
+import io
+import logging
+import random
+import sys
+import time
+
+from recipe_estimator.log import TRACE, configure_logging
+from recipe_estimator.nutrients import get_ciqual_code_index, prepare_product
+from recipe_estimator.recipe_estimator_glop import estimate_recipe_glop
+
+# GLOP estimator latency with trace logging off (the default) vs on. With trace on every variable and constraint is
+# logged, which is what the estimator used to print unconditionally. Log output goes to an in-memory stream so the
+# numbers don't depend on the terminal.
+# Run with: python -m benchmarks.glop_logging [number of products]
+
+num_products = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+random.seed(0)
+ingredient_ids = [ingredient_id for ingredient_id, codes in get_ciqual_code_index().items() if codes[0]]
+
+
+def make_product(n):
+    ingredients = [{"id": random.choice(ingredient_ids)} for _ in range(random.randint(3, 10))]
+    ingredients[1]["ingredients"] = [{"id": random.choice(ingredient_ids)} for _ in range(3)]
+    ingredients[0]["percent"] = random.randint(30, 60)
+    product = {
+        "code": str(n),
+        "ingredients": ingredients,
+        "nutriments": {"proteins_100g": random.uniform(0, 20), "carbohydrates_100g": random.uniform(0, 60), "fat_100g": random.uniform(0, 30)},
+    }
+    prepare_product(product)
+    return product
+
+
+products = [make_product(n) for n in range(num_products)]
+stream = io.StringIO()
+package_logger = logging.getLogger("recipe_estimator")
+package_logger.handlers = [logging.StreamHandler(stream)]
+package_logger.propagate = False
+
+
+def run(level):
+    configure_logging(level, "")
+    stream.seek(0)
+    stream.truncate()
+    start = time.perf_counter()
+    for product in products:
+        estimate_recipe_glop(copy.deepcopy(product))
+    return (time.perf_counter() - start) / len(products) * 1000, stream.tell()
+
+
+# Warm up
+run(logging.WARNING)
+for name, level in [("warning", logging.WARNING), ("info", logging.INFO), ("trace", TRACE)]:
+    elapsed, output = run(level)
+    print(f"{name:8} {elapsed:6.2f} ms per product, {output / len(products):8.0f} bytes of log per product")
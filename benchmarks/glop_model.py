@@ -0,0 +1,67 @@
+import copy
+import logging
+import random
+import sys
+import time
+
+import numpy as np
+
+from recipe_estimator.nutrients import get_ciqual_code_index, prepare_product
+from recipe_estimator.prepare_nutrients import prepare_nutrients
+from recipe_estimator.recipe_estimator_glop import GlopModel, flatten_product
+
+# Sensitivity sweep with the GLOP model: re-solving a product for a range of values of one nutrient by building a new model
+# for each value vs updating the right hand sides of an existing model and re-solving.
+# Run with: python -m benchmarks.glop_model [number of products] [sweep steps]
+
+num_products = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+steps = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+logging.getLogger("recipe_estimator").setLevel(logging.WARNING)
+random.seed(0)
+ingredient_ids = [ingredient_id for ingredient_id, codes in get_ciqual_code_index().items() if codes[0]]
+
+
+def make_product(n, num_ingredients):
+    ingredients = [{"id": random.choice(ingredient_ids)} for _ in range(num_ingredients)]
+    ingredients[1]["ingredients"] = [{"id": random.choice(ingredient_ids)} for _ in range(3)]
+    product = {
+        "code": str(n),
+        "ingredients": ingredients,
+        "nutriments": {"proteins_100g": random.uniform(0, 20), "carbohydrates_100g": random.uniform(0, 60), "fat_100g": random.uniform(0, 30)},
+    }
+    prepare_product(product)
+    prepare_nutrients(product)
+    return product
+
+
+def sweep(recipe, rebuild):
+    nutrient_totals = recipe["nutrient_totals"].copy()
+    model = GlopModel(recipe)
+    solutions = []
+    for scale in np.linspace(0.8, 1.2, steps):
+        recipe["nutrient_totals"] = nutrient_totals * scale
+        if rebuild:
+            model = GlopModel(recipe)
+        else:
+            model.update(recipe)
+        model.solve()
+        solutions.append(model.solver.Objective().Value())
+    recipe["nutrient_totals"] = nutrient_totals
+    return solutions
+
+
+for num_ingredients in (5, 20, 50):
+    recipes = [flatten_product(make_product(n, num_ingredients)) for n in range(num_products)]
+    timings = {}
+    objectives = []
+    for rebuild in (True, False):
+        start = time.perf_counter()
+        results = [sweep(recipe, rebuild) for recipe in copy.copy(recipes)]
+        timings[rebuild] = (time.perf_counter() - start) / (num_products * steps) * 1000
+        objectives.append(results)
+    # Degenerate problems can have more than one optimal recipe, so compare the objective values
+    max_difference = max(abs(a - b) for rebuilt, updated in zip(*objectives) for a, b in zip(rebuilt, updated))
+    print(
+        f"{num_ingredients + 2:3} leaf ingredients: rebuild {timings[True]:.2f} ms, update {timings[False]:.2f} ms per solve"
+        f" (max objective difference {max_difference:.2g})"
+    )
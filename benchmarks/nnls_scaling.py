@@ -0,0 +1,73 @@
+import copy
+import io
+import random
+import sys
+import time
+from contextlib import redirect_stdout
+
+import numpy as np
+from scipy.optimize import nnls
+
+from recipe_estimator.nutrients import get_ciqual_code_index, get_nutrient_table, prepare_product
+from recipe_estimator.recipe_estimator_nnls import estimate_recipe, warm_start_nnls
+
+# Scaling of the NNLS estimator from 5 to 200 leaf ingredients:
+#  - building the cumulative design matrix and the ingredient quantities with loops (as before) vs cumulative sums
+#  - cold nnls vs warm starting from the solution for a slightly different product
+#  - the whole estimate_recipe
+# Run with: python -m benchmarks.nnls_scaling [repeats]
+
+repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+random.seed(0)
+ingredient_ids = [ingredient_id for ingredient_id, codes in get_ciqual_code_index().items() if codes[0]]
+
+
+def timed(function):
+    start = time.perf_counter()
+    for _ in range(repeats):
+        result = function()
+    return (time.perf_counter() - start) / repeats * 1000, result
+
+
+def loop_build(ingredients_nutrients, solution):
+    num_ingredients = ingredients_nutrients.shape[1]
+    A = np.zeros(ingredients_nutrients.shape)
+    for i in range(num_ingredients):
+        A[:, i] = ingredients_nutrients[:, 0:i + 1].sum(axis=1)
+    return A, np.array([100 * solution[i:num_ingredients].sum() for i in range(num_ingredients)])
+
+
+def cumsum_build(ingredients_nutrients, solution):
+    return np.cumsum(ingredients_nutrients, axis=1), 100 * np.cumsum(solution[::-1])[::-1]
+
+
+print("leaves  loop build  cumsum build  cold nnls  warm nnls  estimate_recipe (ms)")
+for num_leaves in (5, 10, 20, 50, 100, 200):
+    product = {
+        "code": str(num_leaves),
+        "ingredients": [{"id": random.choice(ingredient_ids)} for _ in range(num_leaves)],
+        "nutriments": {"proteins_100g": 8, "carbohydrates_100g": 40, "sugars_100g": 10, "fat_100g": 12, "fiber_100g": 3, "salt_100g": 1},
+    }
+    prepare_product(product)
+    estimated = copy.deepcopy(product)
+    with redirect_stdout(io.StringIO()):
+        solution = estimate_recipe(estimated)
+    nutrient_keys = [key for key, nutrient in estimated["recipe_estimator"]["nutrients"].items() if nutrient["weighting"] > 0]
+    leaf_ingredients = estimated["ingredients"]
+    ingredients_nutrients = get_nutrient_table().gather(leaf_ingredients, nutrient_keys)
+    b = np.array([estimated["recipe_estimator"]["nutrients"][key]["product_total"] for key in nutrient_keys])
+    A = np.cumsum(ingredients_nutrients, axis=1)
+    # A small edit to the product
+    b_edited = b * 1.01
+
+    loop_time, _ = timed(lambda: loop_build(ingredients_nutrients, solution))
+    cumsum_time, _ = timed(lambda: cumsum_build(ingredients_nutrients, solution))
+    cold_time, _ = timed(lambda: nnls(A, b_edited))
+    warm_time, warm = timed(lambda: warm_start_nnls(A, b_edited, solution) or nnls(A, b_edited))
+
+    def estimate():
+        with redirect_stdout(io.StringIO()):
+            estimate_recipe(copy.deepcopy(product))
+    estimate_time, _ = timed(estimate)
+
+    print(f"{num_leaves:6}  {loop_time:10.3f}  {cumsum_time:12.3f}  {cold_time:9.3f}  {warm_time:9.3f}  {estimate_time:8.2f}")
@@ -0,0 +1,73 @@
+import random
+import sys
+import time
+
+import copy
+
+from recipe_estimator import nutrients
+from recipe_estimator.nutrients import get_ciqual_code_index, get_ciqual_code_index_stats, get_ingredients_taxonomy, prepare_product, resolve_ciqual_code
+
+# Compares resolving ciqual codes by walking the taxonomy parents for every leaf ingredient (as prepare_product used to)
+# with the pre-resolved index, both on their own and as part of the per-product prepare_product time.
+# Run with: python -m benchmarks.prepare_product [number of products]
+
+num_products = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+random.seed(0)
+ingredients_taxonomy = get_ingredients_taxonomy()
+ingredient_ids = list(ingredients_taxonomy.keys())
+index = get_ciqual_code_index()
+print(get_ciqual_code_index_stats(index))
+
+
+def make_products():
+    products = []
+    for _ in range(num_products):
+        ingredients = [{'id': random.choice(ingredient_ids)} for _ in range(random.randint(1, 20))]
+        products.append({'ingredients': ingredients})
+    return products
+
+
+def leaf_ids(products):
+    return [ingredient['id'] for product in products for ingredient in product['ingredients']]
+
+
+products = make_products()
+ids = leaf_ids(products)
+
+start = time.perf_counter()
+for ingredient_id in ids:
+    resolve_ciqual_code(ingredients_taxonomy, ingredient_id)
+walk_time = time.perf_counter() - start
+
+start = time.perf_counter()
+for ingredient_id in ids:
+    index.get(ingredient_id)
+index_time = time.perf_counter() - start
+
+
+
+def walk_ciqual_code(ingredient_id):
+    ciqual_code, ciqual_proxy_code, _ = resolve_ciqual_code(ingredients_taxonomy, ingredient_id)
+    return ciqual_code, ciqual_proxy_code
+
+
+def time_prepare_product():
+    product_copies = copy.deepcopy(products)
+    start = time.perf_counter()
+    for product in product_copies:
+        prepare_product(product)
+    return time.perf_counter() - start
+
+
+# prepare_product looks up the ciqual code through nutrients.get_ciqual_code, so swap in the parent walk for the before time
+get_ciqual_code = nutrients.get_ciqual_code
+nutrients.get_ciqual_code = walk_ciqual_code
+prepare_walk_time = time_prepare_product()
+nutrients.get_ciqual_code = get_ciqual_code
+prepare_time = time_prepare_product()
+
+print(f"{len(ids)} leaf ingredients in {num_products} products")
+print(f"Parent walk: {walk_time / num_products * 1e6:.1f} us per product")
+print(f"Index:       {index_time / num_products * 1e6:.1f} us per product")
+print(f"prepare_product with parent walk: {prepare_walk_time / num_products * 1e6:.1f} us per product")
+print(f"prepare_product with index:       {prepare_time / num_products * 1e6:.1f} us per product")
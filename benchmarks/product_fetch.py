@@ -0,0 +1,69 @@
+import asyncio
+import json
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import requests
+
+from recipe_estimator import product, settings
+from recipe_estimator.product import ProductCache, ProductClient, get_product_async, get_test_set_index
+from recipe_estimator.product_test import StubProductServer
+
+# Latency of /product/{id} lookups against a local stub of the Open Food Facts API, with a test set directory of the
+# given size: the previous approach (walking the test set directory, then a new connection per request) vs the test set
+# index and pooled async client on a cache miss, and a cache hit.
+# Run with: python -m benchmarks.product_fetch [test set size] [requests]
+
+test_set_size = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+num_requests = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+
+
+def previous_get_product(test_set_dir, id):
+    matches = list(Path(test_set_dir).rglob(id + ".json"))
+    if len(matches) > 0:
+        with open(matches[0]) as f:
+            return json.load(f)
+    return requests.get(settings.OPENFOODFACTS_URL + "/api/v3/product/" + id).json()["product"]
+
+
+def percentiles(timings):
+    return " ".join(f"{t:7.2f}" for t in np.percentile(timings, [50, 95, 99]) * 1000)
+
+
+async def timed_async(ids):
+    timings = []
+    for id in ids:
+        start = time.perf_counter()
+        await get_product_async(id)
+        timings.append(time.perf_counter() - start)
+    await product.product_client.aclose()
+    return timings
+
+
+with tempfile.TemporaryDirectory() as test_set_dir, StubProductServer() as server:
+    for n in range(test_set_size):
+        directory = Path(test_set_dir) / f"set-{n % 20}"
+        directory.mkdir(exist_ok=True)
+        (directory / f"9{n}.json").write_text("{}")
+    settings.OPENFOODFACTS_URL = server.url
+    settings.PRODUCT_TEST_SET_DIR = test_set_dir
+    product.product_cache = ProductCache()
+    product.product_client = ProductClient()
+    ids = [str(1000 + n) for n in range(num_requests)]
+
+    timings = []
+    for id in ids:
+        start = time.perf_counter()
+        previous_get_product(test_set_dir, id)
+        timings.append(time.perf_counter() - start)
+    print(f"{test_set_size} test set products, p50/p95/p99 ms")
+    print(f"Previous (directory walk + new connection): {percentiles(timings)}")
+
+    start = time.perf_counter()
+    get_test_set_index()
+    print(f"Test set index built in {(time.perf_counter() - start) * 1000:.1f} ms")
+    print(f"Cache miss (pooled async client):           {percentiles(asyncio.run(timed_async(ids)))}")
+    print(f"Cache hit:                                  {percentiles(asyncio.run(timed_async(ids)))}")
@@ -0,0 +1,40 @@
+import os
+import statistics
+import subprocess
+import sys
+
+# Measures the cold start of a worker process: importing the package and estimating a first product,
+# loading the assets from the asset bundle and from the JSON / CSV files.
+# Run with: python -m benchmarks.startup [repeats]
+# Build the bundle first with: make build_asset_bundle
+
+COLD_START = """
+import time
+start = time.perf_counter()
+from recipe_estimator.nutrients import prepare_product
+from recipe_estimator.recipe_estimator_simple import estimate_recipe
+product = {'ingredients': [{'id': 'en:tomato'}, {'id': 'en:onion'}, {'id': 'en:salt'}], 'nutriments': {'salt_100g': 1}}
+prepare_product(product)
+estimate_recipe(product)
+print(time.perf_counter() - start)
+"""
+
+repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+root = os.path.join(os.path.dirname(__file__), "..")
+
+
+def cold_start(asset_bundle):
+    env = dict(os.environ)
+    if asset_bundle is not None:
+        env["ASSET_BUNDLE"] = asset_bundle
+    times = []
+    for _ in range(repeats):
+        output = subprocess.run([sys.executable, "-c", COLD_START], cwd=root, env=env, capture_output=True, text=True, check=True).stdout
+        times.append(float(output.strip().splitlines()[-1]))
+    return statistics.median(times)
+
+
+json_time = cold_start("")
+bundle_time = cold_start(None)
+print(f"JSON assets:  {json_time * 1000:.0f} ms")
+print(f"Asset bundle: {bundle_time * 1000:.0f} ms ({json_time / bundle_time:.1f}x faster)")
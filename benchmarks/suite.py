@@ -0,0 +1,186 @@
+import argparse
+import copy
+import json
+import platform
+import resource
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+from benchmarks.corpus import LEAF_GROUPS, load_corpus
+from recipe_estimator.estimation_methods import ESTIMATION_METHODS
+from recipe_estimator.log import configure_logging
+from recipe_estimator.nutrients import get_ciqual_code_index, get_nutrient_table, prepare_product
+from recipe_estimator.spans import Spans
+
+# Times each estimator end to end and per stage (see recipe_estimator.spans) over the product corpus in benchmarks/corpus,
+# by group of leaf ingredient count, and measures the peak memory allocated while estimating a product.
+# Everything runs offline from the corpus and the local assets.
+#
+# Run with: python -m benchmarks.suite [--methods cvxpy,glop] [--repeat 5] [--output results.json]
+# scipy and auto (which can escalate to differential evolution) aren't run by default as differential evolution takes
+# minutes for the larger products. Add them with --methods
+# To check a change for regressions, save a baseline on the main branch and compare with it on the branch:
+#   python -m benchmarks.suite --output baseline.json
+#   python -m benchmarks.suite --baseline baseline.json --threshold 0.2
+# which exits with status 1 if the p50 or p95 time, or the peak memory, of any method and group is more than
+# threshold (a fraction) above the baseline. Differences of less than --min-difference milliseconds are ignored as noise.
+
+PERCENTILES = (50, 95, 99)
+DEFAULT_METHODS = [method for method in ESTIMATION_METHODS if method not in ("scipy", "auto")]
+
+
+def percentiles(values):
+    return {f"p{q}": float(value) for q, value in zip(PERCENTILES, np.percentile(values, PERCENTILES))}
+
+
+def estimate(product, method):
+    product = copy.deepcopy(product)
+    with Spans() as spans:
+        start = time.perf_counter()
+        prepare_product(product)
+        ESTIMATION_METHODS[method](product)
+        total = time.perf_counter() - start
+    return total, spans.timings
+
+
+def peak_memory(product, method):
+    product = copy.deepcopy(product)
+    tracemalloc.reset_peak()
+    start = tracemalloc.get_traced_memory()[0]
+    prepare_product(product)
+    ESTIMATION_METHODS[method](product)
+    return tracemalloc.get_traced_memory()[1] - start
+
+
+def run_group(products, method, repeat):
+    # Untimed run first so one-off costs such as compiling a cvxpy template aren't counted against the first product
+    for product in products:
+        estimate(product, method)
+
+    totals = []
+    stages = {}
+    for _ in range(repeat):
+        for product in products:
+            total, timings = estimate(product, method)
+            totals.append(total * 1000)
+            for name, seconds in timings.items():
+                stages.setdefault(name, []).append(seconds * 1000)
+
+    # Separately as tracing allocations slows everything down
+    tracemalloc.start()
+    try:
+        peaks = [peak_memory(product, method) for product in products]
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "products": len(products),
+        "samples": len(totals),
+        "time_ms": percentiles(totals),
+        "stages_ms": {name: percentiles(values) for name, values in stages.items()},
+        "peak_memory_kib": round(max(peaks) / 1024, 1),
+    }
+
+
+def run(methods, groups, repeat):
+    corpus = load_corpus(groups)
+    # Load the assets before timing anything
+    get_ciqual_code_index()
+    get_nutrient_table()
+
+    results = {}
+    for method in methods:
+        results[method] = {}
+        for group, products in corpus.items():
+            start = time.perf_counter()
+            results[method][group] = run_group(products, method, repeat)
+            print_result(method, group, results[method][group], time.perf_counter() - start)
+    return {
+        "environment": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "machine": platform.machine(),
+            "processor": platform.processor(),
+        },
+        "repeat": repeat,
+        "results": results,
+        # Of the whole process, so includes loading the assets
+        "max_rss_kib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def print_result(method, group, result, elapsed):
+    time_ms = result["time_ms"]
+    print(
+        f"{method:20} {group:14} p50 {time_ms['p50']:9.2f} ms  p95 {time_ms['p95']:9.2f} ms  p99 {time_ms['p99']:9.2f} ms  "
+        f"peak {result['peak_memory_kib']:9.1f} KiB  ({elapsed:.1f} s)"
+    )
+    for name, stage in sorted(result["stages_ms"].items(), key=lambda item: -item[1]["p50"]):
+        print(f"{'':36}{name:17} p50 {stage['p50']:9.3f} ms  p95 {stage['p95']:9.3f} ms")
+
+
+# Returns a description of each regression from baseline to current
+def compare(current, baseline, threshold, min_difference):
+    regressions = []
+    for method, groups in current["results"].items():
+        for group, result in groups.items():
+            base = baseline["results"].get(method, {}).get(group)
+            if base is None:
+                continue
+            for statistic in ("p50", "p95"):
+                now = result["time_ms"][statistic]
+                before = base["time_ms"][statistic]
+                if now > before * (1 + threshold) and now - before > min_difference:
+                    regressions.append(f"{method} {group} {statistic}: {before:.2f} ms -> {now:.2f} ms ({now / before - 1:+.0%})")
+            now = result["peak_memory_kib"]
+            before = base["peak_memory_kib"]
+            if now > before * (1 + threshold):
+                regressions.append(f"{method} {group} peak memory: {before:.1f} KiB -> {now:.1f} KiB ({now / before - 1:+.0%})")
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.suite", description="Benchmark the estimators on the product corpus")
+    parser.add_argument("--methods", default=",".join(DEFAULT_METHODS), help="comma separated estimation methods")
+    parser.add_argument("--groups", help="comma separated leaf ingredient count groups, default all")
+    parser.add_argument("--repeat", type=int, default=5, help="timed runs of each product")
+    parser.add_argument("--output", help="write the results to this JSON file, e.g. to use as a baseline")
+    parser.add_argument("--baseline", help="results JSON to compare with")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed increase over the baseline as a fraction")
+    parser.add_argument("--min-difference", type=float, default=0.5, help="ignore time increases of less than this many milliseconds")
+    args = parser.parse_args(argv)
+    args.methods = args.methods.split(",")
+    for method in args.methods:
+        if method not in ESTIMATION_METHODS:
+            parser.error(f"unknown method {method}, expected one of {', '.join(ESTIMATION_METHODS)}")
+    args.groups = args.groups.split(",") if args.groups else None
+    for group in args.groups or ():
+        if group not in [name for name, _, _ in LEAF_GROUPS]:
+            parser.error(f"unknown group {group}, expected one of {', '.join(name for name, _, _ in LEAF_GROUPS)}")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    # Products the solvers can't solve are expected in the corpus
+    configure_logging("ERROR", "")
+    results = run(args.methods, args.groups, args.repeat)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold, args.min_difference)
+        for regression in regressions:
+            print("REGRESSION", regression)
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions of more than {args.threshold:.0%} against {args.baseline}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,285 @@
+import functools
+import json
+import logging
+import os
+import sys
+from collections.abc import Mapping
+
+import numpy as np
+
+from . import settings
+
+logger = logging.getLogger(__name__)
+
+# The asset bundle is a compact binary version of ingredients.json, ciqual_ingredients.json and nutrient_map.csv
+# that can be memory-mapped, so that worker processes don't need to parse several MB of JSON when they start.
+# It is built with: python -m scripts.build_asset_bundle
+#
+# Layout:
+#   magic (8 bytes) | version (uint32) | header length (uint32) | header (JSON) | padding | arrays...
+# The header holds the string tables (interned ingredient ids, ciqual codes, nutrient keys, etc.) and the
+# offset, dtype and shape of each array. Arrays are aligned to ALIGNMENT bytes from the start of the file.
+
+BUNDLE_MAGIC = b"RECIPEST"
+BUNDLE_VERSION = 3
+ALIGNMENT = 64
+
+# The CIQUAL table written by scripts/build_ciqual_ingredients.py alongside ciqual_ingredients.json has the same layout,
+# with just the CIQUAL foods and their nutrients
+CIQUAL_TABLE_MAGIC = b"CIQUALTB"
+CIQUAL_TABLE_VERSION = 1
+
+assets_dir = os.path.join(os.path.dirname(__file__), "assets")
+source_filenames = [
+    os.path.join(assets_dir, "ingredients.json"),
+    os.path.join(assets_dir, "ciqual_ingredients.json"),
+    os.path.join(assets_dir, "nutrient_map.csv"),
+]
+
+# Index 0 is used for a nutrient that is not present on the CIQUAL food
+CONFIDENCE_CODES = [None, "-", "A", "B", "C", "D"]
+# Last dimension of the nutrient matrix
+NOM, MIN, MAX = 0, 1, 2
+
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+# The nutrient values, confidence codes, modifiers and sources of the CIQUAL foods as arrays of food x nutrient
+def _ciqual_arrays(ciqual_ingredients, nutrient_keys):
+    nutrient_columns = {nutrient_key: n for n, nutrient_key in enumerate(nutrient_keys)}
+    food_codes = sorted(ciqual_ingredients.keys())
+    sources = sorted(
+        set(food.get("source", "") for food in ciqual_ingredients.values())
+        | set(
+            nutrient.get("source", "")
+            for food in ciqual_ingredients.values()
+            for nutrient in food["nutrients"].values()
+        )
+    )
+    source_index = {source: s for s, source in enumerate(sources)}
+
+    num_foods = len(food_codes)
+    num_nutrients = len(nutrient_keys)
+    # Stored as float64 so the estimators get exactly the same values as from the JSON
+    values = np.zeros((num_foods, num_nutrients, 3), dtype=np.float64)
+    confidence = np.zeros((num_foods, num_nutrients), dtype=np.uint8)
+    modifier = np.zeros((num_foods, num_nutrients), dtype=np.uint8)
+    nutrient_source = np.zeros((num_foods, num_nutrients), dtype=np.uint8)
+    food_source = np.zeros(num_foods, dtype=np.uint8)
+    food_names = []
+    for f, food_code in enumerate(food_codes):
+        food = ciqual_ingredients[food_code]
+        food_names.append(food["alim_nom_eng"])
+        food_source[f] = source_index[food.get("source", "")]
+        for nutrient_key, nutrient in food["nutrients"].items():
+            n = nutrient_columns.get(nutrient_key)
+            if n is None:
+                continue
+            values[f, n] = [nutrient["percent_nom"], nutrient["percent_min"], nutrient["percent_max"]]
+            confidence[f, n] = CONFIDENCE_CODES.index(nutrient.get("confidence", "-"))
+            modifier[f, n] = nutrient.get("modifier") == "<"
+            nutrient_source[f, n] = source_index[nutrient.get("source", "")]
+
+    header = {
+        "nutrient_keys": list(nutrient_keys),
+        "food_codes": food_codes,
+        "food_names": food_names,
+        "sources": sources,
+    }
+    arrays = {
+        "nutrient_values": values,
+        "nutrient_confidence": confidence,
+        "nutrient_modifier": modifier,
+        "nutrient_source": nutrient_source,
+        "food_source": food_source,
+    }
+    return header, arrays
+
+
+def _write_arrays(filename, magic, version, header, arrays):
+    header = {**header, "arrays": {}}
+
+    # Work out the array offsets. These depend on the header length, which in turn depends on the offsets,
+    # so use a fixed width placeholder to size the header first
+    def encode_header():
+        return json.dumps(header, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+    for name, array in arrays.items():
+        header["arrays"][name] = {"dtype": array.dtype.str, "shape": list(array.shape), "offset": 10**12}
+    offset = _align(16 + len(encode_header()))
+    first_offset = offset
+    for name, array in arrays.items():
+        header["arrays"][name]["offset"] = offset
+        offset = _align(offset + array.nbytes)
+    header_bytes = encode_header().ljust(first_offset - 16, b" ")
+
+    with open(filename + ".tmp", "wb") as table_file:
+        table_file.write(magic)
+        table_file.write(np.array([version, len(header_bytes)], dtype="<u4").tobytes())
+        table_file.write(header_bytes)
+        for name, array in arrays.items():
+            table_file.seek(header["arrays"][name]["offset"])
+            table_file.write(np.ascontiguousarray(array).tobytes())
+    # Replace atomically so that a running server never sees a partially written file
+    os.replace(filename + ".tmp", filename)
+
+
+# Returns the header, or None with a warning if the file isn't the expected kind or version
+def _read_header(filename, magic, version):
+    with open(filename, "rb") as table_file:
+        preamble = table_file.read(16)
+        if preamble[:8] != magic:
+            logger.warning("Ignoring %s as it is not a %s file", filename, magic.decode())
+            return None
+        file_version, header_length = np.frombuffer(preamble[8:], dtype="<u4")
+        if file_version != version:
+            logger.warning("Ignoring %s as it is version %s, expected %s", filename, file_version, version)
+            return None
+        return json.loads(table_file.read(int(header_length)))
+
+
+def write_bundle(filename, ingredient_codes, ciqual_ingredients, nutrient_map_rows):
+    # ingredient_codes is a dict of taxonomy id -> (ciqual_code, ciqual_proxy_code, source_parent) that has already been
+    # resolved through the taxonomy parents
+    header, arrays = _ciqual_arrays(ciqual_ingredients, [row["off_id"] for row in nutrient_map_rows])
+
+    # Ciqual codes referenced by the taxonomy are stored as indices into a single code table
+    # as many of them will not be in the CIQUAL table itself
+    ingredient_ids = sorted(ingredient_codes.keys())
+    # Source parents are stored as indices into the ingredient ids. In both cases 0 means None
+    codes = sorted(set(code for resolved in ingredient_codes.values() for code in resolved[:2] if code))
+    code_index = {code: c + 1 for c, code in enumerate(codes)}
+    ingredient_index = {ingredient_id: i + 1 for i, ingredient_id in enumerate(ingredient_ids)}
+    resolved_codes = np.zeros((len(ingredient_ids), 3), dtype=np.int32)
+    for i, ingredient_id in enumerate(ingredient_ids):
+        ciqual_code, ciqual_proxy_code, source_parent = ingredient_codes[ingredient_id]
+        resolved_codes[i] = [code_index.get(ciqual_code, 0), code_index.get(ciqual_proxy_code, 0), ingredient_index.get(source_parent, 0)]
+
+    arrays["resolved_codes"] = resolved_codes
+    header.update({
+        "nutrient_map": nutrient_map_rows,
+        "ingredient_ids": ingredient_ids,
+        "codes": codes,
+    })
+    _write_arrays(filename, BUNDLE_MAGIC, BUNDLE_VERSION, header, arrays)
+
+
+def write_ciqual_table(filename, ciqual_ingredients, nutrient_keys):
+    header, arrays = _ciqual_arrays(ciqual_ingredients, nutrient_keys)
+    _write_arrays(filename, CIQUAL_TABLE_MAGIC, CIQUAL_TABLE_VERSION, header, arrays)
+
+
+def _is_stale(filename, sources):
+    bundle_mtime = os.path.getmtime(filename)
+    return any(os.path.exists(source) and os.path.getmtime(source) > bundle_mtime for source in sources)
+
+
+def read_bundle(filename, sources=source_filenames):
+    # Returns None if there is no usable bundle, in which case the caller should fall back to the source files
+    if not filename or not os.path.exists(filename):
+        return None
+    if _is_stale(filename, sources):
+        logger.warning("Ignoring %s as it is older than its source files. Rebuild with: make build_asset_bundle", filename)
+        return None
+
+    header = _read_header(filename, BUNDLE_MAGIC, BUNDLE_VERSION)
+    return AssetBundle(filename, header) if header is not None else None
+
+
+# Returns None if there is no usable table
+def read_ciqual_table(filename):
+    if not filename or not os.path.exists(filename):
+        return None
+    header = _read_header(filename, CIQUAL_TABLE_MAGIC, CIQUAL_TABLE_VERSION)
+    return CiqualTable(filename, header) if header is not None else None
+
+
+@functools.cache
+def get_bundle():
+    return read_bundle(settings.ASSET_BUNDLE)
+
+
+# The memory-mapped CIQUAL foods and nutrients of a CIQUAL table or asset bundle
+class CiqualTable:
+    def __init__(self, filename, header):
+        self.filename = filename
+        self.nutrient_keys = header["nutrient_keys"]
+        self.food_codes = header["food_codes"]
+        self.food_names = header["food_names"]
+        self.sources = header["sources"]
+        self.food_rows = {food_code: f for f, food_code in enumerate(self.food_codes)}
+        self.arrays = {
+            name: np.memmap(filename, dtype=np.dtype(spec["dtype"]), mode="r", offset=spec["offset"], shape=tuple(spec["shape"]))
+            for name, spec in header["arrays"].items()
+        }
+        self.nutrient_values = self.arrays["nutrient_values"]
+        self.ciqual_ingredients = BundleCiqualIngredients(self)
+
+    def food(self, row):
+        # Rebuild the ciqual_ingredients.json entry for a row of the nutrient matrix
+        food_code = self.food_codes[row]
+        food_name = self.food_names[row]
+        values = self.nutrient_values[row]
+        confidence = self.arrays["nutrient_confidence"][row]
+        modifier = self.arrays["nutrient_modifier"][row]
+        nutrient_source = self.arrays["nutrient_source"][row]
+        nutrients = {}
+        for n in np.flatnonzero(confidence):
+            nutrient = {
+                "percent_nom": float(values[n, NOM]),
+                "percent_min": float(values[n, MIN]),
+                "percent_max": float(values[n, MAX]),
+                "confidence": CONFIDENCE_CODES[confidence[n]],
+                "source": self.sources[nutrient_source[n]],
+            }
+            if modifier[n]:
+                nutrient["modifier"] = "<"
+            nutrients[self.nutrient_keys[n]] = nutrient
+
+        return {
+            "id": food_code,
+            "ciqual_food_code": food_code,
+            "alim_nom_eng": food_name,
+            "text": food_name,
+            "nutrients": nutrients,
+            "source": self.sources[self.arrays["food_source"][row]],
+        }
+
+
+class AssetBundle(CiqualTable):
+    def __init__(self, filename, header):
+        super().__init__(filename, header)
+        self.nutrient_map_rows = header["nutrient_map"]
+        codes = [None] + header["codes"]
+        ingredient_ids = [None] + [sys.intern(ingredient_id) for ingredient_id in header["ingredient_ids"]]
+        resolved_codes = self.arrays["resolved_codes"].tolist()
+        self.ingredient_codes = {
+            ingredient_id: (codes[ciqual_code], codes[ciqual_proxy_code], ingredient_ids[source_parent])
+            for ingredient_id, (ciqual_code, ciqual_proxy_code, source_parent) in zip(ingredient_ids[1:], resolved_codes)
+        }
+
+
+class BundleCiqualIngredients(Mapping):
+    # Read-only dict of ciqual code -> ciqual ingredient that builds entries from the bundle on first access
+
+    def __init__(self, bundle):
+        self.bundle = bundle
+        self.cache = {}
+
+    def __getitem__(self, food_code):
+        food = self.cache.get(food_code)
+        if food is None:
+            food = self.bundle.food(self.bundle.food_rows[food_code])
+            self.cache[food_code] = food
+        return food
+
+    def __iter__(self):
+        return iter(self.bundle.food_codes)
+
+    def __len__(self):
+        return len(self.bundle.food_codes)
+
+    def __contains__(self, food_code):
+        return food_code in self.bundle.food_rows
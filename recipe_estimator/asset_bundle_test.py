@@ -0,0 +1,86 @@
+import os
+
+from .asset_bundle import read_bundle, read_ciqual_table, write_bundle, write_ciqual_table
+
+
+ciqual_ingredients = {
+    '20047': {
+        'id': '20047',
+        'ciqual_food_code': '20047',
+        'alim_nom_eng': 'Tomato, raw',
+        'text': 'Tomato, raw',
+        'source': '2025_11_03',
+        'nutrients': {
+            'carbohydrates': {'percent_nom': 2.45, 'percent_min': 2.1, 'percent_max': 4.3, 'confidence': 'A', 'source': '2025_11_03'},
+            'calcium': {'percent_nom': 0.0089, 'percent_min': 0.004, 'percent_max': 0.015, 'confidence': 'B', 'source': '2020_07_07'},
+            'salt': {'percent_nom': 0.01, 'percent_min': 0, 'percent_max': 0.01, 'confidence': '-', 'source': '2025_11_03', 'modifier': '<'},
+        },
+    },
+    '31016': {
+        'id': '31016',
+        'ciqual_food_code': '31016',
+        'alim_nom_eng': 'Sugar, white',
+        'text': 'Sugar, white',
+        'source': '2020_07_07',
+        'nutrients': {},
+    },
+}
+
+nutrient_map_rows = [
+    {'off_id': 'carbohydrates', 'ciqual_id': 'Carbohydrate (g/100g)', 'weighting': '1', 'factor': 1.0},
+    {'off_id': 'calcium', 'ciqual_id': 'Calcium (mg/100g)', 'weighting': '', 'factor': 1000.0},
+    {'off_id': 'salt', 'ciqual_id': 'Salt (g/100g)', 'weighting': '1', 'factor': 1.0},
+]
+
+ingredient_codes = {
+    'en:tomato': ('20047', None, None),
+    'en:cherry-tomato': ('20047', None, 'en:tomato'),
+    'en:tomato-sauce': (None, '11107', None),
+    'en:spice': (None, None, None),
+}
+
+
+def test_bundle_round_trips_assets(tmp_path):
+    filename = str(tmp_path / 'test.bundle')
+    write_bundle(filename, ingredient_codes, ciqual_ingredients, nutrient_map_rows)
+
+    bundle = read_bundle(filename, [])
+    assert bundle is not None
+    assert dict(bundle.ciqual_ingredients) == ciqual_ingredients
+    assert bundle.ingredient_codes == ingredient_codes
+    assert bundle.nutrient_map_rows == nutrient_map_rows
+    assert bundle.nutrient_values.shape == (2, 3, 3)
+
+
+def test_bundle_is_ignored_if_older_than_sources(tmp_path):
+    filename = str(tmp_path / 'test.bundle')
+    write_bundle(filename, ingredient_codes, ciqual_ingredients, nutrient_map_rows)
+    source = tmp_path / 'ingredients.json'
+    source.write_text('{}')
+    os.utime(filename, (0, 0))
+
+    assert read_bundle(filename, [str(source)]) is None
+
+
+def test_bundle_is_ignored_if_not_a_bundle(tmp_path):
+    filename = tmp_path / 'test.bundle'
+    filename.write_bytes(b'{"not": "a bundle"}')
+
+    assert read_bundle(str(filename), []) is None
+
+
+def test_ciqual_table_round_trips_ciqual_ingredients(tmp_path):
+    filename = str(tmp_path / 'ciqual_ingredients.table')
+    write_ciqual_table(filename, ciqual_ingredients, [row['off_id'] for row in nutrient_map_rows])
+
+    table = read_ciqual_table(filename)
+    assert table is not None
+    assert dict(table.ciqual_ingredients) == ciqual_ingredients
+    assert table.nutrient_values.shape == (2, 3, 3)
+
+
+def test_bundle_is_not_read_as_a_ciqual_table(tmp_path):
+    filename = str(tmp_path / 'test.bundle')
+    write_bundle(filename, ingredient_codes, ciqual_ingredients, nutrient_map_rows)
+
+    assert read_ciqual_table(filename) is None
@@ -0,0 +1,338 @@
+import argparse
+import gzip
+import json
+import logging
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from .estimation_methods import ESTIMATION_METHODS
+from .log import configure_logging
+from .nutrients import prepare_product, remove_temporary_ingredients_fields
+
+# Estimate recipes for a dump of products, e.g. openfoodfacts-products.jsonl.gz, in worker processes.
+# Run with: python -m recipe_estimator.bulk <input .jsonl[.gz]> <output .jsonl or .parquet> [options]
+#
+# Lines are sent to the workers in batches and a bounded number of batches are in flight, so memory doesn't grow with
+# the size of the dump. Results are written in input order and a checkpoint of the next input line and the size of the
+# output is saved after each batch, so an interrupted run can be continued with --resume.
+# Products without ingredients are skipped.
+
+logger = logging.getLogger(__name__)
+
+# Lines sent to a worker at a time
+BATCH_SIZE = 64
+# Seconds between progress lines
+PROGRESS_INTERVAL = 1
+
+
+def json_default(value):
+    # numpy values in the recipe_estimator metrics
+    if hasattr(value, "tolist"):
+        return value.tolist()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def estimate_product(line, method, penalties=False):
+    try:
+        product = json.loads(line)
+    except ValueError:
+        return {"code": None, "status": "failed", "error": "invalid_json"}
+    if not isinstance(product, dict) or not product.get("ingredients"):
+        return None
+
+    record = {"code": product.get("code"), "status": "ok", "error": None}
+    try:
+        prepare_product(product)
+        ESTIMATION_METHODS[method](product, penalties=penalties)
+    except Exception as e:
+        logger.warning("Product: %s, estimation failed: %r", product.get("code"), e)
+        record["status"] = "failed"
+        record["error"] = repr(e)
+        return record
+    remove_temporary_ingredients_fields(product["ingredients"])
+    record["ingredients"] = product["ingredients"]
+    record["recipe_estimator"] = product.get("recipe_estimator")
+    return record
+
+
+def encode_jsonl(record):
+    return json.dumps(record, default=json_default) + "\n"
+
+
+# Parquet rows are flat, so the ingredients and metrics are kept as JSON text
+def encode_parquet(record):
+    recipe_estimator = record.get("recipe_estimator") or {}
+    return {
+        "code": record["code"],
+        "status": record["status"],
+        "error": record["error"],
+        "time": recipe_estimator.get("time"),
+        "ingredients": json.dumps(record["ingredients"], default=json_default) if "ingredients" in record else None,
+        "recipe_estimator": json.dumps(recipe_estimator, default=json_default) if recipe_estimator else None,
+    }
+
+
+# Runs in a worker process
+def estimate_lines(lines, method, encode, penalties=False):
+    results = []
+    for line in lines:
+        record = estimate_product(line, method, penalties)
+        if record is not None:
+            results.append((record["status"], encode(record)))
+    return results
+
+
+class JsonlWriter:
+    encode = staticmethod(encode_jsonl)
+
+    def __init__(self, path, checkpoint=None):
+        if checkpoint is None:
+            self.file = open(path, "wb")
+        else:
+            # Anything after the checkpoint is from batches that will be estimated again
+            self.file = open(path, "r+b")
+            self.file.truncate(checkpoint["output_size"])
+            self.file.seek(0, os.SEEK_END)
+
+    def write(self, encoded):
+        self.file.write("".join(encoded).encode("utf-8"))
+
+    # Returns the state to save in the checkpoint once everything written so far is in the output
+    def commit(self):
+        self.file.flush()
+        return {"output_size": self.file.tell()}
+
+    def close(self):
+        state = self.commit()
+        self.file.close()
+        return state
+
+
+# Parquet can't be appended to, so the output is a directory of part files of rows_per_file rows each.
+# The checkpoint only moves on when a part file has been written
+class ParquetWriter:
+    encode = staticmethod(encode_parquet)
+
+    def __init__(self, path, checkpoint=None, rows_per_file=10000):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise SystemExit("Parquet output needs pyarrow: pip install pyarrow")
+        self.pyarrow = pyarrow
+        self.schema = pyarrow.schema([
+            ("code", pyarrow.string()),
+            ("status", pyarrow.string()),
+            ("error", pyarrow.string()),
+            ("time", pyarrow.float64()),
+            ("ingredients", pyarrow.string()),
+            ("recipe_estimator", pyarrow.string()),
+        ])
+        self.directory = Path(path)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.rows_per_file = rows_per_file
+        self.parts = checkpoint["parts"] if checkpoint else 0
+        self.rows = []
+        # Remove parts written after the checkpoint, or by a previous run
+        for part in self.directory.glob("part-*.parquet"):
+            if checkpoint is None or int(part.stem.split("-")[1]) >= self.parts:
+                part.unlink()
+
+    def write(self, encoded):
+        self.rows.extend(encoded)
+
+    def write_part(self):
+        table = self.pyarrow.Table.from_pylist(self.rows, schema=self.schema)
+        path = self.directory / f"part-{self.parts:05}.parquet"
+        temporary_path = path.with_suffix(".tmp")
+        self.pyarrow.parquet.write_table(table, temporary_path)
+        os.replace(temporary_path, path)
+        self.parts += 1
+        self.rows = []
+
+    def commit(self):
+        if len(self.rows) < self.rows_per_file:
+            return None
+        self.write_part()
+        return {"parts": self.parts}
+
+    def close(self):
+        if self.rows:
+            self.write_part()
+        return {"parts": self.parts}
+
+
+def open_lines(path):
+    raw = open(path, "rb")
+    if str(path).endswith(".gz"):
+        return raw, gzip.GzipFile(fileobj=raw)
+    return raw, raw
+
+
+def read_checkpoint(path):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def write_checkpoint(path, checkpoint):
+    temporary_path = str(path) + ".tmp"
+    with open(temporary_path, "w", encoding="utf-8") as f:
+        json.dump(checkpoint, f)
+    os.replace(temporary_path, path)
+
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    return f"{seconds // 3600}:{seconds // 60 % 60:02}:{seconds % 60:02}"
+
+
+# Prints a throughput / ETA line to stderr. The ETA comes from the line range if an end line was given,
+# otherwise from how far through the (compressed) input file we are
+class Progress:
+    def __init__(self, raw, start_line, end_line, stream=sys.stderr):
+        self.raw = raw
+        self.start_line = start_line
+        self.end_line = end_line
+        self.stream = stream
+        self.input_size = os.fstat(raw.fileno()).st_size
+        self.start_position = raw.tell()
+        self.start_time = time.perf_counter()
+        self.last_time = 0
+
+    def update(self, line, counts, force=False):
+        now = time.perf_counter()
+        if not force and now - self.last_time < PROGRESS_INTERVAL:
+            return
+        self.last_time = now
+        elapsed = now - self.start_time
+        lines = line - self.start_line
+        rate = lines / elapsed if elapsed else 0
+        if self.end_line is not None:
+            remaining = (self.end_line - line) / rate if rate else None
+        else:
+            position = self.raw.tell() - self.start_position
+            remaining = elapsed * (self.input_size - self.raw.tell()) / position if position else None
+        eta = format_duration(remaining) if remaining is not None else "?"
+        self.stream.write(
+            f"\rline {line}: {counts['ok']} estimated, {counts['failed']} failed, {rate:.0f} lines/s, "
+            f"{counts['ok'] / elapsed if elapsed else 0:.1f} products/s, elapsed {format_duration(elapsed)}, ETA {eta}  "
+        )
+        self.stream.flush()
+
+
+def run(args):
+    output_format = args.format or ("parquet" if str(args.output).endswith(".parquet") else "jsonl")
+    checkpoint_path = args.checkpoint or str(args.output) + ".checkpoint"
+    settings = {"input": str(args.input), "method": args.method, "penalties": args.penalties, "format": output_format, "start": args.start, "end": args.end}
+
+    checkpoint = read_checkpoint(checkpoint_path)
+    if checkpoint is not None and not args.resume:
+        raise SystemExit(f"{checkpoint_path} exists. Use --resume to continue from it, or delete it to start again")
+    if checkpoint is not None:
+        if checkpoint["settings"] != settings:
+            raise SystemExit(f"{checkpoint_path} is for a different run: {checkpoint['settings']}")
+        if checkpoint.get("complete"):
+            print(f"{args.output} is already complete", file=sys.stderr)
+            return checkpoint
+        writer_state = checkpoint["writer"]
+        counts = checkpoint["counts"]
+        start_line = checkpoint["line"]
+    else:
+        writer_state = None
+        counts = {"ok": 0, "failed": 0}
+        start_line = args.start
+
+    if output_format == "parquet":
+        writer = ParquetWriter(args.output, writer_state, args.rows_per_file)
+    else:
+        writer = JsonlWriter(args.output, writer_state)
+
+    workers = args.workers if args.workers is not None else os.cpu_count()
+    executor = ProcessPoolExecutor(workers, initializer=configure_logging, initargs=(args.log_level, "")) if workers else None
+    max_pending = 2 * max(workers, 1)
+    pending = deque()
+    raw, lines = open_lines(args.input)
+    progress = Progress(raw, start_line, args.end)
+
+    def write_result(results, line):
+        writer.write([encoded for _, encoded in results])
+        for status, _ in results:
+            counts[status] += 1
+        state = writer.commit()
+        if state is not None:
+            write_checkpoint(checkpoint_path, {"settings": settings, "line": line, "counts": counts, "writer": state})
+        progress.update(line, counts)
+
+    def submit(batch, line):
+        if executor is None:
+            write_result(estimate_lines(batch, args.method, writer.encode, args.penalties), line)
+            return
+        pending.append((executor.submit(estimate_lines, batch, args.method, writer.encode, args.penalties), line))
+        while len(pending) >= max_pending:
+            future, line = pending.popleft()
+            write_result(future.result(), line)
+
+    try:
+        batch = []
+        # The line to continue from once the batch has been written
+        end_line = start_line
+        for line_number, line in enumerate(lines):
+            if line_number < start_line:
+                continue
+            if args.end is not None and line_number >= args.end:
+                break
+            batch.append(line)
+            end_line = line_number + 1
+            if len(batch) == BATCH_SIZE:
+                submit(batch, end_line)
+                batch = []
+        if batch:
+            submit(batch, end_line)
+        while pending:
+            future, line = pending.popleft()
+            write_result(future.result(), line)
+
+        checkpoint = {"settings": settings, "line": end_line, "counts": counts, "writer": writer.close(), "complete": True}
+        write_checkpoint(checkpoint_path, checkpoint)
+        progress.update(end_line, counts, force=True)
+        print(file=sys.stderr)
+        return checkpoint
+    finally:
+        raw.close()
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m recipe_estimator.bulk", description="Estimate recipes for a JSONL dump of products")
+    parser.add_argument("input", help="products, one JSON object per line, optionally gzipped")
+    parser.add_argument("output", help="JSONL file, or directory of Parquet part files")
+    parser.add_argument("--method", default="cvxpy", choices=sorted(ESTIMATION_METHODS))
+    parser.add_argument("--penalties", action="store_true", help="include the penalties breakdown in recipe_estimator")
+    parser.add_argument("--format", choices=["jsonl", "parquet"], help="default from the output extension")
+    parser.add_argument("--workers", type=int, help="number of worker processes, default one per CPU. 0 estimates in this process")
+    parser.add_argument("--start", type=int, default=0, help="first input line (from 0) for this shard")
+    parser.add_argument("--end", type=int, help="input line to stop before for this shard")
+    parser.add_argument("--checkpoint", help="checkpoint file, default <output>.checkpoint")
+    parser.add_argument("--resume", action="store_true", help="continue from the checkpoint")
+    parser.add_argument("--rows-per-file", type=int, default=10000, help="rows per Parquet part file")
+    parser.add_argument("--log-level", default="WARNING")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    configure_logging(args.log_level, "")
+    checkpoint = run(args)
+    print(f"{checkpoint['counts']['ok']} estimated, {checkpoint['counts']['failed']} failed", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+import gzip
+import json
+
+import pytest
+
+from .bulk import main, read_checkpoint
+
+
+def write_products(path, count):
+    with gzip.open(path, "wt", encoding="utf-8") as f:
+        for n in range(count):
+            product = {"code": str(n), "ingredients": [{"id": "en:tomato"}, {"id": "en:salt"}], "nutriments": {"salt_100g": 1}}
+            if n == 2:
+                product.pop("ingredients")
+            f.write(json.dumps(product) + "\n")
+            if n == 3:
+                f.write("not json\n")
+
+
+def read_records(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+def run(tmp_path, *args):
+    main([str(tmp_path / "products.jsonl.gz"), str(tmp_path / "out.jsonl"), "--method", "simple", "--workers", "0", *args])
+    return read_records(tmp_path / "out.jsonl")
+
+
+def test_bulk_estimates_products_in_order(tmp_path):
+    write_products(tmp_path / "products.jsonl.gz", 6)
+    records = run(tmp_path)
+
+    # Product 2 has no ingredients so is skipped
+    assert [record["code"] for record in records] == ["0", "1", "3", None, "4", "5"]
+    assert records[3] == {"code": None, "status": "failed", "error": "invalid_json"}
+    assert records[0]["status"] == "ok"
+    assert round(sum(ingredient["percent_estimate"] for ingredient in records[0]["ingredients"])) == 100
+
+    checkpoint = read_checkpoint(tmp_path / "out.jsonl.checkpoint")
+    assert checkpoint["complete"]
+    assert checkpoint["line"] == 7
+    assert checkpoint["counts"] == {"ok": 5, "failed": 1}
+
+
+def test_bulk_line_range(tmp_path):
+    write_products(tmp_path / "products.jsonl.gz", 6)
+    records = run(tmp_path, "--start", "1", "--end", "4")
+    assert [record["code"] for record in records] == ["1", "3"]
+
+
+def test_bulk_worker_processes(tmp_path):
+    write_products(tmp_path / "products.jsonl.gz", 100)
+    main([str(tmp_path / "products.jsonl.gz"), str(tmp_path / "out.jsonl"), "--method", "simple", "--workers", "2"])
+    assert [record["code"] for record in read_records(tmp_path / "out.jsonl")] == [
+        str(n) if n <= 3 else (None if n == 4 else str(n - 1)) for n in range(101) if n != 2
+    ]
+
+
+def test_bulk_resume_from_checkpoint(tmp_path):
+    write_products(tmp_path / "products.jsonl.gz", 6)
+    expected = run(tmp_path)
+
+    # Rewind the checkpoint to after the first two products, with a partly written record after it
+    checkpoint_path = tmp_path / "out.jsonl.checkpoint"
+    checkpoint = read_checkpoint(checkpoint_path)
+    with open(tmp_path / "out.jsonl", "rb") as f:
+        first_two = f.readline() + f.readline()
+    with open(tmp_path / "out.jsonl", "wb") as f:
+        f.write(first_two + b'{"code": "3", "sta')
+    checkpoint.pop("complete")
+    checkpoint.update({"line": 2, "counts": {"ok": 2, "failed": 0}, "writer": {"output_size": len(first_two)}})
+    checkpoint_path.write_text(json.dumps(checkpoint))
+
+    with pytest.raises(SystemExit):
+        run(tmp_path)
+    assert run(tmp_path, "--resume") == expected
+    assert read_checkpoint(checkpoint_path)["counts"] == {"ok": 5, "failed": 1}
+
+    # The checkpoint is for a different range
+    with pytest.raises(SystemExit):
+        run(tmp_path, "--resume", "--start", "1")
+
+
+def test_bulk_parquet(tmp_path):
+    pyarrow_parquet = pytest.importorskip("pyarrow.parquet")
+    write_products(tmp_path / "products.jsonl.gz", 6)
+    main([str(tmp_path / "products.jsonl.gz"), str(tmp_path / "out.parquet"), "--method", "simple", "--workers", "0", "--rows-per-file", "4"])
+    table = pyarrow_parquet.read_table(tmp_path / "out.parquet")
+    assert table.column("code").to_pylist() == ["0", "1", "3", None, "4", "5"]
+    assert len(list((tmp_path / "out.parquet").glob("part-*.parquet"))) == 2
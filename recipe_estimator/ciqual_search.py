@@ -0,0 +1,96 @@
+import functools
+import itertools
+import re
+import unicodedata
+
+import numpy as np
+
+from .asset_bundle import get_bundle
+from .nutrients import get_ciqual_ingredients
+
+# Size of the cache of recent query results. The frontend searches on every keystroke so the same prefixes come up a lot
+QUERY_CACHE_SIZE = 1024
+
+token_pattern = re.compile(r"\w+")
+
+
+# Casefold and remove accents so that "creme" finds "Crème"
+def fold(text):
+    decomposed = unicodedata.normalize("NFKD", text.casefold())
+    return "".join(c for c in decomposed if not unicodedata.combining(c))
+
+
+def tokenize(text):
+    return token_pattern.findall(fold(text))
+
+
+# Search index for CIQUAL foods on their name and food code. Every prefix of every token maps to a sorted posting list of foods
+# containing a token with that prefix, so a query is the intersection of one posting list per search term regardless of how many
+# foods there are. Foods are numbered with shorter names first so posting lists (and their intersections) are already in rank order
+class CiqualSearchIndex:
+    # food_names is an iterable of (food code, name). Foods are looked up in ciqual_ingredients when they are returned
+    def __init__(self, food_names, ciqual_ingredients):
+        self.ciqual_ingredients = ciqual_ingredients
+        food_names = sorted(food_names, key=lambda food_name: (len(food_name[1]), food_name[1]))
+        self.food_codes = [food_code for food_code, _ in food_names]
+        prefixes = {}
+        tokens = {}
+        for food_index, (food_code, food_name) in enumerate(food_names):
+            for token in set(tokenize(food_name) + tokenize(food_code)):
+                tokens.setdefault(token, []).append(food_index)
+                for length in range(1, len(token) + 1):
+                    prefix_postings = prefixes.setdefault(token[:length], [])
+                    # Foods are added in order, so only need to check the last one to avoid duplicates
+                    if not prefix_postings or prefix_postings[-1] != food_index:
+                        prefix_postings.append(food_index)
+        self.prefixes = {prefix: np.array(postings, dtype=np.int32) for prefix, postings in prefixes.items()}
+        self.tokens = {token: np.array(postings, dtype=np.int32) for token, postings in tokens.items()}
+        self.search = functools.lru_cache(maxsize=QUERY_CACHE_SIZE)(self.search)
+
+    def search(self, query, limit=20):
+        terms = tokenize(query)
+        if not terms:
+            # The first foods in the original order
+            return list(itertools.islice(self.ciqual_ingredients.values(), limit))
+
+        # Intersect the shortest posting lists first
+        terms = set(terms)
+        postings = sorted((self.prefixes.get(term) for term in terms), key=lambda p: 0 if p is None else len(p))
+        if postings[0] is None:
+            return []
+        matches = postings[0]
+
+        if len(terms) == 1:
+            # Most keystrokes are a single term. Whole word matches come first, and they are a subset of the prefix matches,
+            # so only the first limit foods of each posting list need to be looked at
+            exact_matches = self.tokens.get(next(iter(terms)), matches[:0])[:limit]
+            others = matches[:limit + len(exact_matches)]
+            others = others[~np.isin(others, exact_matches, assume_unique=True)]
+            return self.get_foods(np.concatenate((exact_matches, others))[:limit])
+
+        for posting in postings[1:]:
+            matches = np.intersect1d(matches, posting, assume_unique=True)
+            if not len(matches):
+                return []
+
+        # Rank foods where terms match whole words first, then on the shorter name
+        exact = np.zeros(len(matches), dtype=np.int32)
+        for term in terms:
+            exact_postings = self.tokens.get(term)
+            if exact_postings is not None:
+                exact += np.isin(matches, exact_postings, assume_unique=True)
+        return self.get_foods(matches[np.argsort(-exact, kind="stable")[:limit]])
+
+    def get_foods(self, food_indices):
+        return [self.ciqual_ingredients[self.food_codes[food_index]] for food_index in food_indices]
+
+
+@functools.cache
+def get_ciqual_search_index():
+    # Only the names are needed to build the index, which for the asset bundle avoids building every food entry
+    bundle = get_bundle()
+    if bundle is not None:
+        food_names = zip(bundle.food_codes, bundle.food_names)
+    else:
+        food_names = ((food["ciqual_food_code"], food["alim_nom_eng"]) for food in get_ciqual_ingredients().values())
+    return CiqualSearchIndex(food_names, get_ciqual_ingredients())
@@ -0,0 +1,49 @@
+from recipe_estimator.ciqual_search import CiqualSearchIndex, fold, tokenize
+
+
+def get_index():
+    ciqual_ingredients = {
+        food_code: {"ciqual_food_code": food_code, "alim_nom_eng": name}
+        for food_code, name in [
+            ("1000", "Pastis (anise-flavoured spirit)"),
+            ("20047", "Tomato, raw"),
+            ("20100", "Tomato sauce, with onions, prepacked"),
+            ("19590", "Crème fraîche, 30% fat"),
+            ("20200", "Tomatillo, raw"),
+            ("13001", "Raw cane sugar"),
+        ]
+    }
+    return CiqualSearchIndex(((code, food["alim_nom_eng"]) for code, food in ciqual_ingredients.items()), ciqual_ingredients)
+
+
+def names(foods):
+    return [food["alim_nom_eng"] for food in foods]
+
+
+def test_fold_removes_case_and_accents():
+    assert fold("Crème Fraîche") == "creme fraiche"
+    assert tokenize("Tomato, raw (20047)") == ["tomato", "raw", "20047"]
+
+
+def test_search_matches_token_prefixes():
+    index = get_index()
+    assert names(index.search("tom")) == ["Tomato, raw", "Tomatillo, raw", "Tomato sauce, with onions, prepacked"]
+    assert names(index.search("creme FRAICHE")) == ["Crème fraîche, 30% fat"]
+    assert names(index.search("2004")) == ["Tomato, raw"]
+    # Terms must all match and can be in any order
+    assert names(index.search("raw tom")) == ["Tomato, raw", "Tomatillo, raw"]
+    assert index.search("tomato fat") == []
+    assert index.search("banana") == []
+
+
+def test_search_ranks_whole_word_matches_first():
+    index = get_index()
+    assert names(index.search("tomato")) == ["Tomato, raw", "Tomato sauce, with onions, prepacked"]
+    assert names(index.search("raw")) == ["Tomato, raw", "Raw cane sugar", "Tomatillo, raw"]
+    assert names(index.search("ra")) == ["Tomato, raw", "Raw cane sugar", "Tomatillo, raw"]
+
+
+def test_search_limit_and_empty_query():
+    index = get_index()
+    assert len(index.search("t", 2)) == 2
+    assert names(index.search(" ", 2)) == ["Pastis (anise-flavoured spirit)", "Tomato, raw"]
@@ -0,0 +1,114 @@
+import numpy as np
+
+from .nutrient_table import NOM
+from .nutrients import get_nutrient_table
+from .spans import span
+
+
+# The ingredient tree of a product flattened in pre-order with a single traversal, so that the estimators can work with flat arrays
+# rather than each walking the tree, and write their results back to the tree once at the end. For ingredient i in ingredients:
+#  - parents[i]: index of its parent, -1 for top level ingredients, and depths[i]: 0 for top level ingredients
+#  - positions[i]: position among its siblings, sibling_counts[i]: number of siblings including itself and
+#    previous_siblings[i]: index of the sibling before it, -1 for the first
+#  - leaf_starts[i] / leaf_ends[i]: the range of leaf ingredients that make it up, so a leaf ingredient has a range of one
+#  - percents[i]: the stated percentage, NaN if there isn't one
+# post_order lists the ingredients with children before their parents. For leaf ingredient l, leaves[l] is its index in ingredients
+# and leaf_ingredients[l] the ingredient itself. structure is the shape of the tree, which is all that the cvxpy constraints depend on.
+# Create after prepare_product so that the leaf ingredients have their nutrients
+class CompiledRecipe:
+    def __init__(self, ingredients):
+        self.ingredients = []
+        self.leaf_ingredients = []
+        parents = []
+        depths = []
+        positions = []
+        sibling_counts = []
+        previous_siblings = []
+        leaf_starts = []
+        leaf_ends = []
+        percents = []
+        leaves = []
+        post_order = []
+
+        def add_ingredients(ingredients, parent, depth):
+            structure = []
+            previous_sibling = -1
+            for position, ingredient in enumerate(ingredients):
+                index = len(self.ingredients)
+                self.ingredients.append(ingredient)
+                parents.append(parent)
+                depths.append(depth)
+                positions.append(position)
+                sibling_counts.append(len(ingredients))
+                previous_siblings.append(previous_sibling)
+                leaf_starts.append(len(self.leaf_ingredients))
+                leaf_ends.append(0)
+                percent = ingredient.get("percent")
+                percents.append(np.nan if percent is None else percent)
+                if ingredient.get("ingredients"):
+                    children = add_ingredients(ingredient["ingredients"], index, depth + 1)
+                else:
+                    children = None
+                    leaves.append(index)
+                    self.leaf_ingredients.append(ingredient)
+                leaf_ends[index] = len(self.leaf_ingredients)
+                post_order.append(index)
+                structure.append((percent is not None, children))
+                previous_sibling = index
+            return tuple(structure)
+
+        self.structure = add_ingredients(ingredients, -1, 0)
+        self.parents = np.array(parents, dtype=np.int32)
+        self.depths = np.array(depths, dtype=np.int32)
+        self.positions = np.array(positions, dtype=np.int32)
+        self.sibling_counts = np.array(sibling_counts, dtype=np.int32)
+        self.previous_siblings = np.array(previous_siblings, dtype=np.int32)
+        self.leaf_starts = np.array(leaf_starts, dtype=np.int32)
+        self.leaf_ends = np.array(leaf_ends, dtype=np.int32)
+        self.percents = np.array(percents, dtype=float)
+        self.leaves = np.array(leaves, dtype=np.int32)
+        self.post_order = np.array(post_order, dtype=np.int32)
+
+        # Gathered from the nutrient table once for all the estimator stages
+        nutrient_table = get_nutrient_table()
+        self.leaf_ids = [ingredient["id"] for ingredient in self.leaf_ingredients]
+        self.ciqual_rows = nutrient_table.leaf_rows(self.leaf_ingredients)
+        self.nutrient_values, self.nutrient_valid = nutrient_table.rows_values(self.ciqual_rows, self.leaf_ingredients)
+        self.nutrient_columns = nutrient_table.columns
+        # Unknown nutrients are treated as zero
+        self.water = self.nutrient_values[:, self.nutrient_columns["water"], NOM] * 0.01
+        self.unknown = np.array([not ingredient.get("nutrients") for ingredient in self.leaf_ingredients], dtype=bool)
+
+    def __len__(self):
+        return len(self.ingredients)
+
+    # nutrients x leaf ingredients matrix of the given bound in the CIQUAL units (percent of the food)
+    def gather(self, nutrient_keys, bound=NOM):
+        columns = [self.nutrient_columns[nutrient_key] for nutrient_key in nutrient_keys]
+        return self.nutrient_values[:, columns, bound].T
+
+    # Total of the leaf values that make up each ingredient
+    def sum_leaves(self, leaf_values):
+        totals = np.concatenate([[0], np.cumsum(leaf_values)])
+        return totals[self.leaf_ends] - totals[self.leaf_starts]
+
+    # Writes the estimates for every ingredient back to the ingredient tree
+    def write_back(self, percent_estimates, quantity_estimates):
+        for ingredient, percent_estimate, quantity_estimate in zip(self.ingredients, percent_estimates.tolist(), quantity_estimates.tolist()):
+            ingredient["percent_estimate"] = percent_estimate
+            ingredient["quantity_estimate"] = quantity_estimate
+
+    # Leaf ingredient estimates are rounded to 2 decimal places and the estimates of ingredients with children are the sum of them
+    def write_leaf_estimates(self, leaf_percent_estimates, leaf_quantity_estimates):
+        self.write_back(
+            np.round(self.sum_leaves(np.round(leaf_percent_estimates, 2)), 2),
+            np.round(self.sum_leaves(np.round(leaf_quantity_estimates, 2)), 2),
+        )
+
+
+# The compiled recipe to use for a product, e.g. given to an estimator by the caller, or otherwise compiled now
+def get_compiled_recipe(product, compiled=None):
+    if compiled is None:
+        with span("compile_recipe"):
+            compiled = CompiledRecipe(product["ingredients"])
+    return compiled
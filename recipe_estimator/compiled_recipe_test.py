@@ -0,0 +1,65 @@
+import numpy as np
+
+from .compiled_recipe import CompiledRecipe
+from .recipe_estimator_cvxpy import get_structure
+
+
+def leaf(id, water=None, **fields):
+    nutrients = {'water': {'percent_nom': water}} if water is not None else {}
+    return {'id': id, 'nutrients': nutrients, **fields}
+
+
+def get_ingredients():
+    return [
+        leaf('A', 80),
+        {'id': 'B', 'percent': 20, 'ingredients': [leaf('B1', 50), {'id': 'B2', 'ingredients': [leaf('B2a'), leaf('B2b', 10)]}]},
+        leaf('C', percent=5),
+    ]
+
+
+def test_flattens_the_ingredient_tree_in_pre_order():
+    ingredients = get_ingredients()
+    compiled = CompiledRecipe(ingredients)
+
+    assert [ingredient['id'] for ingredient in compiled.ingredients] == ['A', 'B', 'B1', 'B2', 'B2a', 'B2b', 'C']
+    assert compiled.parents.tolist() == [-1, -1, 1, 1, 3, 3, -1]
+    assert compiled.depths.tolist() == [0, 0, 1, 1, 2, 2, 0]
+    assert compiled.positions.tolist() == [0, 1, 0, 1, 0, 1, 2]
+    assert compiled.sibling_counts.tolist() == [3, 3, 2, 2, 2, 2, 3]
+    assert compiled.previous_siblings.tolist() == [-1, 0, -1, 2, -1, 4, 1]
+    assert compiled.leaf_starts.tolist() == [0, 1, 1, 2, 2, 3, 4]
+    assert compiled.leaf_ends.tolist() == [1, 4, 2, 4, 3, 4, 5]
+    assert compiled.leaf_ids == ['A', 'B1', 'B2a', 'B2b', 'C']
+    assert compiled.leaves.tolist() == [0, 2, 4, 5, 6]
+    # Children before their parents
+    assert [compiled.ingredients[i]['id'] for i in compiled.post_order] == ['A', 'B1', 'B2a', 'B2b', 'B2', 'B', 'C']
+    assert np.array_equal(compiled.percents, [np.nan, 20, np.nan, np.nan, np.nan, np.nan, 5], equal_nan=True)
+    assert compiled.structure == get_structure(ingredients)
+
+
+def test_gathers_nutrients_of_the_leaf_ingredients():
+    compiled = CompiledRecipe(get_ingredients())
+
+    assert np.allclose(compiled.water, [0.8, 0.5, 0, 0.1, 0])
+    assert np.array_equal(compiled.gather(['water']), [[80, 50, 0, 10, 0]])
+    # Leaves without nutrients are unknown
+    assert compiled.unknown.tolist() == [False, False, True, False, True]
+
+
+def test_write_leaf_estimates_sums_the_rounded_leaves():
+    ingredients = get_ingredients()
+    compiled = CompiledRecipe(ingredients)
+
+    compiled.write_leaf_estimates(np.array([50.004, 20.004, 10.004, 10.004, 9.984]), np.array([60.004, 20.0, 10.0, 10.0, 10.0]))
+
+    assert [ingredient['percent_estimate'] for ingredient in compiled.ingredients] == [50, 40, 20, 20, 10, 10, 9.98]
+    assert [ingredient['quantity_estimate'] for ingredient in compiled.ingredients] == [60, 40, 20, 20, 10, 10, 10]
+    assert ingredients[1]['ingredients'][1]['percent_estimate'] == 20
+
+
+def test_empty_recipe():
+    compiled = CompiledRecipe([])
+
+    assert len(compiled) == 0
+    assert compiled.structure == ()
+    assert compiled.gather(['water']).shape == (1, 0)
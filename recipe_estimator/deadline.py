@@ -0,0 +1,41 @@
+import time
+
+from .recipe_estimator_simple import estimate_percentages as estimate_simple_percentages
+from .spans import set_outcome
+
+# A deadline is the time.monotonic() time by which an estimate should be finished, or None if there isn't one.
+# time.monotonic() is the same in all processes on the machine, so a deadline can be passed to a worker process.
+# The estimators turn the time remaining into solver time limits. If a solver runs out of time the estimate is the best
+# feasible point the solver found or, if it didn't find one, the recipe_estimator_simple power series estimate
+
+DEADLINE_EXCEEDED = "deadline_exceeded"
+
+
+def get_deadline(deadline_ms, start=None):
+    if not deadline_ms:
+        return None
+    return (time.monotonic() if start is None else start) + deadline_ms / 1000
+
+
+# Seconds left before the deadline, or None if there is no deadline
+def remaining(deadline):
+    if deadline is None:
+        return None
+    return max(0.0, deadline - time.monotonic())
+
+
+def expired(deadline):
+    return deadline is not None and time.monotonic() >= deadline
+
+
+# Flags an estimate cut short by the deadline. result is "best_found" if the estimates are the best feasible point
+# found by the solver, or "simple" if they are the power series estimate
+def set_deadline_exceeded(recipe_estimator, result):
+    recipe_estimator["status_message"] = DEADLINE_EXCEEDED
+    recipe_estimator["deadline_result"] = result
+    set_outcome("fallback", f"deadline_{result}")
+
+
+def fall_back_to_simple(product):
+    estimate_simple_percentages(product["ingredients"])
+    set_deadline_exceeded(product["recipe_estimator"], "simple")
@@ -0,0 +1,32 @@
+import time
+
+from .deadline import DEADLINE_EXCEEDED, expired, fall_back_to_simple, get_deadline, remaining
+
+
+def test_get_deadline():
+    assert get_deadline(0) is None
+    assert get_deadline(None) is None
+    assert get_deadline(500, start=10) == 10.5
+
+    deadline = get_deadline(60000)
+    assert 59 < remaining(deadline) <= 60
+    assert not expired(deadline)
+    assert remaining(None) is None
+    assert not expired(None)
+
+
+def test_expired_deadline():
+    deadline = time.monotonic() - 1
+    assert expired(deadline)
+    assert remaining(deadline) == 0
+
+
+def test_fall_back_to_simple():
+    product = {"ingredients": [{"id": "en:sugar"}, {"id": "en:salt"}], "recipe_estimator": {"status_message": "not_solved"}}
+
+    fall_back_to_simple(product)
+
+    assert product["recipe_estimator"]["status_message"] == DEADLINE_EXCEEDED
+    assert product["recipe_estimator"]["deadline_result"] == "simple"
+    assert product["ingredients"][0]["percent_estimate"] > product["ingredients"][1]["percent_estimate"]
+    assert sum(ingredient["percent_estimate"] for ingredient in product["ingredients"]) == 100
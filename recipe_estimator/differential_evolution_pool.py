@@ -0,0 +1,71 @@
+import math
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from . import settings
+
+# Long-lived worker processes for evaluating the differential evolution population in parallel.
+# Passing workers=-1 to differential_evolution creates and tears down a multiprocessing pool on every call,
+# which costs more than the evaluation itself for all but the largest products.
+workers = settings.DIFFERENTIAL_EVOLUTION_WORKERS or os.cpu_count()
+pool = None
+pool_lock = threading.Lock()
+# Set in the estimation and batch worker processes, where there is already one estimate per CPU
+in_process = False
+
+
+def _reset_after_fork():
+    # A forked child inherits the parent's executor but not its manager thread, so anything submitted to it
+    # would never run. The lock may also have been held by another thread when the process forked
+    global pool, pool_lock
+    pool = None
+    pool_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+# Initializer for worker processes that each run whole estimates, so they evaluate the population themselves
+# rather than each starting a pool of their own
+def evaluate_in_process():
+    global in_process
+    in_process = True
+
+
+def use_pool():
+    return not in_process and workers > 1
+
+
+def get_pool():
+    global pool
+    with pool_lock:
+        if pool is None:
+            pool = ProcessPoolExecutor(max_workers=workers)
+        return pool
+
+
+def shutdown_pool():
+    global pool
+    with pool_lock:
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+            pool = None
+
+
+# Map-like callable to pass as differential_evolution(workers=...)
+# The population is split into one chunk per worker so the objective function and its args are only pickled once per worker
+def pool_map(function, iterable):
+    global pool
+    population = list(iterable)
+    executor = get_pool()
+    chunksize = max(1, math.ceil(len(population) / workers))
+    try:
+        return list(executor.map(function, population, chunksize=chunksize))
+    except BrokenProcessPool:
+        # A worker died. Start a new pool for the next call and evaluate this generation in process
+        with pool_lock:
+            if pool is executor:
+                pool = None
+        return [function(x) for x in population]
@@ -0,0 +1,32 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from . import differential_evolution_pool
+from .differential_evolution_pool import evaluate_in_process, pool_map, shutdown_pool
+
+
+def test_pool_map_keeps_population_order_and_reuses_pool():
+    assert pool_map(abs, range(-5, 5)) == [5, 4, 3, 2, 1, 0, 1, 2, 3, 4]
+    pool = differential_evolution_pool.pool
+    assert pool_map(abs, [-1]) == [1]
+    assert differential_evolution_pool.pool is pool
+
+    shutdown_pool()
+    assert differential_evolution_pool.pool is None
+
+
+def _pool_map_in_child():
+    return pool_map(abs, range(-3, 3))
+
+
+def test_pool_map_works_in_a_forked_child():
+    # The child inherits the parent's pool, which can't be used as its manager thread isn't copied
+    assert pool_map(abs, [-1]) == [1]
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("fork")) as executor:
+        assert executor.submit(_pool_map_in_child).result(timeout=60) == [3, 2, 1, 0, 1, 2]
+    shutdown_pool()
+
+
+def test_estimation_workers_evaluate_in_process():
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("fork"), initializer=evaluate_in_process) as executor:
+        assert executor.submit(differential_evolution_pool.use_pool).result(timeout=60) is False
@@ -0,0 +1,26 @@
+from .recipe_estimator_auto import estimate_recipe as estimate_recipe_auto
+from .recipe_estimator_cvxpy import SOLVERS as CVXPY_SOLVERS
+from .recipe_estimator_cvxpy import estimate_recipe as estimate_recipe_cvxpy
+from .recipe_estimator_glop import estimate_recipe_glop
+from .recipe_estimator_nnls import estimate_recipe as estimate_recipe_nnls
+from .recipe_estimator_po import estimate_recipe as estimate_recipe_po
+from .recipe_estimator_scipy import estimate_recipe as estimate_recipe_scipy
+from .recipe_estimator_simple import estimate_recipe as estimate_recipe_simple
+from .recipe_estimator_unconstrained_nnls import estimate_recipe as estimate_recipe_unconstrained_nnls
+
+# Estimation methods that can be requested by name from /api/v3/estimate_recipes and recipe_estimator.bulk
+ESTIMATION_METHODS = {
+    "cvxpy": estimate_recipe_cvxpy,
+    "glop": estimate_recipe_glop,
+    "scipy": estimate_recipe_scipy,
+    "nnls": estimate_recipe_nnls,
+    "unconstrained_nnls": estimate_recipe_unconstrained_nnls,
+    "simple": estimate_recipe_simple,
+    "po": estimate_recipe_po,
+    "auto": estimate_recipe_auto,
+}
+
+# Request options passed on to the estimation methods that take them, with their valid values
+ESTIMATOR_OPTIONS = {
+    "cvxpy": {"solver": ["auto"] + list(CVXPY_SOLVERS)},
+}
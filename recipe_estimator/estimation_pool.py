@@ -0,0 +1,70 @@
+import asyncio
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from . import settings
+from .differential_evolution_pool import evaluate_in_process
+
+
+class EstimationPoolFull(Exception):
+    pass
+
+
+# Runs the CPU bound estimation functions off the event loop so that a slow product doesn't hold up other requests.
+# Requests beyond the number of workers wait in the queue, and once that is full new requests are rejected
+# rather than queueing indefinitely. in_flight is only changed on the event loop so doesn't need a lock
+class EstimationPool:
+    def __init__(self, kind="thread", workers=0, queue_size=0):
+        if kind not in ("thread", "process"):
+            raise ValueError(f"Unknown estimation pool type {kind!r}, expected 'thread' or 'process'")
+        self.kind = kind
+        self.workers = workers or os.cpu_count()
+        self.queue_size = queue_size
+        self.in_flight = 0
+        self.rejected = 0
+        self.executor = None
+
+    def get_executor(self):
+        if self.executor is None:
+            if self.kind == "process":
+                self.executor = ProcessPoolExecutor(max_workers=self.workers, initializer=evaluate_in_process)
+            else:
+                self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="estimation")
+        return self.executor
+
+    async def run(self, function, *args):
+        if self.in_flight >= self.workers + self.queue_size:
+            self.rejected += 1
+            raise EstimationPoolFull()
+        self.in_flight += 1
+        executor = self.get_executor()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(executor, function, *args)
+        except BrokenProcessPool:
+            # A worker process died so create a new pool for the next request
+            if self.executor is executor:
+                self.executor = None
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+        finally:
+            self.in_flight -= 1
+
+    def metrics(self):
+        return {
+            "type": self.kind,
+            "workers": self.workers,
+            "queue_size": self.queue_size,
+            "in_flight": self.in_flight,
+            "queued": max(0, self.in_flight - self.workers),
+            "rejected": self.rejected,
+        }
+
+    def shutdown(self):
+        if self.executor is not None:
+            # Don't block the event loop waiting for running estimates
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+
+estimation_pool = EstimationPool(settings.ESTIMATION_POOL, settings.ESTIMATION_WORKERS, settings.ESTIMATION_QUEUE_SIZE)
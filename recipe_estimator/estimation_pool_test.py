@@ -0,0 +1,41 @@
+import asyncio
+import threading
+
+import pytest
+
+from .estimation_pool import EstimationPool, EstimationPoolFull
+
+
+def test_estimation_pool_rejects_when_queue_is_full():
+    pool = EstimationPool("thread", workers=1, queue_size=1)
+    release = threading.Event()
+
+    async def run():
+        first = asyncio.ensure_future(pool.run(release.wait))
+        second = asyncio.ensure_future(pool.run(release.wait))
+        await asyncio.sleep(0)
+        assert pool.metrics()["in_flight"] == 2
+        assert pool.metrics()["queued"] == 1
+
+        with pytest.raises(EstimationPoolFull):
+            await pool.run(release.wait)
+
+        release.set()
+        await asyncio.gather(first, second)
+
+    asyncio.run(run())
+    pool.shutdown()
+
+    assert pool.metrics() == {"type": "thread", "workers": 1, "queue_size": 1, "in_flight": 0, "queued": 0, "rejected": 1}
+
+
+def test_estimation_pool_runs_in_process():
+    pool = EstimationPool("process", workers=1)
+
+    assert asyncio.run(pool.run(sum, [1, 2, 3])) == 6
+    pool.shutdown()
+
+
+def test_estimation_pool_requires_known_type():
+    with pytest.raises(ValueError):
+        EstimationPool("fibre")
@@ -1,11 +1,16 @@
 import numpy as np
+from scipy.sparse import csr_matrix
 
 # Tried using numba to improve performance but went slower
 # from numba import jit
 # from numba.typed import Dict
 # from numba.core import types
 
+from .nutrient_table import NOM, MIN, MAX
+from .compiled_recipe import get_compiled_recipe
+from .nutrients import get_leaf_ingredients
 from .prepare_nutrients import prepare_nutrients
+from .spans import timed
 
 # NOTE: The following is not used at the moment. We currently just minimize the variance from the nominal nutrient value
 # and don't use min and max. This gives roughly similar results but is less computation, so faster.
@@ -52,8 +57,10 @@ def assign_penalty(
     return 0
 
 
-def get_objective_function_args(product):
-    leaf_ingredient_count = prepare_nutrients(product, True)
+@timed("objective_args")
+def get_objective_function_args(product, compiled=None):
+    compiled = get_compiled_recipe(product, compiled)
+    leaf_ingredient_count = prepare_nutrients(product, True, compiled)
     ingredients = product["ingredients"]
     recipe_estimator = product["recipe_estimator"]
     nutrients = recipe_estimator["nutrients"]
@@ -72,34 +79,17 @@ def get_objective_function_args(product):
     # and assign a penalty based on its divergence from the nutrient value of the product. We weight this depending on a factor for the nutrient.
 
     # Leaf ingredients are those that do not have sub-ingredients.
-    leaf_ingredients = []
-    ingredient_order_previous_indices = []
-    ingredient_order_this_indices = []
+    leaf_ingredients = compiled.leaf_ingredients
+    # Each order constraint compares the contiguous range of leaf ingredients of the previous ingredient with that of this one,
+    # so they are recorded as start / end leaf indices
+    ingredient_order_previous_starts = []
+    ingredient_order_this_starts = []
+    ingredient_order_this_ends = []
     bounds = []
 
-    def ingredient_order_constraint(
-        start_of_previous_parent, leaf_ingredient_index, sub_ingredient_count
-    ):
-        # return { 'type': 'ineq', 'fun': lambda x: sum(x[previous_start : this_start : 2]) - sum(x[this_start : this_start + this_count * 2 : 2])}
-        previous_ingredient_indices = []
-        next_ingredient_indices = []
-        for i in range(0, leaf_ingredient_count):
-            if i >= start_of_previous_parent and i < leaf_ingredient_index:
-                previous_ingredient_indices.append(i)
-            if (
-                i >= leaf_ingredient_index
-                and i < leaf_ingredient_index + sub_ingredient_count
-            ):
-                next_ingredient_indices.append(i)
-        return [previous_ingredient_indices, next_ingredient_indices]
-
     # Prepare nutrients information in arrays for fast objective function
     nutrient_names = []
     product_nutrients = []
-    # Following is an array of nutrients each containing an array of data for that nutrient for each ingredient (not including the lost water leaves)
-    nutrient_ingredients_nom = []
-    nutrient_ingredients_min = []
-    nutrient_ingredients_max = []
     nutrient_weightings = []
     for nutrient_key in nutrients:
         nutrient = nutrients[nutrient_key]
@@ -113,94 +103,76 @@ def get_objective_function_args(product):
         nutrient_names.append(nutrient_key)
         product_nutrients.append(nutrient["product_total"])
         nutrient_weightings.append(weighting)
-        nutrient_ingredients_nom.append([])
-        nutrient_ingredients_min.append([])
-        nutrient_ingredients_max.append([])
-
-    def add_ingredients(
-        ingredients, parent_estimate, parent_min_percent, parent_max_percent
-    ):
-        leaf_ingredients_added = 0
+
+    # The limits and initial estimate of each ingredient depend only on its parent's, so they are filled in pre-order
+    parents = compiled.parents.tolist()
+    positions = compiled.positions.tolist()
+    sibling_counts = compiled.sibling_counts.tolist()
+    leaf_starts = compiled.leaf_starts.tolist()
+    leaf_ends = compiled.leaf_ends.tolist()
+    water = compiled.water.tolist()
+    max_percents = []
+    min_percents = []
+    initial_estimates = []
+    for i, ingredient in enumerate(compiled.ingredients):
+        parent = parents[i]
+        position = positions[i]
+        num_ingredients = sibling_counts[i]
+        if parent < 0:
+            parent_estimate, parent_min_percent, parent_max_percent = 100, 100, 100
+        else:
+            parent_estimate, parent_min_percent, parent_max_percent = initial_estimates[parent], min_percents[parent], max_percents[parent]
+
+        # If there are, say, 3 ingredients then the 1st can be between 100% and 33%, second can be between 50% and 0%, third can be between 33% and 0%
+        # So in general the max percentage is 100% / ingredient_number and the min percentage is 100% / num_ingredients for the first ingredient and 0 for others
+        # Where there are sub-ingredients the max percent follows the same formula except replacing 100% with the max percent of the parent
+        # For the min percent this only applies to the very first leaf ingredient and needs to consider the number of ingredients in its sub-group
+        # along with the total number of ingredients in the root group.
+        # For example if a product has 4 ingredients but the first ingredient is a group of 3 ingredients then the overall first ingredient group can't be less than
+        # 25% but the first ingredient in that group could be 25 % / 3
+        # These rules don't fully hold when evaporation is taken into consideration but that would get very complicated so is ignored for now.
+        max_percent = parent_max_percent / (position + 1)
+        min_percent = parent_min_percent / num_ingredients if position == 0 else 0
+        max_percents.append(max_percent)
+        min_percents.append(min_percent)
+
         # Initial estimate of ingredients is a geometric progression where each is half the previous one
         # Sum of a  geometric progression is Sn = a(1 - r^n) / (1 - r)
         # In our case Sn = 100 and r = 0.5 so our first ingredient (a) will be
         # (100 * 0.5) / (1 - 0.5 ^ n)
-        num_ingredients = len(ingredients)
-        initial_estimate = (parent_estimate * 0.5) / (1 - 0.5 ** num_ingredients)
-        for i, ingredient in enumerate(ingredients):
-            leaf_ingredient_index = len(leaf_ingredients)
-
-            # If there are, say, 3 ingredients then the 1st can be between 100% and 33%, second can be between 50% and 0%, third can be between 33% and 0%
-            # So in general the max percentage is 100% / ingredient_number and the min percentage is 100% / num_ingredients for the first ingredient and 0 for others
-            # Where there are sub-ingredients the max percent follows the same formula except replacing 100% with the max percent of the parent
-            # For the min percent this only applies to the very first leaf ingredient and needs to consider the number of ingredients in its sub-group
-            # along with the total number of ingredients in the root group.
-            # For example if a product has 4 ingredients but the first ingredient is a group of 3 ingredients then the overall first ingredient group can't be less than
-            # 25% but the first ingredient in that group could be 25 % / 3
-            # These rules don't fully hold when evaporation is taken into consideration but that would get very complicated so is ignored for now.
-            max_percent = parent_max_percent / (i + 1)
-            min_percent = parent_min_percent / num_ingredients if i == 0 else 0
-
-            if "ingredients" in ingredient and len(ingredient["ingredients"]) > 0:
-                sub_ingredient_count = add_ingredients(
-                    ingredient["ingredients"],
-                    initial_estimate,
-                    min_percent,
-                    max_percent,
-                )
-            else:
-                # Initial estimate. 0.5 of previous ingredient
-                leaf_ingredients.append(ingredient)
-                ingredient["index"] = leaf_ingredient_index
-                ingredient["initial_estimate"] = initial_estimate
-                sub_ingredient_count = 1
-
-                # Set lost water constraint
-                water = ingredient.get("nutrients", {}).get("water", {})
-                maximum_water_content = water.get("percent_nom", 0) * 0.01
-                # water_loss_multipliers.append(
-                #     water_constraint(leaf_ingredient_index, maximum_water_content)
-                # )
-
-                # Assume no more than 50% of the water is lost
-                # TODO: See if we can justify this assumption with some product statistics
-                maximum_weight = max_percent / (1 - (0.5 * maximum_water_content))
-                bounds.append([min_percent, maximum_weight])
-
-                # # Water loss. Initial estimate is zero
-                # leaf_ingredients.append(0)
-                # maximum_percentages.append(None if maximum_water_content == 1 else maximum_water_content * maximum_weight)
-
-                for n, nutrient_key in enumerate(nutrient_names):
-                    ingredient_nutrient = ingredient["nutrients"].get(nutrient_key)
-                    if ingredient_nutrient:
-                        nutrient_ingredients_nom[n].append(ingredient_nutrient["percent_nom"] / 100)
-                        nutrient_ingredients_min[n].append(ingredient_nutrient["percent_min"] / 100)
-                        nutrient_ingredients_max[n].append(ingredient_nutrient["percent_max"] / 100)
-                    else:
-                        # Treat unknown nutrients as having 0% of each nutrient
-                        # TODO: Might be able to refine this, e.g. use a nominal small value appropriate to the nutrient type
-                        nutrient_ingredients_nom[n].append(0)
-                        nutrient_ingredients_min[n].append(0)
-                        nutrient_ingredients_max[n].append(0)
-
-            # Set order constraint
-            if i > 0:
-                # Sum of children must be less than previous ingredient (or sum of its children)
-                [previous_ingredient_indices, next_ingredient_indices] = ingredient_order_constraint(
-                        start_of_previous_parent,
-                        leaf_ingredient_index,
-                        sub_ingredient_count,
-                    )
-                ingredient_order_previous_indices.append(np.array(previous_ingredient_indices))
-                ingredient_order_this_indices.append(np.array(next_ingredient_indices))
-
-            initial_estimate /= 2
-            leaf_ingredients_added += sub_ingredient_count
-            start_of_previous_parent = leaf_ingredient_index
-        return leaf_ingredients_added
-
-    add_ingredients(ingredients, 100, 100, 100)
+        initial_estimate = (parent_estimate * 0.5) / (1 - 0.5 ** num_ingredients) * 0.5 ** position
+        initial_estimates.append(initial_estimate)
+
+        if not ingredient.get("ingredients"):
+            ingredient["index"] = leaf_starts[i]
+            ingredient["initial_estimate"] = initial_estimate
+
+            # Set lost water constraint
+            maximum_water_content = water[leaf_starts[i]]
+            # water_loss_multipliers.append(
+            #     water_constraint(leaf_ingredient_index, maximum_water_content)
+            # )
+
+            # Assume no more than 50% of the water is lost
+            # TODO: See if we can justify this assumption with some product statistics
+            maximum_weight = max_percent / (1 - (0.5 * maximum_water_content))
+            bounds.append([min_percent, maximum_weight])
+
+    # Sum of children must be less than previous ingredient (or sum of its children)
+    # The previous ingredient's leaves end where this ingredient's start. Added in post-order, as the penalties are summed in this order
+    previous_siblings = compiled.previous_siblings.tolist()
+    for i in compiled.post_order.tolist():
+        if positions[i] > 0:
+            ingredient_order_previous_starts.append(leaf_starts[previous_siblings[i]])
+            ingredient_order_this_starts.append(leaf_starts[i])
+            ingredient_order_this_ends.append(leaf_ends[i])
+
+    # Following is an array of nutrients each containing an array of data for that nutrient for each ingredient (not including the lost water leaves)
+    # Unknown nutrients are treated as having 0% of each nutrient
+    # TODO: Might be able to refine this, e.g. use a nominal small value appropriate to the nutrient type
+    nutrient_columns = [compiled.nutrient_columns[nutrient_key] for nutrient_key in nutrient_names]
+    nutrient_ingredients = np.ascontiguousarray(compiled.nutrient_values[:, nutrient_columns, :].transpose(2, 1, 0)) / 100
+
     if len(bounds) == 1:
         if bounds[0][1] == 100:
             # If there is only one ingredient with no known water content the bounds will be 100, 100 which the optimizer doesn't like, so fudge the max a bit
@@ -215,11 +187,38 @@ def get_objective_function_args(product):
     # for i in range(0, leaf_ingredient_count * 2):
     #     total_mass_multipliers[i] = -1 if i % 2 else 1
 
+    # The order constraints are held as sparse incidence matrices (constraints x leaf ingredients) so that the totals
+    # for all constraints can be calculated with one matrix product
+    ingredient_order_previous = range_incidence_matrix(ingredient_order_previous_starts, ingredient_order_this_starts, leaf_ingredient_count)
+    ingredient_order_this = range_incidence_matrix(ingredient_order_this_starts, ingredient_order_this_ends, leaf_ingredient_count)
+
     penalties = {} # Need this if using numba: Dict.empty(key_type=types.unicode_type, value_type=types.float64)
-    args = [penalties, np.array(product_nutrients), np.array(nutrient_ingredients_nom), np.array(nutrient_ingredients_min), np.array(nutrient_ingredients_max), np.array(nutrient_weightings), ingredient_order_previous_indices, ingredient_order_this_indices, leaf_ingredient_count]
+    args = [penalties, np.array(product_nutrients), nutrient_ingredients[NOM], nutrient_ingredients[MIN], nutrient_ingredients[MAX], np.array(nutrient_weightings), ingredient_order_previous, ingredient_order_this, leaf_ingredient_count]
     return [bounds, leaf_ingredients, args]
 
 
+# Breakdown of the objective function penalties for the estimated quantities, e.g. to compare the estimators. Only calculated if asked for.
+# Estimators that already have the objective function args and quantities pass them in, otherwise they are built from the product
+@timed("penalties")
+def get_penalties(product, quantities=None, args=None, compiled=None):
+    if args is None:
+        args = get_objective_function_args(product, compiled)[2]
+    if quantities is None:
+        quantities = np.array([float(ingredient["quantity_estimate"]) for ingredient in get_leaf_ingredients(product["ingredients"])])
+    objective(quantities, *args)
+    return args[0]
+
+
+# CSR matrix with a row for each [start, end) range of leaf ingredients, built without a loop over the rows
+def range_incidence_matrix(starts, ends, leaf_ingredient_count):
+    starts = np.asarray(starts, dtype=np.int32)
+    lengths = np.asarray(ends, dtype=np.int32) - starts
+    indptr = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int32)
+    # Column indices run from start to end for each row
+    indices = np.arange(indptr[-1], dtype=np.int32) - np.repeat(indptr[:-1] - starts, lengths)
+    return csr_matrix((np.ones(len(indices)), indices, indptr), shape=(len(starts), leaf_ingredient_count))
+
+
 NUTRIENT_WITHIN_BOUNDS_PENALTY = 10000
 NUTRIENT_OUTSIDE_BOUNDS_PENALTY = 130000
 INGREDIENT_BIGGER_THAN_PREVIOUS_PENALTY = 1000000
@@ -228,86 +227,22 @@ TOTAL_MASS_LESS_THAN_100_PENALTY = 10000000
 TOTAL_MASS_MORE_THAN_100_PENALTY = 100
 
 # TODO: Try using quadratic / cubic penalty functions so that gradients are smoother and may be easier for optimizer to spot path to minimum
-# TODO: Use matrix libraries for objective calculations to speed things up
-# @jit # pre-compile with numba
-def objective(ingredient_percentages, penalties, product_nutrients, nutrient_ingredients_nom, nutrient_ingredients_min, nutrient_ingredients_max, nutrient_weightings, ingredient_order_previous_indices, ingredient_order_this_indices, leaf_ingredient_count):
-    nutrient_variance = 0
-    # This seems to be a bit faster than for n, nutrient_total in enumerate(product_nutrients)
-    num_nutrients = len(product_nutrients)
-    for n in range(num_nutrients):
-        nutrient_total = product_nutrients[n]
-        # nom_nutrient_total_from_ingredients = sum(map(lambda x, y: x * y, ingredient_percentages, nutrient_ingredients_nom[n]))
-        # nom_nutrient_total_from_ingredients = sum([ingredient_percentages[i] * nutrient_ingredient_nom for i, nutrient_ingredient_nom, in enumerate(nutrient_ingredients_nom[n])])
-        # nom_nutrient_total_from_ingredients = sum(ingredient_percentage * nutrient_ingredient_nom for ingredient_percentage, nutrient_ingredient_nom in zip(ingredient_percentages, nutrient_ingredients_nom[n]))
-        # nutrient_ingredients_nom_n = nutrient_ingredients_nom[n]
-        nom_nutrient_total_from_ingredients = (ingredient_percentages * nutrient_ingredients_nom[n]).sum()
-        # min_nutrient_total_from_ingredients = (ingredient_percentages * nutrient_ingredients_min[n]).sum()
-        # max_nutrient_total_from_ingredients = (ingredient_percentages * nutrient_ingredients_max[n]).sum()
-
-        # Factors need to quite large as the algorithms only make tiny changes to the variables to determine gradients
-        # TODO: Need to experiment with factors here
-        # nutrient_penalty += nutrient_weightings[n] * assign_penalty(
-        #     nutrient_total,
-        #     nom_nutrient_total_from_ingredients,
-        #     NUTRIENT_WITHIN_BOUNDS_PENALTY,
-        #     min_nutrient_total_from_ingredients,
-        #     max_nutrient_total_from_ingredients,
-        #     NUTRIENT_OUTSIDE_BOUNDS_PENALTY,
-        # )
-        
-        nutrient_variance += nutrient_weightings[n] * (nutrient_total - nom_nutrient_total_from_ingredients) ** 2
+def objective(ingredient_percentages, penalties, product_nutrients, nutrient_ingredients_nom, nutrient_ingredients_min, nutrient_ingredients_max, nutrient_weightings, ingredient_order_previous, ingredient_order_this, leaf_ingredient_count):
+    # Tried using min and max with assign_penalty, but minimizing the variance from the nominal nutrient value gives roughly
+    # similar results and is much less computation
+    nutrient_differences = product_nutrients - nutrient_ingredients_nom @ ingredient_percentages
+    nutrient_variance = nutrient_weightings @ (nutrient_differences * nutrient_differences)
 
     nutrient_penalty = NUTRIENT_OUTSIDE_BOUNDS_PENALTY * nutrient_variance
 
-    ingredient_not_half_previous_penalty = 0
-    ingredient_more_than_previous_penalty = 0
     # Now add a penalty for the constraints
-    num_indices = len(ingredient_order_previous_indices)
-    for n in range(num_indices):
-        # take and "fancy" indexing seem to perform about the same
-        previous_total = ingredient_percentages.take(ingredient_order_previous_indices[n]).sum()
-        this_total = ingredient_percentages.take(ingredient_order_this_indices[n]).sum()
-        # In the absence of anything else we want this_total to be 50% of the previous_total so we apply a very small penalty
-        # for deviations from that. However, once this_total gets bigger than previous_total we want to apply a higher penalty
-
-        # penalty
-        #    ^                                        *
-        #    |        steep_gradient --------------> *
-        #    |                                      *
-        #    |                                     *
-        #    |                                    *
-        #    |                                   *
-        #    |                                  *
-        #    |*****                            *
-        #    |     ******                     *
-        #    |           ******        ******
-        #    |-----------------********------------------------------------------> this / parent
-        #                           ^        ^
-        #                          50%      100% (this >= parent)
-
-        if this_total < previous_total:
-            ingredient_not_half_previous_penalty += (
-                abs(this_total - (previous_total * 0.5))
-                * INGREDIENT_NOT_HALF_PREVIOUS_PENALTY
-            )
-        else:
-            # This is greater than previous. Add the above penalty for this = previous
-            ingredient_more_than_previous_penalty += (
-                0.5 * this_total
-            ) * INGREDIENT_NOT_HALF_PREVIOUS_PENALTY
-            # And then add a steep gradient for percent above previous
-            ingredient_more_than_previous_penalty += (
-                this_total - previous_total
-            ) * INGREDIENT_BIGGER_THAN_PREVIOUS_PENALTY
-
-    # for multipliers in water_loss_multipliers:
-    #     water_loss_test = sum([ingredient_quantity * multipliers[n] for n, ingredient_quantity in enumerate(ingredient_percentages)])
-    #     # If the test is negative (water loss is more than the expected maximum water content of the ingredient) then add a moderate penalty
-    #     if water_loss_test < 0:
-    #         penalty += (-water_loss_test) * 1000
+    ingredient_not_half_previous_penalty, ingredient_more_than_previous_penalty = order_penalties(
+        ingredient_order_previous @ ingredient_percentages,
+        ingredient_order_this @ ingredient_percentages,
+    )
 
     # Total mass penalty. Scale by number of ingredients so in the same order as other penalties
-    total_mass = sum(ingredient_percentages)
+    total_mass = ingredient_percentages.sum()
     mass_more_than_100_penalty = 0
     mass_less_than_100_penalty = 0
     if total_mass < 100:
@@ -327,14 +262,6 @@ def objective(ingredient_percentages, penalties, product_nutrients, nutrient_ing
 
     # Although we could also model bounds using penalties the optimizers seem to work better if they have bounds
 
-    # for n, maximum_percentage in enumerate(maximum_percentages):
-    #     if ingredient_percentages[n] < 0:
-    #         # Add a big penalty for negative ingredients
-    #         penalty += (-ingredient_percentages[n]) * 100000
-    #     if maximum_percentage and ingredient_percentages[n] > maximum_percentage:
-    #         # Add a moderate penalty if an ingredient is bigger than what we think it's maximum should be
-    #         penalty += (ingredient_percentages[n] - maximum_percentage) * 1000
-
     penalty = (
         nutrient_penalty
         + ingredient_not_half_previous_penalty
@@ -355,3 +282,67 @@ def objective(ingredient_percentages, penalties, product_nutrients, nutrient_ing
     penalties["total"] = penalty
     return penalty
 
+
+# Same as objective but scores a whole population (popsize x leaf ingredients) in one call and returns an array of penalties,
+# e.g. for differential_evolution(vectorized=True). penalties is not updated
+def objective_batch(population, penalties, product_nutrients, nutrient_ingredients_nom, nutrient_ingredients_min, nutrient_ingredients_max, nutrient_weightings, ingredient_order_previous, ingredient_order_this, leaf_ingredient_count):
+    # Leaf ingredients x population
+    quantities = np.atleast_2d(population).T
+
+    nutrient_differences = product_nutrients[:, np.newaxis] - nutrient_ingredients_nom @ quantities
+    nutrient_variance = nutrient_weightings @ (nutrient_differences * nutrient_differences)
+
+    nutrient_penalty = NUTRIENT_OUTSIDE_BOUNDS_PENALTY * nutrient_variance
+
+    ingredient_not_half_previous_penalty, ingredient_more_than_previous_penalty = order_penalties(
+        ingredient_order_previous @ quantities,
+        ingredient_order_this @ quantities,
+    )
+
+    total_mass = quantities.sum(axis=0)
+    mass_less_than_100_penalty = np.maximum(100 - total_mass, 0) * TOTAL_MASS_LESS_THAN_100_PENALTY * leaf_ingredient_count
+    mass_more_than_100_penalty = np.maximum(total_mass - 100, 0) * TOTAL_MASS_MORE_THAN_100_PENALTY * leaf_ingredient_count
+
+    return (
+        nutrient_penalty
+        + ingredient_not_half_previous_penalty
+        + ingredient_more_than_previous_penalty
+        + mass_more_than_100_penalty
+        + mass_less_than_100_penalty
+    )
+
+
+# Penalties for the ingredient order constraints given the totals of the previous and this ingredient of each constraint
+# (constraints, or constraints x population)
+def order_penalties(previous_totals, this_totals):
+    # In the absence of anything else we want this_total to be 50% of the previous_total so we apply a very small penalty
+    # for deviations from that. However, once this_total gets bigger than previous_total we want to apply a higher penalty
+
+    # penalty
+    #    ^                                        *
+    #    |        steep_gradient --------------> *
+    #    |                                      *
+    #    |                                     *
+    #    |                                    *
+    #    |                                   *
+    #    |                                  *
+    #    |*****                            *
+    #    |     ******                     *
+    #    |           ******        ******
+    #    |-----------------********------------------------------------------> this / parent
+    #                           ^        ^
+    #                          50%      100% (this >= parent)
+    smaller = this_totals < previous_totals
+    ingredient_not_half_previous_penalty = (
+        (np.abs(this_totals - (previous_totals * 0.5)) * smaller).sum(axis=0)
+        * INGREDIENT_NOT_HALF_PREVIOUS_PENALTY
+    )
+    # If this is greater than previous add the above penalty for this = previous
+    # And then add a steep gradient for percent above previous
+    ingredient_more_than_previous_penalty = (
+        (
+            (0.5 * this_totals) * INGREDIENT_NOT_HALF_PREVIOUS_PENALTY
+            + (this_totals - previous_totals) * INGREDIENT_BIGGER_THAN_PREVIOUS_PENALTY
+        ) * ~smaller
+    ).sum(axis=0)
+    return ingredient_not_half_previous_penalty, ingredient_more_than_previous_penalty
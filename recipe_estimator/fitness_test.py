@@ -1,4 +1,20 @@
-from .fitness import assign_penalty
+import numpy as np
+import pytest
+
+from .fitness import (
+    INGREDIENT_BIGGER_THAN_PREVIOUS_PENALTY,
+    INGREDIENT_NOT_HALF_PREVIOUS_PENALTY,
+    NUTRIENT_OUTSIDE_BOUNDS_PENALTY,
+    TOTAL_MASS_LESS_THAN_100_PENALTY,
+    TOTAL_MASS_MORE_THAN_100_PENALTY,
+    assign_penalty,
+    get_objective_function_args,
+    get_penalties,
+    objective,
+    objective_batch,
+    range_incidence_matrix,
+)
+from .nutrients import prepare_product
 
 
 def test_assign_penalty_value_equals_nominal():
@@ -18,3 +34,82 @@ def test_assign_penalty_value_steep_gradient_used_outside_tolerance():
     assert assign_penalty(100, 50, 2, 20, 80, 500) == 10002
 
 
+
+
+def reference_objective(x, product_nutrients, nutrient_ingredients_nom, nutrient_weightings, previous_indices, this_indices):
+    # Straightforward loop version of the objective to check the matrix version against
+    nutrient_variance = 0
+    for n in range(len(product_nutrients)):
+        nutrient_variance += nutrient_weightings[n] * (product_nutrients[n] - (x * nutrient_ingredients_nom[n]).sum()) ** 2
+    penalty = NUTRIENT_OUTSIDE_BOUNDS_PENALTY * nutrient_variance
+    for previous, this in zip(previous_indices, this_indices):
+        previous_total = x[previous].sum()
+        this_total = x[this].sum()
+        if this_total < previous_total:
+            penalty += abs(this_total - previous_total * 0.5) * INGREDIENT_NOT_HALF_PREVIOUS_PENALTY
+        else:
+            penalty += 0.5 * this_total * INGREDIENT_NOT_HALF_PREVIOUS_PENALTY + (this_total - previous_total) * INGREDIENT_BIGGER_THAN_PREVIOUS_PENALTY
+    total_mass = x.sum()
+    if total_mass < 100:
+        penalty += (100 - total_mass) * TOTAL_MASS_LESS_THAN_100_PENALTY * len(x)
+    else:
+        penalty += (total_mass - 100) * TOTAL_MASS_MORE_THAN_100_PENALTY * len(x)
+    return penalty
+
+
+def get_test_args():
+    product = {
+        'ingredients': [
+            {'id': 'en:a', 'nutrients': {'fiber': {'percent_nom': 15}, 'sugars': {'percent_nom': 2}}},
+            {'id': 'en:b', 'ingredients': [
+                {'id': 'en:c', 'nutrients': {'fiber': {'percent_nom': 3}, 'sugars': {'percent_nom': 20}}},
+                {'id': 'en:d', 'nutrients': {'sugars': {'percent_nom': 50}}},
+            ]},
+            {'id': 'en:e', 'nutrients': {}},
+        ],
+        'nutriments': {'fiber_100g': 10, 'sugars_100g': 12},
+    }
+    return get_objective_function_args(product)
+
+
+def test_objective_matches_reference():
+    _, leaf_ingredients, args = get_test_args()
+    # Previous: c, this: d. Previous: a, this: c + d. Previous: c + d, this: e
+    previous_indices = [[1], [0], [1, 2]]
+    this_indices = [[2], [1, 2], [3]]
+    assert args[6].toarray().tolist() == [[0, 1, 0, 0], [1, 0, 0, 0], [0, 1, 1, 0]]
+    assert args[7].toarray().tolist() == [[0, 0, 1, 0], [0, 1, 1, 0], [0, 0, 0, 1]]
+
+    rng = np.random.default_rng(0)
+    for x in rng.uniform(0, 80, (20, len(leaf_ingredients))):
+        expected = reference_objective(x, args[1], args[2], args[5], previous_indices, this_indices)
+        assert objective(x, *args) == pytest.approx(expected, rel=1e-12)
+        assert args[0]['total'] == pytest.approx(expected, rel=1e-12)
+
+
+def test_objective_batch_matches_objective():
+    _, leaf_ingredients, args = get_test_args()
+    population = np.random.default_rng(0).uniform(0, 80, (50, len(leaf_ingredients)))
+    # Include the boundary case for the total mass
+    population[0] = [40, 30, 20, 10]
+
+    expected = [objective(x, *args) for x in population]
+    assert objective_batch(population, *args) == pytest.approx(expected, rel=1e-12)
+
+
+def test_range_incidence_matrix():
+    assert range_incidence_matrix([0, 2, 1], [2, 2, 4], 4).toarray().tolist() == [[1, 1, 0, 0], [0, 0, 0, 0], [0, 1, 1, 1]]
+    assert range_incidence_matrix([], [], 1).shape == (0, 1)
+
+
+def test_get_penalties_reuses_args():
+    product = {
+        "ingredients": [{"id": "en:sugar", "quantity_estimate": 60}, {"id": "en:salt", "quantity_estimate": 40}],
+        "nutriments": {"sugars_100g": 60, "salt_100g": 40},
+    }
+    prepare_product(product)
+    bounds, leaf_ingredients, args = get_objective_function_args(product)
+
+    penalties = dict(get_penalties(product))
+    assert get_penalties(product, np.array([60.0, 40.0]), args) == penalties
+    assert penalties["total"] == objective(np.array([60.0, 40.0]), *args)
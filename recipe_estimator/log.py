@@ -0,0 +1,51 @@
+import logging
+
+from . import settings
+
+# Logging for the package. Modules log through logging.getLogger(__name__) using %-style arguments so that messages are
+# only formatted if they are going to be output. TRACE is for per-ingredient / per-constraint detail in the solvers,
+# which is off by default. Hot paths should check logger.isEnabledFor(TRACE) first if the arguments are expensive to compute.
+TRACE = 5
+logging.addLevelName(TRACE, "TRACE")
+
+PACKAGE = "recipe_estimator"
+
+
+def parse_level(level):
+    if isinstance(level, int):
+        return level
+    level = level.strip().upper()
+    if level.isdigit():
+        return int(level)
+    value = logging.getLevelName(level)
+    if not isinstance(value, int):
+        raise ValueError(f"Unknown log level {level!r}")
+    return value
+
+
+# Module levels are given as comma separated module=level pairs, e.g. "recipe_estimator_glop=TRACE,nutrients=DEBUG"
+# Module names are relative to the package unless they start with it
+def parse_module_levels(module_levels):
+    levels = {}
+    for module_level in module_levels.split(","):
+        if not module_level.strip():
+            continue
+        module, _, level = module_level.partition("=")
+        module = module.strip()
+        if module != PACKAGE and not module.startswith(PACKAGE + "."):
+            module = PACKAGE + "." + module
+        levels[module] = parse_level(level)
+    return levels
+
+
+def configure_logging(level=None, module_levels=None):
+    package_logger = logging.getLogger(PACKAGE)
+    package_logger.setLevel(parse_level(level if level is not None else settings.LOG_LEVEL))
+    for module, module_level in parse_module_levels(module_levels if module_levels is not None else settings.LOG_LEVELS).items():
+        logging.getLogger(module).setLevel(module_level)
+
+    if not package_logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+        package_logger.addHandler(handler)
+        package_logger.propagate = False
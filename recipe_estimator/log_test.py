@@ -0,0 +1,34 @@
+import logging
+
+import pytest
+
+from recipe_estimator.log import TRACE, configure_logging, parse_level, parse_module_levels
+
+
+def test_parse_level():
+    assert parse_level("debug") == logging.DEBUG
+    assert parse_level("TRACE") == TRACE
+    assert parse_level("15") == 15
+    assert parse_level(logging.INFO) == logging.INFO
+    with pytest.raises(ValueError):
+        parse_level("loud")
+
+
+def test_parse_module_levels():
+    assert parse_module_levels("recipe_estimator_glop=TRACE, nutrients=debug,,recipe_estimator.main=WARNING") == {
+        "recipe_estimator.recipe_estimator_glop": TRACE,
+        "recipe_estimator.nutrients": logging.DEBUG,
+        "recipe_estimator.main": logging.WARNING,
+    }
+    assert parse_module_levels("") == {}
+
+
+def test_configure_logging_sets_module_levels():
+    glop_logger = logging.getLogger("recipe_estimator.recipe_estimator_glop")
+    try:
+        configure_logging("WARNING", "recipe_estimator_glop=TRACE")
+        assert not logging.getLogger("recipe_estimator.nutrients").isEnabledFor(logging.INFO)
+        assert glop_logger.isEnabledFor(TRACE)
+    finally:
+        glop_logger.setLevel(logging.NOTSET)
+        configure_logging()
@@ -1,23 +1,88 @@
-import itertools
+import asyncio
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager
 from json import JSONDecodeError
 from fastapi import FastAPI, Request
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.responses import RedirectResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
-import numpy as np
-from .nutrients import ciqual_ingredients, prepare_product, remove_temporary_ingredients_fields
-from .product import get_product
+from .nutrients import get_ciqual_code_index, get_nutrient_table, prepare_product, remove_temporary_ingredients_fields
+from .product import get_product_async, get_test_set_index, product_cache, product_client
+from .ciqual_search import get_ciqual_search_index
 from .recipe_estimator_glop import estimate_recipe_glop
 from .recipe_estimator_scipy import estimate_recipe as estimate_recipe_scipy
 from .recipe_estimator_nnls import estimate_recipe as estimate_recipe_nnls
 from .recipe_estimator_unconstrained_nnls import estimate_recipe as estimate_recipe_unconstrained_nnls
 from .recipe_estimator_simple import estimate_recipe as estimate_recipe_simple
 from .recipe_estimator_po import estimate_recipe as estimate_recipe_po
+from .recipe_estimator_auto import estimate_recipe as estimate_recipe_auto
 from .recipe_estimator_cvxpy import estimate_recipe as estimate_recipe_cvxpy
-from .fitness import get_objective_function_args, objective
-
-app = FastAPI()
+from .compiled_recipe import get_compiled_recipe
+from .fitness import get_penalties
+from .result_cache import apply_result, encode_result, get_result_key, result_cache
+from .deadline import get_deadline
+from . import settings
+from .differential_evolution_pool import evaluate_in_process, shutdown_pool as shutdown_differential_evolution_pool
+from .estimation_pool import EstimationPoolFull, estimation_pool
+from .estimation_methods import ESTIMATION_METHODS, ESTIMATOR_OPTIONS
+from .log import configure_logging
+from .spans import Spans, span, stage_histograms
+from . import metrics as estimate_metrics
+from .metrics import CounterFunction, Gauge, registry
+
+configure_logging()
+
+# Name of each estimation method for the metrics
+ESTIMATION_METHOD_NAMES = {function: name for name, function in ESTIMATION_METHODS.items()}
+
+registry.register(Gauge("recipe_estimator_in_flight_estimates", "Estimates running or waiting for a worker", lambda: estimation_pool.in_flight))
+registry.register(Gauge("recipe_estimator_queued_estimates", "Estimates waiting for a worker", lambda: max(0, estimation_pool.in_flight - estimation_pool.workers)))
+registry.register(CounterFunction("recipe_estimator_rejected_estimates_total", "Estimates rejected because the queue was full", lambda: estimation_pool.rejected))
+registry.register(CounterFunction("recipe_estimator_product_cache_hits_total", "Products found in the product cache", lambda: product_cache.hits))
+registry.register(CounterFunction("recipe_estimator_product_cache_misses_total", "Products not found in the product cache", lambda: product_cache.misses))
+registry.register(CounterFunction("recipe_estimator_result_cache_hits_total", "Estimates served from the result cache", lambda: sum(result_cache.hits.values())))
+registry.register(CounterFunction("recipe_estimator_result_cache_disk_hits_total", "Estimates served from the result cache database after a memory miss", lambda: result_cache.hits["disk"]))
+registry.register(CounterFunction("recipe_estimator_result_cache_misses_total", "Estimates not found in the result cache", lambda: result_cache.misses))
+registry.register(CounterFunction("recipe_estimator_result_cache_evictions_total", "Results dropped from memory to keep within the result cache size", lambda: result_cache.evictions))
+registry.register(Gauge("recipe_estimator_result_cache_bytes", "Size of the results in the result cache memory", lambda: result_cache.size))
+
+
+batch_executor = None
+
+
+def get_batch_executor():
+    # Created on first use. Worker processes are forked after the assets have been loaded so they share them
+    global batch_executor
+    if batch_executor is None:
+        batch_executor = ProcessPoolExecutor(max_workers=settings.BATCH_WORKERS or None, initializer=evaluate_in_process)
+    return batch_executor
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Load the assets, resolve the ciqual codes and build the nutrient table before accepting requests rather than on the first request
+    get_ciqual_code_index()
+    get_nutrient_table()
+    get_ciqual_search_index()
+    get_test_set_index()
+    yield
+    global batch_executor
+    if batch_executor is not None:
+        # Don't block the event loop waiting for running items
+        batch_executor.shutdown(wait=False, cancel_futures=True)
+        batch_executor = None
+    estimation_pool.shutdown()
+    shutdown_differential_evolution_pool()
+    result_cache.close()
+    await product_client.aclose()
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -35,12 +100,11 @@ async def redirect():
 
 @app.get("/ciqual/{name}")
 async def ciqual(name):
-    search_terms = name.casefold().split()
-    return list(itertools.islice(filter(lambda i: (all(search_term in (i['alim_nom_eng'] + i['ciqual_food_code']).casefold() for search_term in search_terms)), ciqual_ingredients.values()),20))
+    return get_ciqual_search_index().search(name)
 
 @app.get("/product/{id}")
 async def product(id):
-    product = get_product(id)
+    product = await get_product_async(id)
     return product
 
 
@@ -68,17 +132,42 @@ def add_warning(warnings, field_id, message_id, message_name, impact_id="warning
     warnings.append(_issue(field_id, impact_id, impact_name, message_id, message_name))
 
 
+def _failure_content(errors, warnings):
+    return {
+        "errors": errors,
+        "status": "failure",
+        "warnings": warnings,
+    }
+
+
 def _failure_response(errors, warnings, status_code=400):
     return JSONResponse(
         status_code=status_code,
-        content={
-            "errors": errors,
-            "status": "failure",
-            "warnings": warnings,
-        },
+        content=_failure_content(errors, warnings),
     )
 
 
+# Check a {"product": ..., "options": ...} payload. Returns the product and options, or None if errors were added
+def _validate_payload(payload, errors):
+    if not isinstance(payload, dict):
+        add_error(errors, "body", "invalid_json", "Invalid JSON")
+        return None, {}
+
+    if "product" not in payload:
+        add_error(errors, "product", "missing_field", "Missing field")
+        return None, {}
+
+    if not isinstance(payload["product"], dict):
+        add_error(errors, "product", "invalid_type", "Invalid type")
+        return None, {}
+
+    options = payload.get("options", {})
+    if not isinstance(options, dict):
+        options = {}
+
+    return payload["product"], options
+
+
 async def _read_product(request: Request):
     errors = []
     warnings = []
@@ -88,23 +177,38 @@ async def _read_product(request: Request):
         add_error(errors, "body", "invalid_json", "Invalid JSON")
         return None, {}, _failure_response(errors, warnings)
 
-    if not isinstance(payload, dict):
-        add_error(errors, "body", "invalid_json", "Invalid JSON")
+    product, options = _validate_payload(payload, errors)
+    if errors:
         return None, {}, _failure_response(errors, warnings)
 
-    if "product" not in payload:
-        add_error(errors, "product", "missing_field", "Missing field")
-        return None, {}, _failure_response(errors, warnings)
+    return product, options, None
 
-    if not isinstance(payload["product"], dict):
-        add_error(errors, "product", "invalid_type", "Invalid type")
-        return None, {}, _failure_response(errors, warnings)
 
-    options = payload.get("options", {})
-    if not isinstance(options, dict):
-        options = {}
+# The penalties breakdown is only calculated if asked for with the penalties option, or with debug for the frontend
+def _wants_penalties(options):
+    return bool(options.get("penalties", options.get("debug")))
 
-    return payload["product"], options, None
+
+# The options the estimation method takes, adding errors for invalid values
+def _estimator_options(method, options, errors):
+    estimator_options = {}
+    for name, values in ESTIMATOR_OPTIONS.get(method, {}).items():
+        if name not in options:
+            continue
+        if options[name] not in values:
+            add_error(errors, name, "invalid_value", "Invalid value")
+        else:
+            estimator_options[name] = options[name]
+    return estimator_options
+
+
+# Time budget in milliseconds from the deadline_ms option, or the DEADLINE_MS setting. 0 is no deadline
+def _deadline_ms(options, errors):
+    deadline_ms = options.get("deadline_ms", settings.DEADLINE_MS)
+    if isinstance(deadline_ms, bool) or not isinstance(deadline_ms, (int, float)) or deadline_ms < 0:
+        add_error(errors, "deadline_ms", "invalid_value", "Invalid value")
+        return 0
+    return deadline_ms
 
 
 def _product_response(product, options=None):
@@ -113,15 +217,72 @@ def _product_response(product, options=None):
         remove_temporary_ingredients_fields(product.get("ingredients", []))
     return {"product": product}
 
+# Runs in the estimation pool. The product is returned as it is a copy when using a process pool,
+# along with the stage timings and outcomes and the number of leaf ingredients for the metrics
+def _estimate_product(product, estimation_function, penalties, estimator_options=None, deadline=None):
+    with Spans() as spans, span("worker"):
+        prepare_product(product)
+        # The estimator and penalties share the one compiled recipe
+        compiled = get_compiled_recipe(product)
+        estimation_function(product, penalties=penalties, compiled=compiled, deadline=deadline, **(estimator_options or {}))
+    return product, spans.timings, spans.outcomes, len(compiled.leaf_ingredients)
+
+
 # generic function to use in estimate_recipe_* endpoints that only differ by the estimation method used
 # read the product and options from the request, prepare the product, call the estimation function and return the response
 async def estimate_recipe_generic(request: Request, estimation_function):
     product, options, error_response = await _read_product(request)
     if error_response:
         return error_response
-    prepare_product(product)
-    estimation_function(product)
-    if not bool(options.get("debug")):
+    # The deadline includes any time waiting for a worker
+    deadline_start = time.monotonic()
+    method = ESTIMATION_METHOD_NAMES.get(estimation_function, estimation_function.__name__)
+    errors = []
+    estimator_options = _estimator_options(method, options, errors)
+    deadline = get_deadline(_deadline_ms(options, errors), deadline_start)
+    if errors:
+        return _failure_response(errors, [])
+    penalties = _wants_penalties(options)
+    start = time.perf_counter()
+    result_key = None
+    if result_cache.enabled:
+        # On the event loop as a hit only needs the ingredients setting up, which is much quicker than handing over to a worker
+        result_key = get_result_key(product, method, penalties, estimator_options)
+        result = result_cache.get(result_key)
+        if result is not None:
+            prepare_product(product)
+            apply_result(product, result)
+            if bool(options.get("debug")):
+                product["recipe_estimator"]["stages"] = {"result_cache": round(1000 * (time.perf_counter() - start), 3)}
+            return _product_response(product, options)
+    try:
+        product, timings, outcomes, leaf_ingredients = await estimation_pool.run(
+            _estimate_product, product, estimation_function, penalties, estimator_options, deadline
+        )
+    except EstimationPoolFull:
+        errors = []
+        add_error(errors, "server", "server_busy", "Server busy")
+        return _failure_response(errors, [], status_code=503)
+    except Exception:
+        estimate_metrics.estimates.inc(method, "error")
+        raise
+    # Estimates cut short by the deadline aren't kept, so the product is estimated properly next time
+    if result_key is not None and "deadline_result" not in product["recipe_estimator"]:
+        result_cache.put(result_key, encode_result(product))
+    timings["total"] = time.perf_counter() - start
+    estimate_metrics.estimate_seconds.observe(timings["total"], method)
+    estimate_metrics.estimates.inc(method, outcomes.get("solver_status", "ok"))
+    if "fallback" in outcomes:
+        estimate_metrics.fallbacks.inc(method, outcomes["fallback"])
+    if "tier" in outcomes:
+        estimate_metrics.tiers.inc(outcomes["tier"])
+    estimate_metrics.leaf_ingredients.observe(leaf_ingredients)
+    # Time waiting for a worker, plus getting the product to and from a worker process
+    timings["queue"] = max(0, timings["total"] - timings["worker"])
+    stage_histograms.observe(request.url.path, timings)
+    if bool(options.get("debug")):
+        product["recipe_estimator"]["stages"] = {name: round(1000 * seconds, 3) for name, seconds in timings.items()}
+    else:
         remove_temporary_ingredients_fields(product.get("ingredients", []))
     return _product_response(product, options)
 
@@ -155,16 +316,142 @@ async def recipe(request: Request):
 async def recipe(request: Request):
     return await estimate_recipe_generic(request, estimate_recipe_po)
 
+@app.post("/api/v3/estimate_recipe_auto")
+async def recipe(request: Request):
+    return await estimate_recipe_generic(request, estimate_recipe_auto)
+
 @app.post("/api/v3/estimate_recipe_cvxpy")
 async def recipe(request: Request):
     return await estimate_recipe_generic(request, estimate_recipe_cvxpy)
 
+
+# Runs in a batch worker process, so returns the response content rather than a response
+def _estimate_batch_item(payload, method):
+    errors = []
+    warnings = []
+    product, options = _validate_payload(payload, errors)
+    estimator_options = _estimator_options(method, options, errors)
+    # From when the worker starts on the item
+    deadline = get_deadline(_deadline_ms(options, errors))
+    if errors:
+        return _failure_content(errors, warnings)
+    try:
+        prepare_product(product)
+        ESTIMATION_METHODS[method](product, penalties=_wants_penalties(options), deadline=deadline, **estimator_options)
+    except Exception:
+        add_error(errors, "product", "estimation_failed", "Estimation failed")
+        return _failure_content(errors, warnings)
+    return _product_response(product, options)
+
+
+def _parse_ndjson_lines(body):
+    # Yields each payload, or None if the line isn't valid JSON
+    for line in body.splitlines():
+        if not line.strip():
+            continue
+        try:
+            yield json.loads(line)
+        except JSONDecodeError:
+            yield None
+
+
+def _reset_batch_executor(executor):
+    # A worker process died (e.g. killed for running out of memory) so the pool can't be used any more.
+    # Drop it so that the next item gets a new pool
+    global batch_executor
+    if batch_executor is executor:
+        batch_executor = None
+    executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _submit_batch_item(loop, payload, method):
+    executor = get_batch_executor()
+    try:
+        return loop.run_in_executor(executor, _estimate_batch_item, payload, method), executor
+    except BrokenProcessPool:
+        _reset_batch_executor(executor)
+        executor = get_batch_executor()
+        return loop.run_in_executor(executor, _estimate_batch_item, payload, method), executor
+
+
+async def _batch_result(future, executor):
+    try:
+        return await future
+    except BrokenProcessPool:
+        _reset_batch_executor(executor)
+        errors = []
+        add_error(errors, "product", "estimation_failed", "Estimation failed")
+        return _failure_content(errors, [])
+
+
+async def _estimate_batch(payloads, method):
+    # Keep a bounded number of items in flight and write the results in input order
+    loop = asyncio.get_running_loop()
+    pending = deque()
+    max_pending = 2 * (settings.BATCH_WORKERS or os.cpu_count())
+
+    for payload in payloads:
+        if payload is None:
+            errors = []
+            add_error(errors, "body", "invalid_json", "Invalid JSON")
+            future = loop.create_future()
+            future.set_result(_failure_content(errors, []))
+            pending.append((future, None))
+        else:
+            pending.append(_submit_batch_item(loop, payload, method))
+        while len(pending) >= max_pending:
+            yield json.dumps(await _batch_result(*pending.popleft())) + "\n"
+
+    while pending:
+        yield json.dumps(await _batch_result(*pending.popleft())) + "\n"
+
+
+# Estimate many products in one request. The body is either a JSON array or NDJSON (Content-Type: application/x-ndjson)
+# where each item is the same {"product": ..., "options": ...} payload as /api/v3/estimate_recipe.
+# Results are streamed back as NDJSON in input order. Items that fail have the same errors / warnings shape as a failure response
+@app.post("/api/v3/estimate_recipes")
+async def recipes(request: Request, method: str = "cvxpy"):
+    errors = []
+    warnings = []
+    if method not in ESTIMATION_METHODS:
+        add_error(errors, "method", "invalid_value", "Invalid value")
+        return _failure_response(errors, warnings)
+
+    content_type = request.headers.get("content-type", "")
+    if "ndjson" in content_type or "jsonl" in content_type:
+        # The body has to be read before returning the streaming response as the request can't be read while it is being sent
+        payloads = _parse_ndjson_lines(await request.body())
+    else:
+        try:
+            payloads = await request.json()
+        except JSONDecodeError:
+            payloads = None
+        if not isinstance(payloads, list):
+            add_error(errors, "body", "invalid_json", "Invalid JSON")
+            return _failure_response(errors, warnings)
+
+    return StreamingResponse(_estimate_batch(payloads, method), media_type="application/x-ndjson")
+
+
+# Prometheus metrics
+@app.get("/metrics", response_class=PlainTextResponse)
+async def prometheus_metrics():
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/api/v3/metrics")
+async def metrics():
+    return {
+        "estimation_pool": estimation_pool.metrics(),
+        "product_cache": product_cache.metrics(),
+        "result_cache": result_cache.metrics(),
+        "stages": stage_histograms.snapshot(),
+    }
+
+
 @app.post("/api/v3/get_penalties")
 async def recipe(request: Request):
     product = await request.json()
     prepare_product(product)
-    [_, leaf_ingredients, args] = get_objective_function_args(product)
-    quantities = np.array([float(ingredient['quantity_estimate']) for ingredient in leaf_ingredients])
-    objective(quantities, *args)
-    product['recipe_estimator']['penalties'] = args[0]
+    product['recipe_estimator']['penalties'] = get_penalties(product)
     return product
@@ -1,10 +1,24 @@
+import json
+import os
+
 import pytest
 from fastapi.testclient import TestClient
 
+from . import main
+from .estimation_pool import EstimationPool
 from .main import app
 from .nutrients import prepare_product
 from .product import get_product
 from .recipe_estimator_scipy import estimate_recipe as estimate_recipe_scipy
+from .result_cache import ResultCache
+
+
+@pytest.fixture(autouse=True)
+def result_cache(monkeypatch):
+    # So each test estimates the products it sends
+    cache = ResultCache()
+    monkeypatch.setattr(main, "result_cache", cache)
+    return cache
 
 
 ESTIMATE_RECIPE_ENDPOINTS = [
@@ -15,6 +29,7 @@ ESTIMATE_RECIPE_ENDPOINTS = [
     "/api/v3/estimate_recipe_simple",
     "/api/v3/estimate_recipe_po",
     "/api/v3/estimate_recipe_cvxpy",
+    "/api/v3/estimate_recipe_auto",
 ]
 
 
@@ -149,6 +164,192 @@ def test_estimate_recipe_keeps_temporary_ingredient_fields_with_debug(endpoint):
     assert "ciqual_food_code_used" in child
     assert "nutrients" in child
 
+
+@pytest.mark.parametrize("endpoint", ESTIMATE_RECIPE_ENDPOINTS)
+def test_estimate_recipe_only_returns_penalties_when_asked(endpoint):
+    client = TestClient(app)
+    product = {"ingredients": [{"id": "en:sugar"}, {"id": "en:salt"}], "nutriments": {"sugars_100g": 90}}
+
+    response = client.post(endpoint, json={"product": product})
+    assert "penalties" not in response.json()["product"]["recipe_estimator"]
+
+    response = client.post(endpoint, json={"product": product, "options": {"penalties": True}})
+    penalties = response.json()["product"]["recipe_estimator"]["penalties"]
+    assert penalties["total"] == pytest.approx(sum(value for key, value in penalties.items() if key != "total"))
+
+def test_estimate_recipe_cvxpy_solver_option():
+    client = TestClient(app)
+    product = {"ingredients": [{"id": "en:sugar"}, {"id": "en:salt"}], "nutriments": {"sugars_100g": 90}}
+
+    response = client.post("/api/v3/estimate_recipe_cvxpy", json={"product": product})
+    assert response.json()["product"]["recipe_estimator"]["solver"] == "clarabel"
+
+    response = client.post("/api/v3/estimate_recipe_cvxpy", json={"product": product, "options": {"solver": "scs"}})
+    assert response.json()["product"]["recipe_estimator"]["solver"] == "scs"
+
+    response = client.post("/api/v3/estimate_recipe_cvxpy", json={"product": product, "options": {"solver": "unknown"}})
+    assert response.status_code == 400
+    assert response.json()["errors"][0]["field"] == {"id": "solver"}
+    assert response.json()["errors"][0]["message"]["id"] == "invalid_value"
+
+
+def test_estimate_recipe_deadline_option(monkeypatch, result_cache):
+    client = TestClient(app)
+    product = {"ingredients": [{"id": "en:sugar"}, {"id": "en:salt"}], "nutriments": {"sugars_100g": 90}}
+
+    response = client.post("/api/v3/estimate_recipe_scipy", json={"product": product, "options": {"deadline_ms": 0.001}})
+    assert response.status_code == 200
+    assert response.json()["product"]["recipe_estimator"]["status_message"] == "deadline_exceeded"
+    # Estimates cut short aren't cached
+    assert result_cache.metrics()["entries"] == 0
+
+    # The server-wide default applies if there is no option
+    monkeypatch.setattr(main.settings, "DEADLINE_MS", 0.001)
+    response = client.post("/api/v3/estimate_recipe_scipy", json={"product": product})
+    assert response.json()["product"]["recipe_estimator"]["status_message"] == "deadline_exceeded"
+    response = client.post("/api/v3/estimate_recipe_scipy", json={"product": product, "options": {"deadline_ms": 0}})
+    assert "deadline_result" not in response.json()["product"]["recipe_estimator"]
+
+    response = client.post("/api/v3/estimate_recipe", json={"product": product, "options": {"deadline_ms": "soon"}})
+    assert response.status_code == 400
+    assert response.json()["errors"][0]["field"] == {"id": "deadline_ms"}
+
+
+def test_estimate_recipe_uses_result_cache(monkeypatch, result_cache):
+    client = TestClient(app)
+    product = {"code": "1", "ingredients": [{"id": "en:sugar"}, {"id": "en:salt"}], "nutriments": {"sugars_100g": 90}}
+
+    estimated = client.post("/api/v3/estimate_recipe_glop", json={"product": product}).json()["product"]
+    assert result_cache.metrics()["misses"] == 1
+
+    def fail(*args):
+        raise AssertionError("estimated again")
+
+    monkeypatch.setattr(main.estimation_pool, "run", fail)
+    # Only the inputs that affect the estimate are in the key
+    cached = client.post("/api/v3/estimate_recipe_glop", json={"product": {**product, "code": "2", "product_name": "Sugar"}}).json()["product"]
+    assert result_cache.metrics()["hits"]["memory"] == 1
+    assert cached["code"] == "2"
+    assert cached["product_name"] == "Sugar"
+    assert cached["ingredients"] == estimated["ingredients"]
+    assert cached["recipe_estimator"] == estimated["recipe_estimator"]
+
+    debug = client.post("/api/v3/estimate_recipe_glop", json={"product": product, "options": {"debug": True, "penalties": False}}).json()["product"]
+    assert "nutrients" in debug["ingredients"][0]
+    assert "result_cache" in debug["recipe_estimator"]["stages"]
+    assert "recipe_estimator_result_cache_hits_total 2" in client.get("/metrics").text
+
+
+def test_estimate_recipes_returns_results_in_input_order():
+    client = TestClient(app)
+    payloads = [
+        {"product": {"code": "1", "ingredients": [{"id": "en:sugar"}, {"id": "en:salt"}]}},
+        {"product": "invalid"},
+        {"product": {"code": "3", "ingredients": [{"id": "en:tomato"}]}},
+    ]
+
+    response = client.post("/api/v3/estimate_recipes?method=simple", json=payloads)
+
+    assert response.status_code == 200
+    results = [json.loads(line) for line in response.text.splitlines()]
+    assert len(results) == 3
+    assert results[0]["product"]["code"] == "1"
+    assert results[0]["product"]["ingredients"][0]["percent_estimate"] > 0
+    assert results[1]["status"] == "failure"
+    assert results[1]["errors"][0]["message"]["id"] == "invalid_type"
+    assert results[2]["product"]["code"] == "3"
+
+
+def test_estimate_recipes_accepts_ndjson():
+    client = TestClient(app)
+    lines = [
+        json.dumps({"product": {"code": "1", "ingredients": [{"id": "en:sugar"}]}}),
+        "not-a-json-payload",
+        json.dumps({"product": {"code": "3", "ingredients": [{"id": "en:salt"}]}, "options": {"debug": True}}),
+    ]
+
+    response = client.post(
+        "/api/v3/estimate_recipes?method=cvxpy",
+        content="\n".join(lines) + "\n",
+        headers={"Content-Type": "application/x-ndjson"},
+    )
+
+    assert response.status_code == 200
+    results = [json.loads(line) for line in response.text.splitlines()]
+    assert [result.get("status") for result in results] == [None, "failure", None]
+    assert results[1]["errors"][0]["message"]["id"] == "invalid_json"
+    assert "nutrients" not in results[0]["product"]["ingredients"][0]
+    assert "nutrients" in results[2]["product"]["ingredients"][0]
+
+
+def _exit_worker(product, penalties=False, compiled=None, deadline=None):
+    os._exit(1)
+
+
+def test_estimate_recipes_recovers_from_worker_dying(monkeypatch):
+    monkeypatch.setitem(main.ESTIMATION_METHODS, "exit", _exit_worker)
+    monkeypatch.setattr(main, "batch_executor", None)
+    client = TestClient(app)
+
+    response = client.post("/api/v3/estimate_recipes?method=exit", json=[{"product": {"ingredients": []}}])
+
+    assert response.status_code == 200
+    results = [json.loads(line) for line in response.text.splitlines()]
+    assert results[0]["errors"][0]["message"]["id"] == "estimation_failed"
+
+    # A new pool is used for the next request
+    response = client.post("/api/v3/estimate_recipes?method=simple", json=[{"product": {"ingredients": [{"id": "en:sugar"}]}}])
+    assert "product" in json.loads(response.text.splitlines()[0])
+
+
+def test_estimate_recipes_requires_known_method():
+    client = TestClient(app)
+    response = client.post("/api/v3/estimate_recipes?method=unknown", json=[])
+
+    assert response.status_code == 400
+    assert response.json()["errors"][0]["field"] == {"id": "method"}
+
+
+def test_estimate_recipes_requires_json_array():
+    client = TestClient(app)
+    response = client.post("/api/v3/estimate_recipes", json={"product": {}})
+
+    assert response.status_code == 400
+    assert response.json()["errors"][0]["message"]["id"] == "invalid_json"
+
+
+def test_estimate_recipe_rejects_when_estimation_pool_is_full(monkeypatch):
+    monkeypatch.setattr(main, "estimation_pool", EstimationPool("thread", workers=1, queue_size=0))
+    main.estimation_pool.in_flight = 1
+    client = TestClient(app)
+
+    response = client.post("/api/v3/estimate_recipe", json={"product": {"ingredients": [{"id": "en:sugar"}]}})
+
+    assert response.status_code == 503
+    assert response.json() == {
+        "errors": [
+            {
+                "field": {"id": "server"},
+                "impact": {
+                    "id": "failure",
+                    "lc_name": "Failure",
+                    "name": "Failure",
+                },
+                "message": {
+                    "id": "server_busy",
+                    "lc_name": "Server busy",
+                    "name": "Server busy",
+                },
+            }
+        ],
+        "status": "failure",
+        "warnings": [],
+    }
+
+    response = client.get("/api/v3/metrics")
+    assert response.json()["estimation_pool"]["rejected"] == 1
+
+
 @pytest.mark.slow
 def test_estimate_recipe():
     product = get_product("20023751")
@@ -0,0 +1,171 @@
+import bisect
+import math
+
+# Upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+# Counts of observations in fixed buckets, like a Prometheus histogram. Updates are a bisect and two additions
+# so can be left on in the hot path. Not thread safe, so only update from one thread (e.g. the event loop)
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    # Cumulative counts of observations less than or equal to each bucket's upper bound
+    def cumulative_counts(self):
+        total = 0
+        cumulative = []
+        for count in self.counts:
+            total += count
+            cumulative.append(total)
+        return cumulative
+
+    def quantile(self, q):
+        # Upper bound of the bucket containing the quantile
+        if not self.count:
+            return None
+        rank = q * self.count
+        for bound, cumulative in zip(self.buckets + (math.inf,), self.cumulative_counts()):
+            if cumulative >= rank:
+                return bound
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "buckets": {str(bound): count for bound, count in zip(self.buckets + ("+Inf",), self.cumulative_counts())},
+        }
+
+
+# Prometheus text exposition format, https://prometheus.io/docs/instrumenting/exposition_formats/
+def format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def escape_label_value(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{escape_label_value(value)}"' for name, value in labels.items()) + "}"
+
+
+# A metric with a value per combination of label values, e.g. estimates per method and status.
+# Like Histogram, only update from one thread
+class Counter:
+    type = "counter"
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.values = {}
+
+    def inc(self, *label_values, amount=1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def get(self, *label_values):
+        return self.values.get(label_values, 0)
+
+    def samples(self):
+        for label_values, value in self.values.items():
+            yield self.name, dict(zip(self.labels, label_values)), value
+
+
+# A histogram per combination of label values
+class Histograms:
+    type = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.histograms = {}
+
+    def get(self, *label_values):
+        histogram = self.histograms.get(label_values)
+        if histogram is None:
+            histogram = self.histograms[label_values] = Histogram(self.buckets)
+        return histogram
+
+    def observe(self, value, *label_values):
+        self.get(*label_values).observe(value)
+
+    def samples(self):
+        for label_values, histogram in self.histograms.items():
+            labels = dict(zip(self.labels, label_values))
+            for bound, count in zip(histogram.buckets + (math.inf,), histogram.cumulative_counts()):
+                yield self.name + "_bucket", {**labels, "le": format_value(bound)}, count
+            yield self.name + "_sum", labels, histogram.sum
+            yield self.name + "_count", labels, histogram.count
+
+
+# A value read when the metrics are scraped, e.g. the number of requests in progress, so costs nothing to keep up to date
+class Gauge:
+    type = "gauge"
+
+    def __init__(self, name, documentation, function):
+        self.name = name
+        self.documentation = documentation
+        self.function = function
+
+    def samples(self):
+        yield self.name, {}, self.function()
+
+
+# A total kept elsewhere, e.g. the number of rejected requests
+class CounterFunction(Gauge):
+    type = "counter"
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{format_labels(labels)} {format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+# Upper bounds of the leaf ingredient count buckets
+LEAF_INGREDIENT_BUCKETS = (1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+
+estimate_seconds = registry.register(Histograms(
+    "recipe_estimator_estimate_seconds", "Time to estimate a recipe, including waiting for a worker", ("method",)
+))
+estimates = registry.register(Counter(
+    "recipe_estimator_estimates_total", "Estimates by method and solver status", ("method", "status")
+))
+fallbacks = registry.register(Counter(
+    "recipe_estimator_fallbacks_total", "Estimates that fell back to another approach", ("method", "fallback")
+))
+tiers = registry.register(Counter(
+    "recipe_estimator_auto_tiers_total", "Estimates by the auto method by the tier that produced them", ("tier",)
+))
+leaf_ingredients = registry.register(Histograms(
+    "recipe_estimator_leaf_ingredients", "Number of leaf ingredients in estimated products", buckets=LEAF_INGREDIENT_BUCKETS
+))
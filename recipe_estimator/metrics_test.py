@@ -0,0 +1,58 @@
+from fastapi.testclient import TestClient
+
+from .main import app
+from .metrics import Counter, CounterFunction, Gauge, Histograms, Registry
+
+
+def test_registry_renders_prometheus_text():
+    registry = Registry()
+    requests = registry.register(Counter("requests_total", "Requests", ("method", "status")))
+    latency = registry.register(Histograms("latency_seconds", "Latency", ("method",), buckets=(0.1, 1)))
+    registry.register(Gauge("in_flight", "In flight", lambda: 3))
+    registry.register(CounterFunction("rejected_total", "Rejected", lambda: 2))
+    requests.inc("cvxpy", "optimal")
+    requests.inc("cvxpy", "optimal")
+    requests.inc("glop", 'say "hi"\n')
+    latency.observe(0.5, "cvxpy")
+
+    assert registry.render() == "\n".join([
+        "# HELP requests_total Requests",
+        "# TYPE requests_total counter",
+        'requests_total{method="cvxpy",status="optimal"} 2',
+        'requests_total{method="glop",status="say \\"hi\\"\\n"} 1',
+        "# HELP latency_seconds Latency",
+        "# TYPE latency_seconds histogram",
+        'latency_seconds_bucket{method="cvxpy",le="0.1"} 0',
+        'latency_seconds_bucket{method="cvxpy",le="1"} 1',
+        'latency_seconds_bucket{method="cvxpy",le="+Inf"} 1',
+        'latency_seconds_sum{method="cvxpy"} 0.5',
+        'latency_seconds_count{method="cvxpy"} 1',
+        "# HELP in_flight In flight",
+        "# TYPE in_flight gauge",
+        "in_flight 3",
+        "# HELP rejected_total Rejected",
+        "# TYPE rejected_total counter",
+        "rejected_total 2",
+    ]) + "\n"
+
+
+def test_metrics_endpoint_counts_estimates():
+    client = TestClient(app)
+    metrics = client.get("/metrics").text
+    assert "# TYPE recipe_estimator_in_flight_estimates gauge\nrecipe_estimator_in_flight_estimates 0\n" in metrics
+
+    def count(text, sample):
+        for line in text.splitlines():
+            if line.startswith(sample + " "):
+                return float(line.split(" ")[1])
+        return 0
+
+    before = count(metrics, 'recipe_estimator_estimates_total{method="glop",status="optimal"}')
+    product = {"ingredients": [{"id": "en:sugar"}, {"id": "en:salt", "ingredients": [{"id": "en:water"}, {"id": "en:flour"}]}]}
+    assert client.post("/api/v3/estimate_recipe_glop", json={"product": product}).status_code == 200
+
+    metrics = client.get("/metrics").text
+    assert count(metrics, 'recipe_estimator_estimates_total{method="glop",status="optimal"}') == before + 1
+    assert count(metrics, 'recipe_estimator_estimate_seconds_count{method="glop"}') >= 1
+    assert count(metrics, 'recipe_estimator_leaf_ingredients_bucket{le="3"}') >= 1
+    assert count(metrics, 'recipe_estimator_stage_seconds_count{endpoint="/api/v3/estimate_recipe_glop",stage="solve"}') >= 1
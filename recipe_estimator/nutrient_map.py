@@ -1,22 +1,35 @@
 import csv
 import os
 
-# Load OFF Ciqual Nutrient mapping
+from .asset_bundle import get_bundle
+
+filename = os.path.join(os.path.dirname(__file__), "assets/nutrient_map.csv")
+
+
+def read_nutrient_map(filename=filename):
+    # Only the rows that map to a Ciqual nutrient are used
+    rows = []
+    with open(filename, newline="", encoding="utf8") as csvfile:
+        reader = csv.DictReader(csvfile)
+        for row in reader:
+            if row["ciqual_id"]:
+                # Normalise units. OFF units are generally g so need to convert to the
+                # Ciqual unit for comparison
+                factor = 1.0
+                ciqual_unit = row['ciqual_unit']
+                if ciqual_unit == 'mg':
+                    factor = 1000.0
+                elif ciqual_unit == 'µg':
+                    factor = 1000000.0
+                row['factor'] = factor
+                rows.append(row)
+    return rows
+
+
+# Load OFF Ciqual Nutrient mapping. The asset bundle holds a copy of the mapped rows so we don't need to parse the whole CSV
+bundle = get_bundle()
 off_to_ciqual = {}
 ciqual_to_off = {}
-filename = os.path.join(os.path.dirname(__file__), "assets/nutrient_map.csv")
-with open(filename, newline="", encoding="utf8") as csvfile:
-    reader = csv.DictReader(csvfile)
-    for row in reader:
-        if row["ciqual_id"]:
-            # Normalise units. OFF units are generally g so need to convert to the
-            # Ciqual unit for comparison
-            factor = 1.0
-            ciqual_unit = row['ciqual_unit']
-            if ciqual_unit == 'mg':
-                factor = 1000.0
-            elif ciqual_unit == 'µg':
-                factor = 1000000.0
-            row['factor'] = factor
-            off_to_ciqual[row["off_id"]] = row
-            ciqual_to_off[row["ciqual_id"].lower()] = row
+for row in bundle.nutrient_map_rows if bundle else read_nutrient_map():
+    off_to_ciqual[row["off_id"]] = row
+    ciqual_to_off[row["ciqual_id"].lower()] = row
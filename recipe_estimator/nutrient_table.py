@@ -0,0 +1,83 @@
+import numpy as np
+
+# Last dimension of the nutrient values
+NOM, MIN, MAX = 0, 1, 2
+
+
+# Dense copy of the CIQUAL nutrients so that estimators can build their nutrient matrices with a single
+# fancy-index gather rather than looping over the nested ingredient['nutrients'] dicts.
+#  - values: array of (foods + 1) x nutrients x {nom, min, max} in the CIQUAL units (percent of the food)
+#  - valid: (foods + 1) x nutrients, True where the nutrient is known with a confidence other than '-'
+#  - rows: ciqual code -> row, columns: nutrient key -> column
+# The last row is all zeros and is used for ingredients that aren't in CIQUAL
+class NutrientTable:
+    def __init__(self, ciqual_ingredients, food_codes, nutrient_keys, values, valid):
+        self.ciqual_ingredients = ciqual_ingredients
+        self.nutrient_keys = nutrient_keys
+        self.rows = {food_code: f for f, food_code in enumerate(food_codes)}
+        self.columns = {nutrient_key: n for n, nutrient_key in enumerate(nutrient_keys)}
+        self.unknown_row = len(food_codes)
+        self.values = np.concatenate([values, np.zeros((1,) + values.shape[1:])])
+        self.valid = np.concatenate([valid, np.zeros((1,) + valid.shape[1:], dtype=bool)])
+
+    @classmethod
+    def from_ciqual_ingredients(cls, ciqual_ingredients, nutrient_keys):
+        food_codes = list(ciqual_ingredients.keys())
+        values = np.zeros((len(food_codes), len(nutrient_keys), 3))
+        valid = np.zeros((len(food_codes), len(nutrient_keys)), dtype=bool)
+        for f, food_code in enumerate(food_codes):
+            _fill_row(ciqual_ingredients[food_code]["nutrients"], nutrient_keys, values[f], valid[f])
+        return cls(ciqual_ingredients, food_codes, nutrient_keys, values, valid)
+
+    @classmethod
+    def from_bundle(cls, bundle):
+        # Confidence code 1 is '-' (see asset_bundle.CONFIDENCE_CODES)
+        confidence = np.asarray(bundle.arrays["nutrient_confidence"])
+        values = np.asarray(bundle.nutrient_values)
+        return cls(bundle.ciqual_ingredients, bundle.food_codes, bundle.nutrient_keys, values, confidence > 1)
+
+    def row(self, ingredient):
+        # Returns None if the ingredient nutrients didn't come from CIQUAL, e.g. they were provided in the request
+        ingredient_nutrients = ingredient.get("nutrients")
+        if not ingredient_nutrients:
+            return self.unknown_row
+        row = self.rows.get(ingredient.get("ciqual_food_code_used"))
+        if row is not None and ingredient_nutrients is self.ciqual_ingredients[ingredient["ciqual_food_code_used"]]["nutrients"]:
+            return row
+        return None
+
+    def leaf_rows(self, leaf_ingredients):
+        # Rows of the leaf ingredients, None for those with nutrients that didn't come from CIQUAL
+        return [self.row(ingredient) for ingredient in leaf_ingredients]
+
+    def rows_values(self, rows, leaf_ingredients):
+        # Returns values (leaves x nutrients x {nom, min, max}) and valid (leaves x nutrients) for rows from leaf_rows
+        custom = [i for i, row in enumerate(rows) if row is None]
+        if not custom:
+            return self.values[rows], self.valid[rows]
+
+        values = self.values[[self.unknown_row if row is None else row for row in rows]]
+        valid = self.valid[[self.unknown_row if row is None else row for row in rows]]
+        for i in custom:
+            _fill_row(leaf_ingredients[i]["nutrients"], self.nutrient_keys, values[i], valid[i])
+        return values, valid
+
+    def leaf_values(self, leaf_ingredients):
+        # Returns values (leaves x nutrients x {nom, min, max}) and valid (leaves x nutrients) for all nutrients in the table
+        return self.rows_values(self.leaf_rows(leaf_ingredients), leaf_ingredients)
+
+    def gather(self, leaf_ingredients, nutrient_keys, bound=NOM):
+        # Returns a nutrients x leaves matrix of the given bound for the requested nutrients
+        values, _ = self.leaf_values(leaf_ingredients)
+        columns = [self.columns[nutrient_key] for nutrient_key in nutrient_keys]
+        return values[:, columns, bound].T
+
+
+def _fill_row(ingredient_nutrients, nutrient_keys, values, valid):
+    for n, nutrient_key in enumerate(nutrient_keys):
+        ingredient_nutrient = ingredient_nutrients.get(nutrient_key)
+        if ingredient_nutrient is None:
+            continue
+        percent_nom = ingredient_nutrient.get("percent_nom", 0)
+        values[n] = [percent_nom, ingredient_nutrient.get("percent_min", percent_nom), ingredient_nutrient.get("percent_max", percent_nom)]
+        valid[n] = ingredient_nutrient.get("confidence") != "-"
@@ -0,0 +1,61 @@
+import numpy as np
+
+from .asset_bundle import read_bundle, write_bundle
+from .nutrient_table import NutrientTable, MAX, MIN, NOM
+
+
+ciqual_ingredients = {
+    '1': {'nutrients': {
+        'fiber': {'percent_nom': 4, 'percent_min': 3, 'percent_max': 5, 'confidence': 'A'},
+        'sugars': {'percent_nom': 2, 'percent_min': 2, 'percent_max': 2, 'confidence': '-'},
+    }},
+    '2': {'nutrients': {
+        'sugars': {'percent_nom': 50, 'percent_min': 40, 'percent_max': 60, 'confidence': 'B'},
+    }},
+}
+nutrient_keys = ['fiber', 'sugars', 'salt']
+
+
+def leaf(code):
+    return {'ciqual_food_code_used': code, 'nutrients': ciqual_ingredients[code]['nutrients']}
+
+
+def test_gather_uses_table_rows():
+    table = NutrientTable.from_ciqual_ingredients(ciqual_ingredients, nutrient_keys)
+    leaf_ingredients = [leaf('2'), leaf('1'), {'nutrients': {}}]
+
+    assert np.array_equal(table.gather(leaf_ingredients, ['sugars', 'fiber']), [[50, 2, 0], [0, 4, 0]])
+    assert np.array_equal(table.gather(leaf_ingredients, ['sugars'], MIN), [[40, 2, 0]])
+    assert np.array_equal(table.gather(leaf_ingredients, ['fiber'], MAX), [[0, 5, 0]])
+
+
+def test_leaf_values_flags_unknown_confidence_as_not_valid():
+    table = NutrientTable.from_ciqual_ingredients(ciqual_ingredients, nutrient_keys)
+    _, valid = table.leaf_values([leaf('1'), leaf('2')])
+
+    assert valid.tolist() == [[True, False, False], [False, True, False]]
+
+
+def test_gather_uses_nutrients_provided_on_the_ingredient():
+    table = NutrientTable.from_ciqual_ingredients(ciqual_ingredients, nutrient_keys)
+    # Nutrients have been edited so don't match the CIQUAL entry any more
+    edited = {'ciqual_food_code_used': '1', 'nutrients': {'fiber': {'percent_nom': 10}}}
+    values, valid = table.leaf_values([leaf('1'), edited])
+
+    assert values[:, 0, NOM].tolist() == [4, 10]
+    assert values[1, 0].tolist() == [10, 10, 10]
+    assert valid[1].tolist() == [True, False, False]
+
+
+def test_bundle_table_matches_json_table(tmp_path):
+    foods = {code: {'alim_nom_eng': code, 'nutrients': {
+        nutrient_key: {**nutrient, 'percent_nom': nutrient['percent_nom'] + 0.1} for nutrient_key, nutrient in food['nutrients'].items()
+    }} for code, food in ciqual_ingredients.items()}
+    filename = str(tmp_path / 'test.bundle')
+    write_bundle(filename, {'en:one': ('1', None, None)}, foods, [{'off_id': nutrient_key, 'ciqual_id': nutrient_key} for nutrient_key in nutrient_keys])
+
+    bundle_table = NutrientTable.from_bundle(read_bundle(filename, []))
+    json_table = NutrientTable.from_ciqual_ingredients(foods, nutrient_keys)
+
+    assert np.array_equal(bundle_table.values, json_table.values)
+    assert np.array_equal(bundle_table.valid, json_table.valid)
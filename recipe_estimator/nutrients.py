@@ -1,25 +1,68 @@
+import functools
 import json
+import logging
 import os
 
+from .asset_bundle import get_bundle
 from .nutrient_map import off_to_ciqual
+from .nutrient_table import NutrientTable
+from .spans import timed
 
-# Load ciqual ingredients
-with open(os.path.join(os.path.dirname(__file__), "assets/ciqual_ingredients.json"), "r", encoding="utf-8") as ciqual_file:
-    ciqual_ingredients = json.load(ciqual_file)
+logger = logging.getLogger(__name__)
 
-# Load ingredients
-with open(os.path.join(os.path.dirname(__file__), "assets/ingredients.json"), "r", encoding="utf-8") as ingredients_file:
-    ingredients_taxonomy = json.load(ingredients_file)
 
-def get_ciqual_code(ingredient_id):
-    ciqual_code = None
-    ciqual_proxy_code = None
-    
+# Assets are loaded lazily, from the asset bundle if one has been built, otherwise from the JSON files
+@functools.cache
+def get_ciqual_ingredients():
+    bundle = get_bundle()
+    if bundle is not None:
+        return bundle.ciqual_ingredients
+    with open(os.path.join(os.path.dirname(__file__), "assets/ciqual_ingredients.json"), "r", encoding="utf-8") as ciqual_file:
+        return json.load(ciqual_file)
+
+
+@functools.cache
+def get_ingredients_taxonomy():
+    with open(os.path.join(os.path.dirname(__file__), "assets/ingredients.json"), "r", encoding="utf-8") as ingredients_file:
+        return json.load(ingredients_file)
+
+
+@functools.cache
+def get_nutrient_table():
+    bundle = get_bundle()
+    if bundle is not None:
+        return NutrientTable.from_bundle(bundle)
+    return NutrientTable.from_ciqual_ingredients(get_ciqual_ingredients(), list(off_to_ciqual.keys()))
+
+
+def __getattr__(name):
+    # Keep supporting nutrients.ciqual_ingredients and nutrients.ingredients_taxonomy
+    if name == "ciqual_ingredients":
+        return get_ciqual_ingredients()
+    if name == "ingredients_taxonomy":
+        return get_ingredients_taxonomy()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+# Walk up the taxonomy parents until we find a ciqual code or proxy code
+# Returns the codes and the id of the ancestor they were found on (None if they are on the ingredient itself)
+# resolved is used to memoize results so that building the index for the whole taxonomy is linear
+def resolve_ciqual_code(ingredients_taxonomy, ingredient_id, resolved=None):
+    if resolved is None:
+        resolved = {}
+    elif ingredient_id in resolved:
+        return resolved[ingredient_id]
+
     ingredient = ingredients_taxonomy.get(ingredient_id, None)
     if ingredient is None:
-        print(ingredient_id + ' not found')       
-        return None, None
+        return None, None, None
 
+    # Mark the ingredient as unresolved while its parents are walked so that a cycle in the parents ends there
+    resolved[ingredient_id] = None, None, None
+
+    ciqual_code = None
+    ciqual_proxy_code = None
+    source_parent = None
     ciqual_code_object = ingredient.get('ciqual_food_code', None)
     if ciqual_code_object:
         ciqual_code  = ciqual_code_object['en']
@@ -31,15 +74,56 @@ def get_ciqual_code(ingredient_id):
         parents = ingredient.get('parents', None)
         if parents:
             for parent_id in parents:
-                ciqual_code, ciqual_proxy_code = get_ciqual_code(parent_id)
+                ciqual_code, ciqual_proxy_code, parent_source = resolve_ciqual_code(ingredients_taxonomy, parent_id, resolved)
                 if ciqual_code or ciqual_proxy_code:
-                    print(f"Obtained ciqual_code for {ingredient_id} from parent {parent_id}")
+                    source_parent = parent_source or parent_id
                     break
 
+    resolved[ingredient_id] = ciqual_code, ciqual_proxy_code, source_parent
+    return ciqual_code, ciqual_proxy_code, source_parent
+
+
+# Index of taxonomy id -> (ciqual_code, ciqual_proxy_code, source_parent)
+def build_ciqual_code_index(ingredients_taxonomy):
+    index = {}
+    for ingredient_id in ingredients_taxonomy:
+        resolve_ciqual_code(ingredients_taxonomy, ingredient_id, index)
+    return index
+
+
+# The result only depends on the taxonomy so is resolved once, either when building the asset bundle or on first use
+@functools.cache
+def get_ciqual_code_index():
+    bundle = get_bundle()
+    if bundle is not None:
+        return bundle.ingredient_codes
+    return build_ciqual_code_index(get_ingredients_taxonomy())
+
+
+def get_ciqual_code_index_stats(index):
+    stats = {'ingredients': len(index), 'direct': 0, 'from_parent': 0, 'unresolved': 0}
+    for ciqual_code, ciqual_proxy_code, source_parent in index.values():
+        if source_parent:
+            stats['from_parent'] += 1
+        elif ciqual_code or ciqual_proxy_code:
+            stats['direct'] += 1
+        else:
+            stats['unresolved'] += 1
+    return stats
+
+
+def get_ciqual_code(ingredient_id):
+    codes = get_ciqual_code_index().get(ingredient_id)
+    if codes is None:
+        logger.debug("%s not found", ingredient_id)
+        return None, None
+
+    ciqual_code, ciqual_proxy_code, _ = codes
     return ciqual_code, ciqual_proxy_code
 
 
 def setup_ingredients(ingredients, nutrients):
+    ciqual_ingredients = get_ciqual_ingredients()
     for ingredient in ingredients:
         if ('ingredients' in ingredient and len(ingredient['ingredients']) > 0):
             # Child ingredients
@@ -70,6 +154,19 @@ def setup_ingredients(ingredients, nutrients):
                 ingredient['ciqual_food_code_used'] = ciqual_code
 
 
+# Leaf ingredients are those that do not have sub-ingredients, in the order they appear in the product
+def get_leaf_ingredients(ingredients, leaf_ingredients=None):
+    if leaf_ingredients is None:
+        leaf_ingredients = []
+    for ingredient in ingredients:
+        if 'ingredients' in ingredient and len(ingredient['ingredients']) > 0:
+            get_leaf_ingredients(ingredient['ingredients'], leaf_ingredients)
+        else:
+            leaf_ingredients.append(ingredient)
+    return leaf_ingredients
+
+
+@timed("prepare_product")
 def prepare_product(product):
     setup_ingredients(product['ingredients'], product.get('nutriments', {}))
 
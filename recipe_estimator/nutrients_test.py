@@ -1,4 +1,4 @@
-from .nutrients import get_ciqual_code, prepare_product
+from .nutrients import build_ciqual_code_index, get_ciqual_code, get_ciqual_code_index_stats, prepare_product
 
 def test_prepare_product_populates_nutrients():
     product = {
@@ -57,3 +57,37 @@ def test_get_ciqual_code_should_use_proxy_if_no_main_code():
     ciqual_code, ciqual_proxy_code = get_ciqual_code('en:tomato-sauce')
     assert ciqual_code is None
     assert ciqual_proxy_code == '11107'
+
+
+def test_ciqual_code_index_resolves_through_parents():
+    taxonomy = {
+        'en:vegetable': {},
+        'en:tomato': {'ciqual_food_code': {'en': '20047'}, 'parents': ['en:vegetable']},
+        'en:cherry-tomato': {'parents': ['en:tomato']},
+        'en:organic-cherry-tomato': {'parents': ['en:vegetable', 'en:cherry-tomato']},
+        'en:tomato-sauce': {'ciqual_proxy_food_code': {'en': '11107'}},
+    }
+    index = build_ciqual_code_index(taxonomy)
+
+    assert index['en:tomato'] == ('20047', None, None)
+    assert index['en:cherry-tomato'] == ('20047', None, 'en:tomato')
+    # Source parent is the ancestor that has the code
+    assert index['en:organic-cherry-tomato'] == ('20047', None, 'en:tomato')
+    assert index['en:tomato-sauce'] == (None, '11107', None)
+    assert index['en:vegetable'] == (None, None, None)
+
+    assert get_ciqual_code_index_stats(index) == {'ingredients': 5, 'direct': 2, 'from_parent': 2, 'unresolved': 1}
+
+
+def test_ciqual_code_index_treats_parent_cycles_as_unresolved():
+    taxonomy = {
+        'en:a': {'parents': ['en:b']},
+        'en:b': {'parents': ['en:a']},
+        'en:c': {'parents': ['en:b', 'en:tomato']},
+        'en:tomato': {'ciqual_food_code': {'en': '20047'}},
+    }
+    index = build_ciqual_code_index(taxonomy)
+
+    assert index['en:a'] == (None, None, None)
+    assert index['en:b'] == (None, None, None)
+    assert index['en:c'] == ('20047', None, 'en:tomato')
@@ -1,33 +1,28 @@
-from .nutrients import ensure_float
+import numpy as np
+
+from .compiled_recipe import get_compiled_recipe
+from .nutrients import ensure_float, get_nutrient_table
 from .nutrient_map import off_to_ciqual
+from .nutrient_table import NOM
+from .spans import timed
 
 
 # count the number of leaf ingredients in the product
 # for each nutrient, store in nutrients the number of leaf ingredients that have a nutrient value
-# and the sum of the percent_max of the corresponding ingredients
-def count_ingredients(ingredients, nutrients):
-    count = 0
-    for ingredient in ingredients:
-        if ('ingredients' in ingredient and len(ingredient['ingredients']) > 0):
-            # Child ingredients
-            child_count = count_ingredients(ingredient['ingredients'], nutrients)
-            count = count + child_count
-
-        else:
-            count = count + 1
-            ingredient_nutrients = ingredient.get('nutrients')
-            if (ingredient_nutrients is not None):
-                for off_id in ingredient_nutrients:
-                    if ingredient_nutrients[off_id].get('confidence') != '-':
-                        proportion = ingredient_nutrients[off_id]['percent_nom']
-                        existing_nutrient = nutrients.get(off_id)
-                        if (existing_nutrient is None):
-                            nutrients[off_id] = {'ingredient_count': 1, 'unweighted_total': proportion, 'weighting': 0}
-                        else:
-                            existing_nutrient['ingredient_count'] = existing_nutrient['ingredient_count'] + 1
-                            existing_nutrient['unweighted_total'] = existing_nutrient['unweighted_total'] + proportion
+# and the sum of the percent_nom of the corresponding ingredients
+def count_ingredients(compiled, nutrients):
+    nutrient_table = get_nutrient_table()
+    values, valid = compiled.nutrient_values, compiled.nutrient_valid
+    ingredient_counts = valid.sum(axis=0)
+    unweighted_totals = np.where(valid, values[:, :, NOM], 0).sum(axis=0)
+    for n in np.flatnonzero(ingredient_counts):
+        nutrients[nutrient_table.nutrient_keys[n]] = {
+            'ingredient_count': int(ingredient_counts[n]),
+            'unweighted_total': float(unweighted_totals[n]),
+            'weighting': 0,
+        }
 
-    return count
+    return len(compiled.leaf_ingredients)
 
 def assign_weightings(product, scipy):
     # Determine which nutrients will be used in the analysis by assigning a weighting
@@ -85,9 +80,10 @@ def assign_weightings(product, scipy):
 
     return might_be_us
 
-def prepare_nutrients(product, scipy = False):
+@timed("prepare_nutrients")
+def prepare_nutrients(product, scipy = False, compiled = None):
     nutrients = {}
-    count = count_ingredients(product['ingredients'], nutrients)
+    count = count_ingredients(get_compiled_recipe(product, compiled), nutrients)
     recipe_estimator = product.setdefault('recipe_estimator', {})
     recipe_estimator['nutrients'] = nutrients
     recipe_estimator['ingredient_count'] = count
@@ -1,9 +1,24 @@
+import asyncio
+import functools
 import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
 from pathlib import Path
+
+import httpx
 import requests
 
 from . import settings
 
+logger = logging.getLogger(__name__)
+
+HEADERS = {
+    "User-Agent": "recipe-estimator/0.1 (recipe-estimator.openfoodfacts.org)"
+}
+
 
 def print_recipe(ingredients, indent=""):
     for ingredient in ingredients:
@@ -27,28 +42,190 @@ def fix_ingredients(ingredients):
                 del ingredient["ingredients"]
 
 
-def get_product(id):
-    id = str(id)
-    if not id.isdigit():
-        return {}
+# Index of product id -> file for the test set products, built with a single walk of the directory
+@functools.cache
+def get_test_set_index(test_set_dir=None):
+    test_set_dir = Path(test_set_dir or settings.PRODUCT_TEST_SET_DIR)
+    index = {}
+    if test_set_dir.is_dir():
+        for path in test_set_dir.rglob("*.json"):
+            index.setdefault(path.stem, path)
+    return index
+
+
+def get_test_set_product(id):
+    path = get_test_set_index().get(id)
+    if path is None:
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+# Products fetched from Open Food Facts. Entries expire after ttl seconds and the least recently used are dropped beyond max_size.
+# Products are kept as JSON text so every caller gets its own copy to modify. If a directory is given products are also
+# written there, so they are still available after a restart until they expire
+class ProductCache:
+    def __init__(self, max_size=1024, ttl=3600, directory=None, clock=time.time):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.directory = Path(directory) if directory else None
+        self.clock = clock
+        self.products = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if self.directory is not None:
+            self.directory.mkdir(parents=True, exist_ok=True)
+
+    def get(self, id):
+        now = self.clock()
+        with self.lock:
+            entry = self.products.get(id)
+            if entry is not None and entry[0] <= now:
+                del self.products[id]
+                entry = None
+            if entry is not None:
+                self.products.move_to_end(id)
+
+        if entry is None:
+            entry = self.read(id, now)
+        with self.lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return json.loads(entry[1])
+
+    def put(self, id, product):
+        text = json.dumps(product)
+        self.add(id, self.clock() + self.ttl, text)
+        if self.directory is not None:
+            path = self.directory / (id + ".json")
+            temporary_path = path.with_suffix(f".{threading.get_ident()}.tmp")
+            temporary_path.write_text(text, encoding="utf-8")
+            os.replace(temporary_path, path)
+
+    def add(self, id, expires, text):
+        with self.lock:
+            self.products[id] = (expires, text)
+            self.products.move_to_end(id)
+            while len(self.products) > self.max_size:
+                self.products.popitem(last=False)
+
+    # Products on disk expire ttl seconds after they were written
+    def read(self, id, now):
+        if self.directory is None:
+            return None
+        path = self.directory / (id + ".json")
+        try:
+            expires = path.stat().st_mtime + self.ttl
+            if expires <= now:
+                return None
+            text = path.read_text(encoding="utf-8")
+        except OSError:
+            return None
+        self.add(id, expires, text)
+        return expires, text
+
+    def clear(self):
+        with self.lock:
+            self.products.clear()
+
+    def metrics(self):
+        return {"size": len(self.products), "max_size": self.max_size, "hits": self.hits, "misses": self.misses}
+
+
+# Async client for Open Food Facts with a pool of keep-alive connections, a timeout, and a limit on concurrent requests.
+# An httpx.AsyncClient can only be used on the event loop that created it, so a new one is created if the loop changes
+class ProductClient:
+    def __init__(self, max_connections=10, timeout=10):
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.client = None
+        self.semaphore = None
+        self.loop = None
+
+    def get_client(self):
+        loop = asyncio.get_running_loop()
+        if self.client is None or self.loop is not loop:
+            self.client = httpx.AsyncClient(
+                headers=HEADERS,
+                timeout=self.timeout,
+                limits=httpx.Limits(max_connections=self.max_connections, max_keepalive_connections=self.max_connections),
+            )
+            self.semaphore = asyncio.Semaphore(self.max_connections)
+            self.loop = loop
+        return self.client
+
+    async def fetch(self, id):
+        client = self.get_client()
+        async with self.semaphore:
+            response = await client.get(settings.OPENFOODFACTS_URL + "/api/v3/product/" + id)
+        return response.json()
+
+    async def aclose(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+
+product_cache = ProductCache(
+    settings.PRODUCT_CACHE_SIZE,
+    settings.PRODUCT_CACHE_TTL,
+    settings.PRODUCT_CACHE_DIR or None,
+)
+product_client = ProductClient(settings.PRODUCT_MAX_CONNECTIONS, settings.PRODUCT_TIMEOUT)
+session = requests.Session()
+session.headers.update(HEADERS)
 
+
+def get_local_product(id):
     # First see if the product is in a test set
-    matches = list(
-        Path("../recipe-estimator-metrics/test-sets/input").rglob(id + ".json")
-    )
-    if len(matches) > 0:
-        with open(matches[0]) as f:
-            return json.load(f)
-
-    response = requests.get(
-        settings.OPENFOODFACTS_URL + "/api/v3/product/" + id,
-        headers={
-            "User-Agent": "recipe-estimator/0.1 (recipe-estimator.openfoodfacts.org)"
-        },
-    ).json()
+    product = get_test_set_product(id)
+    if product is None:
+        product = product_cache.get(id)
+    return product
+
+
+def add_product(id, response):
     if not "product" in response:
         return {}
 
     product = response["product"]
     fix_ingredients(product["ingredients"])
+    product_cache.put(id, product)
     return product
+
+
+async def get_product_async(id):
+    id = str(id)
+    if not id.isdigit():
+        return {}
+
+    product = get_local_product(id)
+    if product is not None:
+        return product
+
+    try:
+        response = await product_client.fetch(id)
+    except (httpx.HTTPError, ValueError) as e:
+        logger.warning("Product: %s, could not fetch from Open Food Facts: %r", id, e)
+        return {}
+    return add_product(id, response)
+
+
+# Blocking version for scripts and tests
+def get_product(id):
+    id = str(id)
+    if not id.isdigit():
+        return {}
+
+    product = get_local_product(id)
+    if product is not None:
+        return product
+
+    response = session.get(
+        settings.OPENFOODFACTS_URL + "/api/v3/product/" + id,
+        timeout=settings.PRODUCT_TIMEOUT,
+    ).json()
+    return add_product(id, response)
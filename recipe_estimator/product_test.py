@@ -1,7 +1,173 @@
+import asyncio
+import json
 import os
-from .product import get_product
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from fastapi.testclient import TestClient
+
+from . import product as product_module
+from . import settings
+from .main import app
+from .product import ProductCache, ProductClient, get_product, get_product_async, get_test_set_index
+
+
+# Local stand in for the Open Food Facts product API. Records the number of requests and the most that were in progress at once
+class StubProductServer:
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.requests = 0
+        self.in_progress = 0
+        self.max_in_progress = 0
+        self.lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Headers and body are written separately, which with keep-alive connections would otherwise wait for a delayed ACK
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                with stub.lock:
+                    stub.requests += 1
+                    stub.in_progress += 1
+                    stub.max_in_progress = max(stub.max_in_progress, stub.in_progress)
+                time.sleep(stub.delay)
+                id = self.path.rsplit("/", 1)[-1]
+                if id.startswith("404"):
+                    body = json.dumps({"status": "failure"}).encode()
+                else:
+                    body = json.dumps({"product": {"code": id, "ingredients": [{"id": "en:tomato", "ingredients": []}]}}).encode()
+                with stub.lock:
+                    stub.in_progress -= 1
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def stub_server(monkeypatch, tmp_path):
+    with StubProductServer() as server:
+        monkeypatch.setattr(settings, "OPENFOODFACTS_URL", server.url)
+        monkeypatch.setattr(product_module, "product_cache", ProductCache(max_size=10))
+        monkeypatch.setattr(product_module, "product_client", ProductClient(max_connections=2, timeout=5))
+        monkeypatch.setattr(settings, "PRODUCT_TEST_SET_DIR", str(tmp_path / "test-sets"))
+        get_test_set_index.cache_clear()
+        yield server
+    get_test_set_index.cache_clear()
+
 
 def test_product_comes_from_metrics():
     is_ci = os.environ.get('CI', False)
     # Shouldn't see any non-whitelisted fields if came from metrics
-    assert is_ci or "_keywords" not in get_product('20005726')
\ No newline at end of file
+    assert is_ci or "_keywords" not in get_product('20005726')
+
+
+def test_get_product_fetches_once_then_uses_cache(stub_server):
+    product = asyncio.run(get_product_async("123"))
+    assert product == {"code": "123", "ingredients": [{"id": "en:tomato"}]}
+    assert stub_server.requests == 1
+
+    # Callers get their own copy
+    product["ingredients"].clear()
+    assert asyncio.run(get_product_async("123")) == {"code": "123", "ingredients": [{"id": "en:tomato"}]}
+    assert get_product("123") == {"code": "123", "ingredients": [{"id": "en:tomato"}]}
+    assert stub_server.requests == 1
+    assert product_module.product_cache.metrics()["hits"] == 2
+
+
+def test_get_product_not_found_is_not_cached(stub_server):
+    assert asyncio.run(get_product_async("404")) == {}
+    assert asyncio.run(get_product_async("404")) == {}
+    assert stub_server.requests == 2
+    assert asyncio.run(get_product_async("not-a-code")) == {}
+    assert stub_server.requests == 2
+
+
+def test_get_product_from_test_set_index(stub_server, tmp_path):
+    test_set = tmp_path / "test-sets" / "set-1"
+    test_set.mkdir(parents=True)
+    (test_set / "456.json").write_text(json.dumps({"code": "456", "from": "test set"}))
+
+    assert asyncio.run(get_product_async("456")) == {"code": "456", "from": "test set"}
+    assert get_product("456") == {"code": "456", "from": "test set"}
+    assert stub_server.requests == 0
+
+
+def test_get_product_timeout(monkeypatch):
+    with StubProductServer(delay=0.5) as server:
+        monkeypatch.setattr(settings, "OPENFOODFACTS_URL", server.url)
+        monkeypatch.setattr(product_module, "product_cache", ProductCache())
+        monkeypatch.setattr(product_module, "product_client", ProductClient(timeout=0.1))
+        assert asyncio.run(get_product_async("123")) == {}
+
+
+def test_product_client_limits_concurrent_requests(monkeypatch):
+    with StubProductServer(delay=0.05) as server:
+        monkeypatch.setattr(settings, "OPENFOODFACTS_URL", server.url)
+        client = ProductClient(max_connections=2)
+
+        async def fetch_all():
+            try:
+                return await asyncio.gather(*(client.fetch(str(id)) for id in range(8)))
+            finally:
+                await client.aclose()
+
+        responses = asyncio.run(fetch_all())
+        assert [response["product"]["code"] for response in responses] == [str(id) for id in range(8)]
+        assert server.requests == 8
+        assert server.max_in_progress <= 2
+
+
+def test_product_cache_expires_and_evicts():
+    now = [0]
+    cache = ProductCache(max_size=2, ttl=10, clock=lambda: now[0])
+    cache.put("1", {"code": "1"})
+    cache.put("2", {"code": "2"})
+    assert cache.get("1") == {"code": "1"}
+    # 2 is now the least recently used
+    cache.put("3", {"code": "3"})
+    assert cache.get("2") is None
+    assert cache.get("3") == {"code": "3"}
+
+    now[0] = 10
+    assert cache.get("1") is None
+    assert cache.metrics() == {"size": 1, "max_size": 2, "hits": 2, "misses": 2}
+
+
+def test_product_cache_persists_to_directory(tmp_path):
+    ProductCache(directory=tmp_path).put("1", {"code": "1"})
+    assert ProductCache(directory=tmp_path).get("1") == {"code": "1"}
+
+    # Expired on disk
+    os.utime(tmp_path / "1.json", (0, 0))
+    assert ProductCache(directory=tmp_path).get("1") is None
+
+
+def test_product_endpoint_uses_cache(stub_server):
+    # Each request without a lifespan runs on a new event loop, so this also checks the client is recreated
+    client = TestClient(app)
+    assert client.get("/product/123").json()["code"] == "123"
+    assert client.get("/product/789").json()["code"] == "789"
+    assert client.get("/product/123").json()["code"] == "123"
+    assert stub_server.requests == 2
@@ -0,0 +1,92 @@
+import logging
+import time
+
+from . import settings
+from .compiled_recipe import get_compiled_recipe
+from .deadline import expired
+from .fitness import get_objective_function_args, get_penalties
+from .recipe_estimator_cvxpy import estimate_recipe as estimate_recipe_cvxpy
+from .recipe_estimator_nnls import estimate_recipe as estimate_recipe_nnls
+from .recipe_estimator_po import estimate_recipe as estimate_recipe_po
+from .recipe_estimator_scipy import estimate_recipe as estimate_recipe_scipy
+from .recipe_estimator_simple import estimate_recipe as estimate_recipe_simple
+from .recipe_estimator_unconstrained_nnls import estimate_recipe as estimate_recipe_unconstrained_nnls
+from .spans import set_outcome, span
+
+logger = logging.getLogger(__name__)
+
+# Estimators that can be tiers of the auto method. GLOP isn't one as it doesn't set any estimates if it fails
+TIER_ESTIMATORS = {
+    "simple": estimate_recipe_simple,
+    "po": estimate_recipe_po,
+    "unconstrained_nnls": estimate_recipe_unconstrained_nnls,
+    "nnls": estimate_recipe_nnls,
+    "cvxpy": estimate_recipe_cvxpy,
+    "scipy": estimate_recipe_scipy,
+}
+
+
+def get_tiers(tiers):
+    tiers = [tier.strip() for tier in tiers.split(",") if tier.strip()]
+    unknown = [tier for tier in tiers if tier not in TIER_ESTIMATORS]
+    if unknown or not tiers:
+        raise ValueError(f"AUTO_TIERS must be a list of {', '.join(TIER_ESTIMATORS)}, not {', '.join(unknown) or 'empty'}")
+    return tiers
+
+
+TIERS = get_tiers(settings.AUTO_TIERS)
+
+
+# Scores an estimate with the objective function penalties: how far the nutrients of the leaf ingredient quantities are
+# from those of the product, and how much the quantities are out of order
+def score_estimate(product, args):
+    penalties = dict(get_penalties(product, args=args))
+    order_penalty = penalties["ingredient_not_half_previous_penalty"] + penalties["ingredient_more_than_previous_penalty"]
+    return penalties, float(penalties["nutrient_penalty"]), float(order_penalty)
+
+
+# Runs the tiers in turn, cheapest first, until an estimate has penalties within the thresholds, the deadline has passed
+# or the last tier has been run. With the default tiers NNLS is good enough for most small products, cvxpy for most
+# others and differential evolution, which can take seconds, is only run for the products cvxpy does badly on.
+# Which tier produced the estimate is in recipe_estimator.tier, and the scores and time of each tier run in recipe_estimator.tiers
+def estimate_recipe(product, penalties=False, compiled=None, deadline=None, tiers=None, nutrient_threshold=None, order_threshold=None):
+    current = time.perf_counter()
+    compiled = get_compiled_recipe(product, compiled)
+    tiers = TIERS if tiers is None else tiers
+    nutrient_threshold = settings.AUTO_NUTRIENT_PENALTY if nutrient_threshold is None else nutrient_threshold
+    order_threshold = settings.AUTO_ORDER_PENALTY if order_threshold is None else order_threshold
+
+    initial = dict(product.get("recipe_estimator", {}))
+    args = None
+    tier_results = []
+    for tier in tiers:
+        start = time.perf_counter()
+        # So nothing is left over from the previous tier, e.g. the cvxpy solver after differential evolution
+        product["recipe_estimator"] = dict(initial)
+        TIER_ESTIMATORS[tier](product, compiled=compiled, deadline=deadline)
+        with span("score"):
+            if args is None:
+                # Doesn't depend on the estimates so is shared by the tiers
+                args = get_objective_function_args(product, compiled)[2]
+            tier_penalties, nutrient_penalty, order_penalty = score_estimate(product, args)
+        tier_results.append({
+            "method": tier,
+            "nutrient_penalty": nutrient_penalty,
+            "order_penalty": order_penalty,
+            "time": round(time.perf_counter() - start, 4),
+        })
+        if nutrient_penalty <= nutrient_threshold and order_penalty <= order_threshold:
+            break
+        if expired(deadline):
+            logger.debug("Product: %s, no time to escalate from %s", product.get("code"), tier)
+            break
+        logger.debug("Product: %s, %s nutrient penalty: %s, order penalty: %s", product.get("code"), tier, nutrient_penalty, order_penalty)
+
+    recipe_estimator = product["recipe_estimator"]
+    recipe_estimator["tier"] = tier
+    recipe_estimator["tiers"] = tier_results
+    set_outcome("tier", tier)
+    if penalties:
+        recipe_estimator["penalties"] = tier_penalties
+    recipe_estimator["time"] = round(time.perf_counter() - current, 2)
+    logger.info("Product: %s, time: %s s, tier: %s", product.get("code"), recipe_estimator["time"], tier)
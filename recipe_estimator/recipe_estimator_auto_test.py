@@ -0,0 +1,61 @@
+import time
+
+import pytest
+
+from .recipe_estimator_auto import estimate_recipe, get_tiers
+
+
+def make_product():
+    return {
+        'code': 'auto',
+        'ingredients': [
+            {'id': 'A', 'nutrients': {'fiber': {'percent_nom': 15, 'percent_min': 15, 'percent_max': 15}}},
+            {'id': 'B', 'nutrients': {'fiber': {'percent_nom': 3, 'percent_min': 3, 'percent_max': 3}}},
+        ],
+        'nutriments': {'fiber_100g': 10},
+    }
+
+
+def test_estimate_recipe_stops_at_first_good_enough_tier():
+    product = make_product()
+
+    estimate_recipe(product, tiers=['nnls', 'cvxpy', 'scipy'])
+
+    recipe_estimator = product['recipe_estimator']
+    assert recipe_estimator['tier'] == 'nnls'
+    assert [tier['method'] for tier in recipe_estimator['tiers']] == ['nnls']
+    assert recipe_estimator['tiers'][0]['nutrient_penalty'] < 1
+    assert 'penalties' not in recipe_estimator
+
+
+def test_estimate_recipe_escalates_above_thresholds():
+    product = make_product()
+
+    # The power series estimate is nowhere near the fiber content
+    estimate_recipe(product, penalties=True, tiers=['simple', 'cvxpy'], nutrient_threshold=1000)
+
+    recipe_estimator = product['recipe_estimator']
+    assert recipe_estimator['tier'] == 'cvxpy'
+    simple, cvxpy = recipe_estimator['tiers']
+    assert simple['nutrient_penalty'] > 1000
+    assert cvxpy['nutrient_penalty'] < simple['nutrient_penalty']
+    # Only the fields of the last tier
+    assert recipe_estimator['solver'] == 'clarabel'
+    assert recipe_estimator['penalties']['nutrient_penalty'] == cvxpy['nutrient_penalty']
+    assert abs(58.3 - product['ingredients'][0]['percent_estimate']) < 2
+
+
+def test_estimate_recipe_doesnt_escalate_after_deadline():
+    product = make_product()
+
+    estimate_recipe(product, tiers=['simple', 'cvxpy'], nutrient_threshold=1000, deadline=time.monotonic())
+
+    assert product['recipe_estimator']['tier'] == 'simple'
+
+
+def test_get_tiers():
+    assert get_tiers('nnls, cvxpy,scipy') == ['nnls', 'cvxpy', 'scipy']
+    with pytest.raises(ValueError):
+        get_tiers('nnls,glop')
+    with pytest.raises(ValueError):
+        get_tiers('')
@@ -1,15 +1,26 @@
+import logging
+import threading
 import time
+from collections import OrderedDict
+
 import cvxpy as cp
 import numpy as np
 
-from .fitness import get_objective_function_args, objective as objective_function
-
+from .compiled_recipe import get_compiled_recipe
+from .deadline import expired, remaining, set_deadline_exceeded
+from .fitness import get_penalties
 from .prepare_nutrients import prepare_nutrients
+from .spans import add_span, set_outcome, span
+
+logger = logging.getLogger(__name__)
 
 POWER = -1.7
 EVAPORATION_COST = 0.01
 UNKNOWN_INGREDIENT_WEIGHTING = 0.002
 
+# Maximum number of compiled problems to keep. Each one is specific to a shape of ingredient tree
+PROBLEM_CACHE_SIZE = 256
+
 
 def get_ingredient_range(ingredient_percentage):
     if int(ingredient_percentage) == ingredient_percentage:
@@ -20,54 +31,70 @@ def get_ingredient_range(ingredient_percentage):
         return ingredient_percentage - 0.25, ingredient_percentage + 0.25
 
 
+def has_child_ingredients(ingredient):
+    return "ingredients" in ingredient and len(ingredient["ingredients"]) > 0
+
+
+# The shape of the ingredient tree: for each ingredient whether it has a stated percentage and the shape of its children.
+# This is all that the constraints depend on, so products with the same structure can share a compiled problem
+def get_structure(ingredients):
+    return tuple(
+        (
+            ingredient.get("percent") is not None,
+            get_structure(ingredient["ingredients"]) if has_child_ingredients(ingredient) else None,
+        )
+        for ingredient in ingredients
+    )
+
+
+def count_leaves(structure):
+    return sum(1 if children is None else count_leaves(children) for _, children in structure)
+
+
+# water_losses gets the pre-mixing bowl water loss variable of each ingredient in pre-order (see CompiledRecipe), None if it has no stated percentage
 def add_ingredient_constraints(
-    ingredients,
+    structure,
     constraints,
-    leaf_ingredients,
     ingredient_quantities,
     water_proportions,
-    ingredient_vars,
+    percent_ranges,
+    water_losses,
+    leaf_ingredient_index=0,
 ):
     previous_ingredient_mixing_bowl_weight = None
     total_mixing_bowl_weight = []
-    for ingredient in ingredients:
-        # TODO: Remove hidden eventually
-        ingredient_percent = ingredient.get("percent")
-        my_index = len(leaf_ingredients)
-        ingredient_var = {
-            "ingredient": ingredient,
-            "percent": ingredient_percent,
-            "leaf_ingredient_index": my_index,
-        }
-        ingredient_vars.append(ingredient_var)
-        if "ingredients" in ingredient and len(ingredient["ingredients"]) > 0:
+    for has_percent, children in structure:
+        my_index = leaf_ingredient_index
+        my_position = len(water_losses)
+        water_losses.append(None)
+        if children is not None:
             # Child ingredients
-            ingredient_var["ingredients"] = []
-            my_mixing_bowl_weight = add_ingredient_constraints(
-                ingredient["ingredients"],
+            my_mixing_bowl_weight, leaf_ingredient_index = add_ingredient_constraints(
+                children,
                 constraints,
-                leaf_ingredients,
                 ingredient_quantities,
                 water_proportions,
-                ingredient_var["ingredients"],
+                percent_ranges,
+                water_losses,
+                leaf_ingredient_index,
             )
             # Keep a note of how many child ingredients make up the total for this parent ingredient
-            last_child_index = len(leaf_ingredients)
-            ingredient_var["last_child_index"] = last_child_index
+            last_child_index = leaf_ingredient_index
 
             # For compound ingredients, if there is a known percentage then assume there is water loss before the entire compound ingredient is added to the mixing bowl
-            if ingredient_percent is not None:
+            if has_percent:
                 # If we have a percentage for the ingredient then we add a pre-mixing bowl water loss variable
                 # TODO: Cope with re-hydrated ingredients, like concentrates, where the water loss would be negative
                 pre_mixing_bowl_water_loss = cp.Variable(nonneg=True)
                 # For UK/EU quantity of raw ingredient less pre-mixing bowl water should correspond to the percentage on the packaging
-                percent_min, percent_max = get_ingredient_range(ingredient_percent)
+                percent_min, percent_max = cp.Parameter(), cp.Parameter()
+                percent_ranges.append((percent_min, percent_max))
                 constraints.extend([
                     (cp.sum(my_mixing_bowl_weight) - pre_mixing_bowl_water_loss) >= percent_min,
                     (cp.sum(my_mixing_bowl_weight) - pre_mixing_bowl_water_loss) <= percent_max
                 ])
                 my_mixing_bowl_weight.append(-pre_mixing_bowl_water_loss)
-                ingredient_var["pre_mixing_bowl_water_loss"] = pre_mixing_bowl_water_loss
+                water_losses[my_position] = pre_mixing_bowl_water_loss
 
                 if last_child_index > my_index:
                     # If child ingredients were found then we add a constraint that the pre-mixing bowl water loss of the parent
@@ -78,20 +105,17 @@ def add_ingredient_constraints(
         else:
             my_quantity = ingredient_quantities[my_index]
             my_mixing_bowl_weight = [my_quantity]
-            leaf_ingredients.append(ingredient)
-            # Tried defaulting to a nominal value for water for unknown ingredients
-            # but didn't seem to help
-            water_proportion = ingredient["nutrients"].get("water", {}).get("percent_nom", 0) * 0.01
-            water_proportions.append(water_proportion)
+            leaf_ingredient_index += 1
 
-            if ingredient_percent is not None:
+            if has_percent:
                 # If we have a percentage for the ingredient then we add a pre-mixing bowl water loss variable
                 pre_mixing_bowl_water_loss = cp.Variable(nonneg=True)
-                ingredient_var["pre_mixing_bowl_water_loss"] = pre_mixing_bowl_water_loss
+                water_losses[my_position] = pre_mixing_bowl_water_loss
                 # For UK/EU quantity of raw ingredient less pre-mixing bowl water should correspond to the percentage on the packaging
-                percent_min, percent_max = get_ingredient_range(ingredient_percent)
+                percent_min, percent_max = cp.Parameter(), cp.Parameter()
+                percent_ranges.append((percent_min, percent_max))
                 constraints.extend([
-                    pre_mixing_bowl_water_loss <= my_quantity * water_proportion,
+                    pre_mixing_bowl_water_loss <= my_quantity * water_proportions[my_index],
                     (my_quantity - pre_mixing_bowl_water_loss) >= percent_min,
                     (my_quantity - pre_mixing_bowl_water_loss) <= percent_max
                 ])
@@ -103,114 +127,279 @@ def add_ingredient_constraints(
         total_mixing_bowl_weight.extend(my_mixing_bowl_weight)
         previous_ingredient_mixing_bowl_weight = my_mixing_bowl_weight
 
-    return total_mixing_bowl_weight
+    return total_mixing_bowl_weight, leaf_ingredient_index
+
+
+# Stated percentages, in the same order as the percent_ranges parameters created by add_ingredient_constraints,
+# which is the order of the compiled recipe's post_order as a parent's range comes after the ranges of its children
+def get_percent_ranges(compiled):
+    percents = compiled.percents.tolist()
+    return [get_ingredient_range(percents[i]) for i in compiled.post_order.tolist() if percents[i] == percents[i]]
+
+
+# A DPP-compliant problem for one ingredient tree structure. All product specific data are parameters so
+# CVXPY only needs to canonicalize the problem once, and subsequent products with the same structure just
+# bind new parameter values and re-solve.
+# Nutrient weightings are folded into the nutrient matrix and product totals (scaled by the square root of the weighting)
+# as multiplying a parameter by an expression that contains parameters is not DPP.
+class ProblemTemplate:
+    def __init__(self, structure, num_nutrients):
+        leaf_ingredient_count = count_leaves(structure)
+        self.lock = threading.Lock()
+        self.num_nutrients = num_nutrients
+        self.ingredient_quantities = cp.Variable(leaf_ingredient_count, nonneg=True)
+        self.water_proportions = cp.Parameter(leaf_ingredient_count, nonneg=True)
+        self.percent_ranges = []
+        self.water_losses = []
+        self.constraints = []
+        add_ingredient_constraints(
+            structure,
+            self.constraints,
+            self.ingredient_quantities,
+            self.water_proportions,
+            self.percent_ranges,
+            self.water_losses,
+        )
 
+        # Hard constraint: sum of ingredients less maximum water loss can't be greater than 100g
+        self.constraints.append(
+            cp.sum(self.ingredient_quantities) - (self.ingredient_quantities @ self.water_proportions)
+            <= 100
+        )
 
-def estimate_percentages(
-    ingredient_quantities, nutrient_objectives, simple_objectives, ingredients, simple_estimates, total=100.0, index=0, percent_unknown = 0
-):
-    # Each ingredient quantity = a * n ^ p
-    # where p is the POWER constant, n is the ingredient number and a is the percentage of the first ingredient
-    # We work out a by adding up all the results of the series with a = 1 and then factor a so that the total adds up to 100% (total)
-    num_ingredients = len(ingredients)
-    if num_ingredients < 1:
-        return 0, 100
-
-    raw_sum = sum([(n + 1.0) ** POWER for n in range(num_ingredients)])
-    a = total / raw_sum
-    for n, ingredient in enumerate(ingredients):
-        estimate = round(a * (n + 1.0) ** POWER, 2)
-
-        if "ingredients" in ingredient and len(ingredient["ingredients"]) > 0:
-            index, percent_unknown = estimate_percentages(
-                ingredient_quantities,
-                nutrient_objectives,
-                simple_objectives,
-                ingredient["ingredients"],
-                simple_estimates,
-                estimate,
-                index,
-                percent_unknown
-            )
-        else:
-            # If ingredient has no nutrient information then add an objective to keep close to the estimate
-            if len(ingredient["nutrients"]) == 0:
-                percent_unknown += estimate
-                nutrient_objectives.append(
-                    UNKNOWN_INGREDIENT_WEIGHTING
-                    * cp.square(ingredient_quantities[index] - estimate)
-                )
-            # Simple objectives are used if we find that going by nutrients doesn't work
-            simple_objectives.append(cp.square(ingredient_quantities[index] - estimate))
-            simple_estimates.append(estimate)
-            index += 1
-
-    return index, percent_unknown
-
-
-def set_percentages(solution_x, ingredient_vars, product_total_quantity):
-    total_mixing_bowl_quantity = 0
-    total_original_quantity = 0
-    for ingredient_var in ingredient_vars:
-        ingredient = ingredient_var["ingredient"]
-        pre_mixing_bowl_water_loss = ingredient_var.get("pre_mixing_bowl_water_loss")
+        self.estimates = cp.Parameter(leaf_ingredient_count)
+        # Square root of UNKNOWN_INGREDIENT_WEIGHTING for ingredients with no nutrient information, otherwise 0
+        self.unknown_weightings = cp.Parameter(leaf_ingredient_count, nonneg=True)
+        self.unknown_estimates = cp.Parameter(leaf_ingredient_count)
+        if num_nutrients:
+            self.weighted_ingredients_nutrients = cp.Parameter((num_nutrients, leaf_ingredient_count))
+            self.weighted_product_nutrients = cp.Parameter(num_nutrients)
+        self.problems = {}
+        # Used to choose the solver
+        self.leaf_ingredient_count = leaf_ingredient_count
+        self.water_loss_count = sum(water_loss is not None for water_loss in self.water_losses)
+        self.constraint_count = len(self.constraints)
+
+    # A problem for each objective and solver, as cvxpy compiles a problem for the solver it is solved with
+    # and would compile it again each time a different solver is used
+    def get_problem(self, name, solver=None):
+        # Problems are created on first use as most products never need the simple objectives
+        problem = self.problems.get((name, solver))
+        if problem is None:
+            ingredient_quantities = self.ingredient_quantities
+            # Get the ingredients to add up to close to 100g, which effectively adds a cost for evaporation.
+            # Could potentially adjust the weighting here depending on the food category
+            evaporation_cost = EVAPORATION_COST * cp.square(cp.sum(ingredient_quantities) - 100)
+            # Simple objectives keep all ingredients close to the inverse power series
+            simple_objective = cp.sum_squares(ingredient_quantities - self.estimates)
+            if name == "nutrients":
+                # Keep unknown ingredients close to the inverse power series
+                objectives = [cp.sum_squares(cp.multiply(self.unknown_weightings, ingredient_quantities) - self.unknown_estimates)]
+                if self.num_nutrients:
+                    # Main objective to match ingredient nutrients to product nutrients
+                    objectives.append(cp.sum_squares(self.weighted_ingredients_nutrients @ ingredient_quantities - self.weighted_product_nutrients))
+                objectives.append(evaporation_cost)
+            elif name == "simple":
+                objectives = [simple_objective, evaporation_cost]
+            else:
+                # Fallback if the nutrient approach didn't work. This has never included the evaporation cost
+                objectives = [simple_objective]
+            problem = cp.Problem(cp.Minimize(sum(objectives)), self.constraints)
+            self.problems[(name, solver)] = problem
+        return problem
+
+
+problem_cache = OrderedDict()
+problem_cache_lock = threading.Lock()
+problem_cache_stats = {"hits": 0, "misses": 0}
+
+
+# Solver backends, their settings and the name of their time limit setting (in seconds), in the order they are tried
+# if the first one doesn't find the optimal solution. Tolerances are tight enough for percentages estimated to
+# 2 decimal places. OSQP and SCS have higher iteration limits than the cvxpy defaults as they can need them when the
+# nutrients are badly scaled
+SOLVERS = {
+    "clarabel": (cp.CLARABEL, {"tol_gap_abs": 1e-7, "tol_gap_rel": 1e-7, "tol_feas": 1e-7}, "time_limit"),
+    "scs": (cp.SCS, {"eps_abs": 1e-5, "eps_rel": 1e-5, "max_iters": 20000}, "time_limit_secs"),
+    "osqp": (cp.OSQP, {"eps_abs": 1e-5, "eps_rel": 1e-5, "max_iter": 20000}, "time_limit"),
+}
+
+# Time limit in seconds given to a solver when the deadline has already passed, so it returns its first iterate
+MIN_TIME_LIMIT = 0.001
+
+# Maximum violation of the constraints for a solution that isn't optimal to be used when the deadline is exceeded
+FEASIBILITY_TOLERANCE = 1e-3
+
+# Problems up to this size without water loss variables are small enough for any of the solvers to be quick and reliable.
+# Calibrated with benchmarks.cvxpy_solvers: CLARABEL was as fast as SCS and faster than OSQP at every size in the corpus,
+# but OSQP and SCS ran out of iterations on some of the larger products with water losses
+SMALL_PROBLEM_LEAF_INGREDIENTS = 9
+SMALL_PROBLEM_CONSTRAINTS = 20
+
+
+# The solvers to try in turn until one finds the optimal solution, the given one first. With "auto" CLARABEL is tried
+# first, and OSQP isn't tried at all for larger problems or those with water loss variables as it was the slowest solver
+# for them and the most likely to fail
+def get_solvers(template, solver="auto"):
+    if solver == "auto" or solver is None:
+        small = (
+            template.leaf_ingredient_count <= SMALL_PROBLEM_LEAF_INGREDIENTS
+            and template.constraint_count <= SMALL_PROBLEM_CONSTRAINTS
+            and not template.water_loss_count
+        )
+        return [name for name in SOLVERS if small or name != "osqp"]
+    return [solver] + [other for other in SOLVERS if other != solver]
+
+
+# Returns the problem solved with the first of the solvers to find the optimal solution, or the last one tried, and the solver.
+# With a deadline each solver is limited to the time remaining, and no more solvers are tried once it has passed
+def solve(template, name, solvers, product, deadline=None):
+    for solver in solvers:
+        prob = template.get_problem(name, solver)
+        backend, options, time_limit_option = SOLVERS[solver]
+        time_limit = remaining(deadline)
+        if time_limit is not None:
+            options = {**options, time_limit_option: max(time_limit, MIN_TIME_LIMIT)}
+        try:
+            # Don't warm start from the previous product's solution. OSQP can then hit its iteration limit
+            with span("solve"):
+                prob.solve(solver=backend, warm_start=False, **options)
+        except cp.SolverError as e:
+            logger.debug("Product: %s, %s failed: %s", product.get("code"), solver, e)
+            continue
+        finally:
+            # Time cvxpy spent canonicalizing the problem (or just substituting the parameters once it has been compiled)
+            add_span("compile", prob.compilation_time or 0)
+        if prob.status == cp.OPTIMAL:
+            break
+        logger.debug("Product: %s, %s status: %s", product.get("code"), solver, prob.status)
+        if expired(deadline):
+            break
+    return prob, solver
+
+
+# Whether a problem that wasn't solved to optimality, e.g. because the solver ran out of time, has a usable solution
+def is_feasible(prob):
+    if prob.status not in cp.settings.SOLUTION_PRESENT:
+        return False
+    return all(np.max(constraint.violation(), initial=0) <= FEASIBILITY_TOLERANCE for constraint in prob.constraints)
+
+
+def get_problem_template(structure, num_nutrients):
+    key = (structure, num_nutrients)
+    with problem_cache_lock:
+        template = problem_cache.get(key)
+        if template is not None:
+            problem_cache.move_to_end(key)
+            problem_cache_stats["hits"] += 1
+            return template
+        problem_cache_stats["misses"] += 1
+
+    template = ProblemTemplate(structure, num_nutrients)
+    with problem_cache_lock:
+        template = problem_cache.setdefault(key, template)
+        while len(problem_cache) > PROBLEM_CACHE_SIZE:
+            problem_cache.popitem(last=False)
+    return template
+
+
+def get_problem_cache_info():
+    with problem_cache_lock:
+        return {**problem_cache_stats, "size": len(problem_cache), "maxsize": PROBLEM_CACHE_SIZE}
+
+
+def clear_problem_cache():
+    with problem_cache_lock:
+        problem_cache.clear()
+        problem_cache_stats["hits"] = 0
+        problem_cache_stats["misses"] = 0
+
+
+# Each ingredient quantity = a * n ^ p
+# where p is the POWER constant, n is the ingredient number and a is the percentage of the first ingredient
+# We work out a by adding up all the results of the series with a = 1 and then factor a so that the total adds up to 100%
+# (or the estimate of the parent ingredient). Returns the estimates of the leaf ingredients and the total of those with no nutrient information
+def estimate_percentages(compiled):
+    if not len(compiled):
+        return np.zeros(0), 100
+
+    raw_sums = {}
+    parents = compiled.parents.tolist()
+    positions = compiled.positions.tolist()
+    sibling_counts = compiled.sibling_counts.tolist()
+    estimates = []
+    for parent, position, num_ingredients in zip(parents, positions, sibling_counts):
+        raw_sum = raw_sums.get(num_ingredients)
+        if raw_sum is None:
+            raw_sum = raw_sums[num_ingredients] = sum([(n + 1.0) ** POWER for n in range(num_ingredients)])
+        total = 100.0 if parent < 0 else estimates[parent]
+        estimates.append(round(total / raw_sum * (position + 1.0) ** POWER, 2))
+
+    simple_estimates = np.array(estimates)[compiled.leaves]
+    # Ingredients with no nutrient information get an objective to keep them close to the estimate
+    percent_unknown = 0
+    for estimate, unknown in zip(simple_estimates.tolist(), compiled.unknown.tolist()):
+        if unknown:
+            percent_unknown += estimate
+    return simple_estimates, percent_unknown
+
+
+# Leaf quantities are the solution and the quantity of an ingredient with children is the total of theirs.
+# The mixing bowl quantity of each ingredient is its quantity less its pre-mixing bowl water loss and that of the ingredients it is made of
+def set_percentages(compiled, solution_x, water_losses, product_total_quantity):
+    count = len(compiled)
+    mixing_bowl_quantities = [0] * count
+    original_quantities = [0] * count
+    # Totals of the children of each ingredient
+    total_mixing_bowl_quantities = [0] * count
+    total_original_quantities = [0] * count
+    parents = compiled.parents.tolist()
+    leaf_starts = compiled.leaf_starts.tolist()
+    solution_x = list(solution_x)
+    # Children come before their parents in post-order, so the totals of a parent are complete when it is reached
+    for i in compiled.post_order.tolist():
+        pre_mixing_bowl_water_loss = water_losses[i]
         pre_mixing_bowl_water_loss_value = (
             pre_mixing_bowl_water_loss.value
             if pre_mixing_bowl_water_loss is not None
             and pre_mixing_bowl_water_loss.value is not None
             else 0
         )
-        if "ingredients" in ingredient_var:
-            index, mixing_bowl_quantity_estimate, original_quantity_estimate = set_percentages(
-                solution_x, ingredient_var["ingredients"], product_total_quantity
-            )
+        if compiled.ingredients[i].get("ingredients"):
             # Subtract the parent ingredient's pre-mixing bowl water loss from the mixing bowl quantity estimate of the child ingredients to get the mixing bowl estimate for the parent ingredient
-            mixing_bowl_quantity_estimate = mixing_bowl_quantity_estimate - pre_mixing_bowl_water_loss_value
+            mixing_bowl_quantity_estimate = total_mixing_bowl_quantities[i] - pre_mixing_bowl_water_loss_value
+            original_quantity_estimate = total_original_quantities[i]
         else:
-            index = ingredient_var["leaf_ingredient_index"]
-            raw_ingredient_quantity = solution_x[index]
-            original_quantity_estimate = raw_ingredient_quantity
+            original_quantity_estimate = solution_x[leaf_starts[i]]
             mixing_bowl_quantity_estimate = original_quantity_estimate - pre_mixing_bowl_water_loss_value
-
-        ingredient["percent_estimate"] = round(100 * mixing_bowl_quantity_estimate / product_total_quantity, 2)
-        ingredient["quantity_estimate"] = round(original_quantity_estimate, 2)
-        total_mixing_bowl_quantity += mixing_bowl_quantity_estimate
-        total_original_quantity += original_quantity_estimate
-
-    return index, total_mixing_bowl_quantity, total_original_quantity
+        mixing_bowl_quantities[i] = mixing_bowl_quantity_estimate
+        original_quantities[i] = original_quantity_estimate
+        parent = parents[i]
+        if parent >= 0:
+            total_mixing_bowl_quantities[parent] += mixing_bowl_quantity_estimate
+            total_original_quantities[parent] += original_quantity_estimate
+
+    compiled.write_back(
+        np.round(100 * np.array(mixing_bowl_quantities, dtype=float) / product_total_quantity, 2),
+        np.round(np.array(original_quantities, dtype=float), 2),
+    )
 
 
-def estimate_recipe(product):
+def estimate_recipe(product, penalties=False, compiled=None, solver="auto", deadline=None):
     current = time.perf_counter()
-    leaf_ingredient_count = prepare_nutrients(product, True)
-    ingredients = product["ingredients"]
+    compiled = get_compiled_recipe(product, compiled)
+    prepare_nutrients(product, True, compiled)
     recipe_estimator = product["recipe_estimator"]
     nutrients = recipe_estimator["nutrients"]
 
-    ingredients_nutrients = []
-    product_nutrients = []
-    leaf_ingredients = []
-    water_proportions = []
+    leaf_ingredients = compiled.leaf_ingredients
+    # Tried defaulting to a nominal value for water for unknown ingredients
+    # but didn't seem to help
+    water_proportions = compiled.water
 
-    ingredient_quantities = cp.Variable(leaf_ingredient_count, nonneg=True)
-    constraints = []
+    nutrient_keys = []
+    product_nutrients = []
     nutrient_weightings = []
-    ingredient_vars = []
-    add_ingredient_constraints(
-        ingredients,
-        constraints,
-        leaf_ingredients,
-        ingredient_quantities,
-        water_proportions,
-        ingredient_vars,
-    )
-
-    # Hard constraint: sum of ingredients less maximum water loss can't be greater than 100g
-    constraints.append(
-        cp.sum(ingredient_quantities) - (ingredient_quantities @ water_proportions)
-        <= 100
-    )
-
     for nutrient_key in nutrients:
         nutrient = nutrients[nutrient_key]
 
@@ -219,88 +408,98 @@ def estimate_recipe(product):
         if weighting == 0:
             continue
 
-        product_total = nutrient["product_total"]
-        product_nutrients.append(product_total)
+        nutrient_keys.append(nutrient_key)
+        product_nutrients.append(nutrient["product_total"])
         nutrient_weightings.append(weighting)
-        ingredient_nutrients = []
 
-        for i, ingredient in enumerate(leaf_ingredients):
-            ingredient_nutrient = ingredient["nutrients"].get(nutrient_key, {})
-            ingredient_nutrient_percent = ingredient_nutrient.get("percent_nom", 0)
-            ingredient_nutrients.append(ingredient_nutrient_percent * 0.01)
-
-        ingredients_nutrients.append(ingredient_nutrients)
-        
         # Tried adding a constraint that the minimum nutrient value for all ingredients can't exceed what is on the packaging
         # but it didn't improve the results
-    
-    # Need an np.array in the matrix multiplication below
-    ingredients_nutrients = np.array(ingredients_nutrients)
-    nutrient_objectives = []
-    simple_objectives = []
-    simple_estimates = []
+
+    # Nutrients x leaf ingredients matrix of the nominal nutrient proportions
+    ingredients_nutrients = compiled.gather(nutrient_keys) * 0.01
+    product_nutrients = np.array(product_nutrients)
+    nutrient_weightings = np.array(nutrient_weightings)
 
     # Add objective to keep unknown ingredients close to the inverse power series
-    # simple_objectives does this for all ingredients
-    _, percent_unknown = estimate_percentages(ingredient_quantities, nutrient_objectives, simple_objectives, ingredients, simple_estimates)
-
-    # Main objective to match ingredient nutrients to product nutrients
-    if product_nutrients:
-        residual = ingredients_nutrients @ ingredient_quantities - product_nutrients
-        nutrient_variance = cp.sum(nutrient_weightings @ cp.square(residual))
-        nutrient_objectives.append(nutrient_variance)
-
-        # Tried adding a penalty if not all ingredients are known to penalize results where
-        # the ingredient nutrients are greater than the product nutrients
-        # But it didn't offer any significant improvement
-
-    try_nutrients = percent_unknown < 10 and len(leaf_ingredients[0]["nutrients"])
-
-    # Don't bother with the nutrient approach if the first ingredient is unknown or too many others are unknown
-    objectives = nutrient_objectives if try_nutrients else simple_objectives
-    
-    # Get the ingredients to add up to close to 100g, which effectively adds a cost for evaporation.
-    # Could potentially adjust the weighting here depending on the food category
-    evaporation_cost = EVAPORATION_COST * cp.square(sum(ingredient_quantities) - 100)
-    objectives.append(evaporation_cost)
-
-    objective = cp.Minimize(sum(objectives))
-    prob = cp.Problem(objective, constraints)
-    prob.solve()
-
-    if product_nutrients:
-        if prob.status == cp.OPTIMAL:
-            nutrient_variance_value = nutrient_variance.value.item()
-            recipe_estimator["nutrient_variance"] = nutrient_variance_value
-
-        # If nutrient variance is too much then try again with the simple approach
-        if try_nutrients and (prob.status != cp.OPTIMAL or nutrient_variance_value > 2500):
-            objectives = simple_objectives
-            objective = cp.Minimize(sum(objectives))
-            prob = cp.Problem(objective, constraints)
-            prob.solve()
+    # simple_estimates does this for all ingredients
+    simple_estimates, percent_unknown = estimate_percentages(compiled)
+    unknown_weightings = np.where(compiled.unknown, UNKNOWN_INGREDIENT_WEIGHTING ** 0.5, 0)
+
+    def get_nutrient_variance(quantities):
+        return float(nutrient_weightings @ np.square(ingredients_nutrients @ quantities - product_nutrients))
+
+    with span("build"):
+        template = get_problem_template(compiled.structure, len(nutrient_keys))
+    with template.lock:
+        with span("parameters"):
+            template.water_proportions.value = water_proportions
+            for (percent_min, percent_max), (percent_min_value, percent_max_value) in zip(template.percent_ranges, get_percent_ranges(compiled)):
+                percent_min.value = percent_min_value
+                percent_max.value = percent_max_value
+            template.estimates.value = simple_estimates
+            template.unknown_weightings.value = unknown_weightings
+            template.unknown_estimates.value = unknown_weightings * simple_estimates
+            if len(nutrient_keys):
+                weighting_factors = np.sqrt(nutrient_weightings)
+                template.weighted_ingredients_nutrients.value = ingredients_nutrients * weighting_factors[:, None]
+                template.weighted_product_nutrients.value = product_nutrients * weighting_factors
+
+        try_nutrients = percent_unknown < 10 and len(leaf_ingredients[0]["nutrients"])
+
+        solvers = get_solvers(template, solver)
+        # Don't bother with the nutrient approach if the first ingredient is unknown or too many others are unknown
+        prob, solver_used = solve(template, "nutrients" if try_nutrients else "simple", solvers, product, deadline)
+
+        if len(nutrient_keys):
             if prob.status == cp.OPTIMAL:
-                recipe_estimator["nutrient_variance_simple"] = nutrient_variance.value.item()
+                nutrient_variance_value = get_nutrient_variance(template.ingredient_quantities.value)
+                recipe_estimator["nutrient_variance"] = nutrient_variance_value
+
+            # If nutrient variance is too much then try again with the simple approach
+            # Unless there is no time left
+            if try_nutrients and (prob.status != cp.OPTIMAL or nutrient_variance_value > 2500) and not expired(deadline):
+                logger.debug("Product: %s, nutrient solution status: %s, trying the simple approach", product.get("code"), prob.status)
+                set_outcome("fallback", "simple")
+                prob, solver_used = solve(template, "fallback", solvers, product, deadline)
+                if prob.status == cp.OPTIMAL:
+                    recipe_estimator["nutrient_variance_simple"] = get_nutrient_variance(template.ingredient_quantities.value)
+
+        deadline_result = None
+        if prob.status == cp.OPTIMAL:
+            solution_x = template.ingredient_quantities.value
+        elif (
+            expired(deadline)
+            and is_feasible(prob)
+            and len(nutrient_keys)
+            and get_nutrient_variance(template.ingredient_quantities.value) < get_nutrient_variance(simple_estimates)
+        ):
+            # The solver ran out of time, but where it got to is closer to the product nutrients than the simple estimates
+            solution_x = template.ingredient_quantities.value
+            deadline_result = "best_found"
+        else:
+            solution_x = simple_estimates
+            if expired(deadline):
+                deadline_result = "simple"
 
-    solution_x = ingredient_quantities.value if prob.status == cp.OPTIMAL else simple_estimates
-        
-    # In the UK/EU the percentage is the weight of raw product needed to produce 100g divided by the final weight (100g)
-    # In the US it is the weight of raw ingredient divided by the total weight of all raw ingredients
-    product_total_quantity = sum(solution_x) if recipe_estimator.get('might_be_us') else 100
+        # In the UK/EU the percentage is the weight of raw product needed to produce 100g divided by the final weight (100g)
+        # In the US it is the weight of raw ingredient divided by the total weight of all raw ingredients
+        product_total_quantity = sum(solution_x) if recipe_estimator.get('might_be_us') else 100
 
-    set_percentages(solution_x, ingredient_vars, product_total_quantity)
+        with span("set_percentages"):
+            set_percentages(compiled, solution_x, template.water_losses, product_total_quantity)
 
     # Calculate objective function so we can compare with SciPy
-    quantities = np.array(
-        [float(ingredient["quantity_estimate"]) for ingredient in leaf_ingredients]
-    )
-    [_, _, args] = get_objective_function_args(product)
-    objective_function(quantities, *args)
-    recipe_estimator["penalties"] = args[0]
+    if penalties:
+        recipe_estimator["penalties"] = get_penalties(product, compiled=compiled)
 
     recipe_estimator["status"] = 0 # TODO: Should probably have different status codes for different failure modes, e.g. not optimal vs unbounded vs infeasible
     recipe_estimator["status_message"] = prob.status
+    recipe_estimator["solver"] = solver_used
+    if deadline_result:
+        set_deadline_exceeded(recipe_estimator, deadline_result)
+    set_outcome("solver_status", prob.status)
     recipe_estimator["time"] = round(time.perf_counter() - current, 2)
+    logger.info("Product: %s, time: %s s, status: %s", product.get("code"), recipe_estimator["time"], prob.status)
 
     # Tried re-running the solver multiple times to get the minimum and maximum of each ingredient
     # But it had a significant performance penalty
@@ -1,5 +1,10 @@
 
-from recipe_estimator.recipe_estimator_cvxpy import estimate_recipe
+import time
+from types import SimpleNamespace
+
+from recipe_estimator import recipe_estimator_cvxpy
+
+from recipe_estimator.recipe_estimator_cvxpy import clear_problem_cache, estimate_recipe, get_problem_cache_info, get_solvers, get_structure, problem_cache
 
 
 def test_estimate_recipe_simple_recipe():
@@ -82,3 +87,98 @@ def test_estimate_recipe_subingredient_limits():
     proteins = product['ingredients'][1]
     # Percent estimate is as high a possible
     assert abs(50 - proteins.get('percent_estimate')) < 2
+
+
+def test_estimate_recipe_reuses_problem_for_same_structure():
+    clear_problem_cache()
+
+    def make_product(fiber):
+        return {
+            'code': 'test',
+            'ingredients': [
+                {
+                    'id':'A',
+                    'percent': 60,
+                    'nutrients': {
+                        'fiber': {'percent_nom': 15, 'percent_min': 15, 'percent_max': 15},
+                    }
+                },
+                {
+                    'id':'B',
+                    'nutrients': {
+                        'fiber': {'percent_nom': 3, 'percent_min': 3, 'percent_max': 3},
+                    }
+                }
+            ],
+            'nutriments': {
+                'fiber_100g': fiber,
+            }}
+
+    first = make_product(10)
+    estimate_recipe(first)
+    second = make_product(12)
+    estimate_recipe(second)
+
+    info = get_problem_cache_info()
+    assert info['misses'] == 1
+    assert info['hits'] == 1
+
+    # Parameters are re-bound for each product
+    assert abs(first['ingredients'][0]['percent_estimate'] - 59.5) < 0.1
+    assert abs(second['ingredients'][0]['percent_estimate'] - 60.5) < 0.1
+
+    # Re-binding parameters only works if the problem is DPP
+    template = next(iter(problem_cache.values()))
+    assert all(problem.is_dpp() for problem in template.problems.values())
+
+
+def test_get_structure_distinguishes_stated_percentages():
+    assert get_structure([{'id': 'A', 'percent': 10}, {'id': 'B'}]) == get_structure([{'id': 'C', 'percent': 20}, {'id': 'D'}])
+    assert get_structure([{'id': 'A', 'percent': 10}, {'id': 'B'}]) != get_structure([{'id': 'A'}, {'id': 'B'}])
+    assert get_structure([{'id': 'A', 'ingredients': []}]) == get_structure([{'id': 'A'}])
+    assert get_structure([{'id': 'A', 'ingredients': [{'id': 'B'}]}]) != get_structure([{'id': 'A'}])
+
+
+def test_get_solvers_chooses_from_problem_size():
+    small = SimpleNamespace(leaf_ingredient_count=3, constraint_count=5, water_loss_count=0)
+    assert get_solvers(small) == ['clarabel', 'scs', 'osqp']
+    # OSQP isn't tried for larger problems or those with water loss variables
+    assert get_solvers(SimpleNamespace(leaf_ingredient_count=30, constraint_count=45, water_loss_count=0)) == ['clarabel', 'scs']
+    assert get_solvers(SimpleNamespace(leaf_ingredient_count=3, constraint_count=5, water_loss_count=1)) == ['clarabel', 'scs']
+    # A requested solver is tried first, then the others
+    assert get_solvers(small, 'osqp') == ['osqp', 'clarabel', 'scs']
+
+
+def test_estimate_recipe_with_solver():
+    for solver in ['clarabel', 'osqp', 'scs']:
+        product = {
+            'code': 'solver',
+            'ingredients': [
+                {'id': 'A', 'nutrients': {'fiber': {'percent_nom': 15, 'percent_min': 15, 'percent_max': 15}}},
+                {'id': 'B', 'nutrients': {'fiber': {'percent_nom': 3, 'percent_min': 3, 'percent_max': 3}}},
+            ],
+            'nutriments': {'fiber_100g': 10},
+        }
+        estimate_recipe(product, solver=solver)
+        assert product['recipe_estimator']['solver'] == solver
+        assert abs(58.3 - product['ingredients'][0]['percent_estimate']) < 2
+
+
+def test_estimate_recipe_falls_back_to_simple_estimate_at_deadline(monkeypatch):
+    # So the solver has no time at all
+    monkeypatch.setattr(recipe_estimator_cvxpy, 'MIN_TIME_LIMIT', 1e-9)
+    product = {
+        'code': 'deadline',
+        'ingredients': [
+            {'id': 'A', 'nutrients': {'fiber': {'percent_nom': 15, 'percent_min': 15, 'percent_max': 15}}},
+            {'id': 'B', 'nutrients': {'fiber': {'percent_nom': 3, 'percent_min': 3, 'percent_max': 3}}},
+        ],
+        'nutriments': {'fiber_100g': 10},
+    }
+
+    estimate_recipe(product, solver='osqp', deadline=time.monotonic())
+
+    assert product['recipe_estimator']['status_message'] == 'deadline_exceeded'
+    assert product['recipe_estimator']['deadline_result'] == 'simple'
+    # The power series estimate
+    assert product['ingredients'][0]['percent_estimate'] == 76.47
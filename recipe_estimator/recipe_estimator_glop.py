@@ -1,261 +1,196 @@
+import logging
 import time  
 import numpy as np
 from ortools.linear_solver import pywraplp
 
-from .fitness import get_objective_function_args, objective as objective_function
+from .compiled_recipe import get_compiled_recipe
+from .deadline import expired, fall_back_to_simple, remaining, set_deadline_exceeded
+from .fitness import get_penalties
 
+from .log import TRACE
 from .prepare_nutrients import prepare_nutrients
 from .nutrients import ensure_float
+from .spans import set_outcome, span
 
-precision = 0.01
-
-
-def add_ingredients_to_solver(ingredients, solver, total_ingredients):
-    ingredient_numvars = []
-
-    for i,ingredient in enumerate(ingredients):
-
-        ingredient_numvar = {'ingredient': ingredient, 'numvar': solver.NumVar(0.0, solver.infinity(), '')}
-        ingredient_numvars.append(ingredient_numvar)
-        # TODO: Known percentage or stated range
-
-        if ingredient.get('ingredients'):
-            # Child ingredients
-            child_numvars = add_ingredients_to_solver(ingredient['ingredients'], solver, total_ingredients)
-
-            ingredient_numvar['child_numvars'] = child_numvars
-
-        else:
-            # Constrain water loss. If ingredient is 20% water then
-            # raw ingredient - lost water must be greater than 80
-            # ingredient - water_loss >= ingredient * (100 - water_ratio) / 100
-            # ingredient - water_loss >= ingredient - ingredient * water ratio / 100
-            # ingredient * water ratio / 100 - water_loss >= 0
-            
-            ingredient_numvar['lost_water'] = solver.NumVar(0, solver.infinity(), '')
-            water = ingredient['nutrients'].get('water', {})
-            maximum_water_content = water.get('percent_nom', 0)
-            print("maximum_water_content", ingredient['id'], maximum_water_content)
-
-            water_loss_ratio_constraint = solver.Constraint(0, solver.infinity(),  '')
-            water_loss_ratio_constraint.SetCoefficient(ingredient_numvar['numvar'], 0.01 * maximum_water_content)
-            water_loss_ratio_constraint.SetCoefficient(ingredient_numvar['lost_water'], -1.0)
-
-            total_ingredients.SetCoefficient(ingredient_numvar['numvar'], 1)
-            total_ingredients.SetCoefficient(ingredient_numvar['lost_water'], -1.0)
-            print("total_ingredients:", total_ingredients.name(), ingredient_numvar['ingredient']['id'])
-
-    return ingredient_numvars
-
-# Add constraints to ensure that the quantity of each ingredient is greater than or equal to the quantity of the next ingredient
-# and that the sum of children ingredients is equal to the parent ingredient
-def add_relative_constraints_on_ingredients(solver, parent_ingredient_numvar, ingredient_numvars):
-
-    # Constraint: parent_ingredient = sum(children_ingredients)
-    if (parent_ingredient_numvar is not None):
-        parent_ingredient_constraint = solver.Constraint(0, 0)
-        parent_ingredient_constraint.SetCoefficient(parent_ingredient_numvar['numvar'], 1)
-        print("parent_ingredient_constraint - parent :", parent_ingredient_constraint.name(), parent_ingredient_numvar['ingredient']['id'])
-        for i,ingredient_numvar in enumerate(ingredient_numvars):
-            parent_ingredient_constraint.SetCoefficient(ingredient_numvar['numvar'], -1)
-            print("parent_ingredient_constraint - child :", parent_ingredient_constraint.name(), ingredient_numvar['ingredient']['id'])
-
-    for i,ingredient_numvar in enumerate(ingredient_numvars):
-
-        # Relative constraints on consecutive ingredients        
-        if i < (len(ingredient_numvars) - 1):
-            # constraint: ingredient (i) - ingredient (i+1) >= 0
-            relative_constraint = solver.Constraint(0, solver.infinity())
-            relative_constraint.SetCoefficient(ingredient_numvar['numvar'], 1.0)
-            relative_constraint.SetCoefficient(ingredient_numvars[i+1]['numvar'], -1.0)
-            print("relative_constraint:", relative_constraint.name(), ingredient_numvar['ingredient']['id'], '>=', ingredient_numvars[i+1]['ingredient']['id'])
-        
-        # Recursively apply parent ingredient constraint and relative constraints to child ingredients
-        if 'child_numvars' in ingredient_numvar:
-            add_relative_constraints_on_ingredients(solver, ingredient_numvar, ingredient_numvar['child_numvars'])
-
-def add_to_relative_constraint(solver, relative_constraint, ingredient_numvar, coefficient):
-    if 'child_numvars' in ingredient_numvar:
-        child_numvars = ingredient_numvar['child_numvars']
-        for i,child_numvar in enumerate(child_numvars):
-            add_to_relative_constraint(solver, relative_constraint, child_numvar, coefficient)
-            if i < (len(child_numvars) - 1):
-                child_constraint = solver.Constraint(0, solver.infinity())
-                add_to_relative_constraint(solver, child_constraint, child_numvar, 1.0)
-                add_to_relative_constraint(solver, child_constraint, child_numvars[i+1], -1.0)
-    else:
-        print("relative_constraint:", relative_constraint.name(), ingredient_numvar['ingredient']['id'], coefficient)
-        relative_constraint.SetCoefficient(ingredient_numvar['numvar'], coefficient)
-
-# add maximum quantity constraints on some ingredients like en:salt (5g) and en:flavouring (1g)
-def add_maximum_quantity_constraints(solver, ingredient_numvars):
-    for ingredient_numvar in ingredient_numvars:
-        ingredient = ingredient_numvar['ingredient']
-        if ('child_numvars' in ingredient_numvar):
-            add_maximum_quantity_constraints(solver, ingredient_numvar['child_numvars'])
-        else:
-            # if ingredient['id'] == 'en:salt' or ingredient['id'] == 'en:sea-salt':
-            #     salt_constraint = solver.Constraint(0, 5)
-            #     salt_constraint.SetCoefficient(ingredient_numvar['numvar'], 1)
-            if ingredient['id'] == 'en:flavouring' or ingredient['id'] == 'en:natural-flavouring':
-                flavouring_constraint = solver.Constraint(0, 2)
-                flavouring_constraint.SetCoefficient(ingredient_numvar['numvar'], 1)
-            # if the ingredient is an additive (id starts with "en:e" + digits) then we set a maximum quantity of 1g
-            if ingredient['id'].startswith('en:e'):
-                additive_constraint = solver.Constraint(0, 2)
-                additive_constraint.SetCoefficient(ingredient_numvar['numvar'], 1)
-
-# add max limits on ingredients en:salt and en:sugar based on the sugars and salt nutrition facts of the product
-def add_maximum_limits_on_salt_sugar_and_fat(solver, ingredient_numvars, salt_constraint, sugars_constraint, fat_constraint):
-    for ingredient_numvar in ingredient_numvars:
-        ingredient = ingredient_numvar['ingredient']
-        if ('child_numvars' in ingredient_numvar):
-            add_maximum_limits_on_salt_sugar_and_fat(solver, ingredient_numvar['child_numvars'], salt_constraint, sugars_constraint, fat_constraint)
-        else:
-            # salt: ingredient id is en:salt or ends with -salt
-            if salt_constraint is not None:
-                if ingredient['id'] == 'en:salt' or ingredient['id'].endswith('-salt'):
-                    salt_constraint.SetCoefficient(ingredient_numvar['numvar'], 1)
-            # sugar: ingredient id is en:sugar or ends with -sugar
-            if sugars_constraint is not None:
-                if ingredient['id'] == 'en:sugar' or ingredient['id'].endswith('-sugar'):
-                   sugars_constraint.SetCoefficient(ingredient_numvar['numvar'], 1)
-            # oils: ingredient id ending with -oil, en:cocoa-butter
-            if fat_constraint is not None:
-                if ingredient['id'].endswith('-oil') or ingredient['id'] == 'en:cocoa-butter':
-                    fat_constraint.SetCoefficient(ingredient_numvar['numvar'], 1)
-                # fats: ingredient id ending with -fat
-                if ingredient['id'].endswith('-fat'):
-                    fat_constraint.SetCoefficient(ingredient_numvar['numvar'], 0.8)
-                # butter: min 80% fat
-                if ingredient['id'] == 'en:butter':
-                    fat_constraint.SetCoefficient(ingredient_numvar['numvar'], 0.8)
-                # butterfat: 90% fat
-                if ingredient['id'] == 'en:butterfat':
-                    fat_constraint.SetCoefficient(ingredient_numvar['numvar'], 0.9)
-
-
-# For each ingredient, get the quantity estimate from the solver (for leaf ingredients)
-# or sum the quantity estimates of the child ingredients (for non-leaf ingredients)
-def get_quantity_estimate(ingredient_numvars):
-    total_quantity = 0
-    quantity_estimate = 0
-    for ingredient_numvar in ingredient_numvars:
-        if ('child_numvars' in ingredient_numvar):
-            quantity_estimate = get_quantity_estimate(ingredient_numvar['child_numvars'])
-        else:
-            quantity_estimate = ingredient_numvar['numvar'].solution_value()
-            ingredient_numvar['ingredient']['lost_water'] = ingredient_numvar['lost_water'].solution_value()
-        
-        ingredient_numvar['ingredient']['quantity_estimate'] = quantity_estimate
-        total_quantity += quantity_estimate
+logger = logging.getLogger(__name__)
 
-    return total_quantity
-
-
-def set_percent_estimate(ingredients, total_quantity):
-    for ingredient in ingredients:
-        if ingredient.get('ingredients'):
-            set_percent_estimate(ingredient['ingredients'], total_quantity)
-
-        ingredient['percent_estimate'] = 100 * ingredient['quantity_estimate'] / total_quantity
-
-
-def add_nutrient_distance(ingredient_numvars, nutrient_key, positive_constraint, negative_constraint, weighting):
-    for ingredient_numvar in ingredient_numvars:
-        ingredient = ingredient_numvar['ingredient']
-        if 'child_numvars' in ingredient_numvar:
-            #print(ingredient['indent'] + ' - ' + ingredient['text'] + ':')
-            add_nutrient_distance(ingredient_numvar['child_numvars'], nutrient_key, positive_constraint, negative_constraint, weighting)
-        else:
-            # TODO: Figure out whether to do anything special with < ...
-            # Currently treat unknown nutrients as zero percent
-            ingredient_nutrient_percent =  ingredient['nutrients'].get(nutrient_key, {}).get('percent_nom', 0)
-            #print(ingredient['indent'] + ' - ' + ingredient['text'] + ' (' + ingredient['ciqual_code'] + ') : ' + str(ingredient_nutrient))
-            print("nutrient_distance:", ingredient['id'], nutrient_key, ingredient_nutrient_percent)
-            negative_constraint.SetCoefficient(ingredient_numvar['numvar'], ingredient_nutrient_percent / 100)
-            positive_constraint.SetCoefficient(ingredient_numvar['numvar'], ingredient_nutrient_percent / 100)
-
-
-# Add an objective to minimize the difference between the quantity of each ingredient and the next ingredient (and 0 for the last ingredient)
-def add_objective_to_minimize_maximum_distance_between_ingredients(solver, objective, weighting, ingredient_numvars):
-    
-    max_ingredients_distance = solver.NumVar(0, solver.infinity(), "max_ingredients_distance")
-
-    for i,ingredient_numvar in enumerate(ingredient_numvars):
-        
-        # constraint: ingredient(i) - ingredient(i+1) <= max_ingredients_distance
-        # can be expressed as: ingredient(i) - ingredient(i+1) - max_ingredients_distance <= 0
-        constraint = solver.Constraint(-solver.infinity(), 0)
-        constraint.SetCoefficient(ingredient_numvar['numvar'], 1)
-        if i < (len(ingredient_numvars) - 1):
-            constraint.SetCoefficient(ingredient_numvars[i+1]['numvar'], -1)
-            # for the last ingredient, we look at its distance to 0
-            # so the constraint is only ingredient(i) < max_ingredients_distance
-            # and we don't need add it to the constraint
-        constraint.SetCoefficient(max_ingredients_distance, -1)
-
-        # Apply recursively to child ingredients
-        if 'child_numvars' in ingredient_numvar:
-            add_objective_to_minimize_maximum_distance_between_ingredients(solver, objective, weighting, ingredient_numvar['child_numvars'])
-
-    objective.SetCoefficient(max_ingredients_distance, weighting)
+precision = 0.01
 
-# estimate_recipe_glop() uses a linear solver to estimate the quantities of all leaf ingredients (ingredients that don't have child ingredient)
-# The solver is used to minimise the difference between the sum of the nutrients in the leaf ingredients and the total nutrients in the product
-def estimate_recipe_glop(product):
-    current = time.perf_counter()
-    prepare_nutrients(product)
-    ingredients = product['ingredients']
-    recipe_estimator = product['recipe_estimator']
-    nutrients = recipe_estimator['nutrients']
-    
-    # Instantiate a Glop solver
-    solver = pywraplp.Solver.CreateSolver('GLOP')
-    if not solver:
-        return None
-    
-    # Total of leaf level ingredients must add up to at least 100
-    total_ingredients = solver.Constraint(100 - precision, 100 + precision, '')
-    ingredient_numvars = add_ingredients_to_solver(ingredients, solver, total_ingredients)
-
-    # Make sure nth ingredient > n+1 th ingredient
-    # add_relative_constraints_on_ingredients(solver, ingredient_numvars)
-
-    add_relative_constraints_on_ingredients(solver, None, ingredient_numvars)
-
-    add_maximum_quantity_constraints(solver, ingredient_numvars)
-
-    # maximum constraints on salt, sugar and fat based on their minimum content in some ingredients
-    # only add constraints if we have a corresponding nutrient value for the product
+# Solver status reported in the metrics
+STATUS_NAMES = {
+    pywraplp.Solver.OPTIMAL: "optimal",
+    pywraplp.Solver.FEASIBLE: "feasible",
+    pywraplp.Solver.INFEASIBLE: "infeasible",
+    pywraplp.Solver.UNBOUNDED: "unbounded",
+    pywraplp.Solver.ABNORMAL: "abnormal",
+    pywraplp.Solver.MODEL_INVALID: "model_invalid",
+    pywraplp.Solver.NOT_SOLVED: "not_solved",
+}
+
+
+# Per leaf ingredient and per nutrient values in the GLOP model, with the value each has in a newly created model
+RECIPE_VALUES = {
+    'water': 0,
+    'max_quantities': np.inf,
+    'limit_coefficients': 0,
+    'limits': np.inf,
+    'nutrient_matrix': 0,
+    'nutrient_totals': 0,
+    'nutrient_weightings': 0,
+}
+
+
+# Maximum quantity of some ingredients like en:flavouring, and the minimum proportion of salt, sugars and fat in others
+# which gives an upper limit on their quantity from the product's nutrition facts
+def get_ingredient_limits(ingredient_id):
+    max_quantity = np.inf
+    salt = sugars = fat = 0
+    # if ingredient_id == 'en:salt' or ingredient_id == 'en:sea-salt':
+    #     max_quantity = 5
+    if ingredient_id == 'en:flavouring' or ingredient_id == 'en:natural-flavouring':
+        max_quantity = 2
+    # if the ingredient is an additive (id starts with "en:e" + digits) then we set a maximum quantity of 1g
+    if ingredient_id.startswith('en:e'):
+        max_quantity = 2
+    # salt: ingredient id is en:salt or ends with -salt
+    if ingredient_id == 'en:salt' or ingredient_id.endswith('-salt'):
+        salt = 1
+    # sugar: ingredient id is en:sugar or ends with -sugar
+    if ingredient_id == 'en:sugar' or ingredient_id.endswith('-sugar'):
+        sugars = 1
+    # oils: ingredient id ending with -oil, en:cocoa-butter
+    if ingredient_id.endswith('-oil') or ingredient_id == 'en:cocoa-butter':
+        fat = 1
+    # fats: ingredient id ending with -fat
+    if ingredient_id.endswith('-fat'):
+        fat = 0.8
+    # butter: min 80% fat
+    if ingredient_id == 'en:butter':
+        fat = 0.8
+    # butterfat: 90% fat
+    if ingredient_id == 'en:butterfat':
+        fat = 0.9
+    return max_quantity, (salt, sugars, fat)
+
+
+# Everything the GLOP model is built from as flat arrays. The ingredient tree (taken from the CompiledRecipe) and the number of nutrients
+# determine the structure of the model. The RECIPE_VALUES can be changed and applied to an existing model with GlopModel.update
+def flatten_product(product, compiled=None):
+    compiled = get_compiled_recipe(product, compiled)
+    recipe = {
+        'ingredients': compiled.ingredients,
+        'parents': compiled.parents.tolist(),
+        'leaf_starts': compiled.leaf_starts.tolist(),
+        'leaf_ends': compiled.leaf_ends.tolist(),
+        'leaves': compiled.leaf_ingredients,
+    }
+    leaves = recipe['leaves']
+
+    # Nutrients without a weighting are left out of the model
+    nutrients = product['recipe_estimator']['nutrients']
+    nutrient_keys = [nutrient_key for nutrient_key, nutrient in nutrients.items() if nutrient.get('weighting')]
+    if logger.isEnabledFor(TRACE):
+        for nutrient_key in nutrients:
+            if nutrient_key not in nutrient_keys:
+                logger.log(TRACE, "Skipping nutrient without weight: %s", nutrient_key)
+    recipe['nutrient_keys'] = nutrient_keys
+    recipe['nutrient_totals'] = np.array([nutrients[nutrient_key]['product_total'] for nutrient_key in nutrient_keys], dtype=float)
+    recipe['nutrient_weightings'] = np.array([nutrients[nutrient_key]['weighting'] for nutrient_key in nutrient_keys], dtype=float)
+
+    # TODO: Figure out whether to do anything special with < ...
+    # Currently treat unknown nutrients as zero percent
+    recipe['nutrient_matrix'] = compiled.gather(nutrient_keys) / 100
+    recipe['water'] = compiled.gather(['water'])[0]
+
+    limits = [get_ingredient_limits(leaf['id']) for leaf in leaves]
+    recipe['max_quantities'] = np.array([max_quantity for max_quantity, _ in limits], dtype=float)
+    recipe['limit_coefficients'] = np.array([coefficients for _, coefficients in limits], dtype=float).reshape(len(leaves), 3).T
+
+    # Maximum limits on salt, sugar and fat are only applied if we have a corresponding nutrient value for the product
     nutriments = product.get('nutriments', {})
+    recipe['limits'] = np.array([
+        np.inf if nutriments.get(nutriment) is None else ensure_float(nutriments[nutriment])
+        for nutriment in ('salt_100g', 'sugars_100g', 'fat_100g')
+    ])
+
+    if logger.isEnabledFor(TRACE):
+        for leaf, water in zip(leaves, recipe['water']):
+            logger.log(TRACE, "maximum_water_content %s %s", leaf['id'], water)
+        for nutrient_key, nutrient_total, weighting in zip(nutrient_keys, recipe['nutrient_totals'], recipe['nutrient_weightings']):
+            logger.log(TRACE, "nutrient_key: %s nutrient_total: %s weighting: %s", nutrient_key, nutrient_total, weighting)
+    return recipe
+
+
+def get_model_structure(recipe):
+    return tuple(recipe['parents']), len(recipe['nutrient_keys'])
+
+
+# A GLOP linear program for one ingredient tree structure, created in a single pass over the flattened recipe.
+# Ingredients with children don't have variables of their own. Their quantity is the sum of their contiguous range of leaf ingredients.
+# The per leaf ingredient and per nutrient values are then set with update, which only changes the coefficients and bounds that differ
+# from the last update, so the same model can be re-solved for variations of a product, e.g. for sensitivity analysis
+class GlopModel:
+    def __init__(self, recipe):
+        self.structure = get_model_structure(recipe)
+        self.solver = solver = pywraplp.Solver.CreateSolver('GLOP')
+        if not solver:
+            raise RuntimeError("GLOP solver is not available")
+        infinity = solver.infinity()
+        objective = solver.Objective()
+        leaf_count = len(recipe['leaves'])
+        leaf_starts = recipe['leaf_starts']
+        leaf_ends = recipe['leaf_ends']
+
+        self.quantities = [solver.NumVar(0.0, infinity, '') for _ in range(leaf_count)]
+        self.lost_water = [solver.NumVar(0.0, infinity, '') for _ in range(leaf_count)]
+
+        def add_ingredient(constraint, index, coefficient):
+            for quantity in self.quantities[leaf_starts[index]:leaf_ends[index]]:
+                constraint.SetCoefficient(quantity, coefficient)
+
+        # Total of leaf level ingredients less lost water must add up to 100
+        total_ingredients = solver.Constraint(100 - precision, 100 + precision, '')
+        # Constrain water loss. If ingredient is 20% water then
+        # raw ingredient - lost water must be greater than 80
+        # ingredient - water_loss >= ingredient * (100 - water_ratio) / 100
+        # ingredient - water_loss >= ingredient - ingredient * water ratio / 100
+        # ingredient * water ratio / 100 - water_loss >= 0
+        self.water_constraints = []
+        for quantity, lost_water in zip(self.quantities, self.lost_water):
+            total_ingredients.SetCoefficient(quantity, 1)
+            total_ingredients.SetCoefficient(lost_water, -1)
+            water_loss_ratio_constraint = solver.Constraint(0, infinity, '')
+            water_loss_ratio_constraint.SetCoefficient(lost_water, -1)
+            self.water_constraints.append(water_loss_ratio_constraint)
+
+        # Each ingredient must be greater than or equal to the next ingredient with the same parent. We also minimise the maximum
+        # difference between consecutive ingredients (and 0 for the last ingredient) for each group of ingredients
+        previous_ingredients = {}
+        max_ingredients_distances = {}
+        for index, parent in enumerate(recipe['parents']):
+            if parent not in max_ingredients_distances:
+                max_ingredients_distances[parent] = solver.NumVar(0, infinity, '')
+                objective.SetCoefficient(max_ingredients_distances[parent], 0.005)
+            previous = previous_ingredients.get(parent)
+            if previous is not None:
+                # constraint: ingredient(i) - ingredient(i+1) >= 0
+                relative_constraint = solver.Constraint(0, infinity, '')
+                add_ingredient(relative_constraint, previous, 1)
+                add_ingredient(relative_constraint, index, -1)
+                # constraint: ingredient(i) - ingredient(i+1) - max_ingredients_distance <= 0
+                distance_constraint = solver.Constraint(-infinity, 0, '')
+                add_ingredient(distance_constraint, previous, 1)
+                add_ingredient(distance_constraint, index, -1)
+                distance_constraint.SetCoefficient(max_ingredients_distances[parent], -1)
+            previous_ingredients[parent] = index
+        for parent, last in previous_ingredients.items():
+            # for the last ingredient, we look at its distance to 0
+            distance_constraint = solver.Constraint(-infinity, 0, '')
+            add_ingredient(distance_constraint, last, 1)
+            distance_constraint.SetCoefficient(max_ingredients_distances[parent], -1)
 
-    salt_constraint = None
-    salt = nutriments.get('salt_100g')
-    if salt is not None:
-        salt_constraint = solver.Constraint(0, ensure_float(salt))
-
-    sugars_constraint = None
-    sugars = nutriments.get('sugars_100g')
-    if sugars is not None:
-        sugars_constraint = solver.Constraint(0, ensure_float(sugars))
-
-    fat_constraint = None
-    fat = nutriments.get('fat_100g')
-    if fat is not None:
-        fat_constraint = solver.Constraint(0, ensure_float(fat))
-
-    add_maximum_limits_on_salt_sugar_and_fat(solver, ingredient_numvars, salt_constraint, sugars_constraint, fat_constraint)
-
-    objective = solver.Objective()
-    for nutrient_key in nutrients:
-        nutrient = nutrients[nutrient_key]
-
-        weighting = nutrient.get('weighting')
-        # Skip nutrients that don't have a weighting
-        if weighting is None or weighting == 0:
-            print("Skipping nutrient without weight:", nutrient_key)
-            continue
+        # Upper limits on the salt, sugar and fat ingredients from the product's nutrition facts
+        self.limit_constraints = [solver.Constraint(0, infinity, '') for _ in range(3)]
 
         # We want to minimise the absolute difference between the sum of the ingredient nutrients and the total nutrients
         # Ni: Nutrient content of ingredient i
@@ -264,80 +199,176 @@ def estimate_recipe_glop(product):
         # However we can't do absolute as it isn't linear
         # We get around this by introducing a nutrient distance variable that has to be positive
         # This is achieved by setting the following constraints:
-        #    Ndist >= (Sum(Ni) - Ntot) 
-        #    Ndist >= -(Sum(Ni) - Ntot) 
+        #    Ndist >= (Sum(Ni) - Ntot)
+        #    Ndist >= -(Sum(Ni) - Ntot)
         # or
-        #    Negative constraint:  -infinity < ( sum(Ni) - Ndist ) <= Ntot 
+        #    Negative constraint:  -infinity < ( sum(Ni) - Ndist ) <= Ntot
         #    Positive constraint:  +infinity > ( sum(Ni) + Ndist ) >= Ntot
-        #
+        self.nutrient_distances = []
+        self.negative_constraints = []
+        self.positive_constraints = []
+        for nutrient_key in recipe['nutrient_keys']:
+            nutrient_distance = solver.NumVar(0, infinity, nutrient_key)
+            negative_constraint = solver.Constraint(-infinity, 0, '')
+            negative_constraint.SetCoefficient(nutrient_distance, -1)
+            positive_constraint = solver.Constraint(0, infinity, '')
+            positive_constraint.SetCoefficient(nutrient_distance, 1)
+            self.nutrient_distances.append(nutrient_distance)
+            self.negative_constraints.append(negative_constraint)
+            self.positive_constraints.append(positive_constraint)
+
+        objective.SetMinimization()
+
+        # Have had to keep increasing this until we get a solution for a good set of products
+        # Not sure what the correct approach is here
+        solver.SetSolverSpecificParametersAsString("solution_feasibility_tolerance:1e5")
+
+        # Following may be an alternative (haven't tried yet)
+        #solver_parameters = pywraplp.MPSolverParameters()
+        #solver_parameters.SetDoubleParam(pywraplp.MPSolverParameters.PRIMAL_TOLERANCE, 0.001)
+        #status = solver.Solve(solver_parameters)
+
+        #solver.EnableOutput()
+
+        self.values = {
+            key: np.full(np.shape(recipe[key]), default, dtype=float)
+            for key, default in RECIPE_VALUES.items()
+        }
+        self.update(recipe)
+
+    def update(self, recipe):
+        if get_model_structure(recipe) != self.structure:
+            raise ValueError("Recipe does not have the same structure as the model")
+
+        def changed(key):
+            value = recipe[key]
+            indices = np.argwhere(value != self.values[key])
+            self.values[key] = np.array(value, dtype=float)
+            return indices, value
+
+        indices, water = changed('water')
+        for (i,) in indices:
+            self.water_constraints[i].SetCoefficient(self.quantities[i], 0.01 * water[i])
+
+        indices, max_quantities = changed('max_quantities')
+        for (i,) in indices:
+            self.quantities[i].SetUb(max_quantities[i])
+
+        indices, limit_coefficients = changed('limit_coefficients')
+        for k, i in indices:
+            self.limit_constraints[k].SetCoefficient(self.quantities[i], limit_coefficients[k, i])
+
+        indices, limits = changed('limits')
+        for (k,) in indices:
+            self.limit_constraints[k].SetUb(limits[k])
+
         # If the nutrition information about the ingredient is a range of value then use the higher value
         # on the positive constraint and the lower value on the negative constraint as this will make it "easier"
         # to meet these constraints
         #
         # Conversely, if the product nutrition value (Ntot) has a range then use the higher value on the negative
         # constraint and a lower value on the positive constraint
+        indices, nutrient_matrix = changed('nutrient_matrix')
+        for k, i in indices:
+            self.negative_constraints[k].SetCoefficient(self.quantities[i], nutrient_matrix[k, i])
+            self.positive_constraints[k].SetCoefficient(self.quantities[i], nutrient_matrix[k, i])
+        if logger.isEnabledFor(TRACE):
+            for k, i in indices:
+                logger.log(TRACE, "nutrient_distance: %s %s %s", recipe['leaves'][i]['id'], recipe['nutrient_keys'][k], nutrient_matrix[k, i])
+
+        indices, nutrient_totals = changed('nutrient_totals')
+        for (k,) in indices:
+            self.negative_constraints[k].SetUb(nutrient_totals[k])
+            self.positive_constraints[k].SetLb(nutrient_totals[k])
+
+        indices, nutrient_weightings = changed('nutrient_weightings')
+        objective = self.solver.Objective()
+        for (k,) in indices:
+            objective.SetCoefficient(self.nutrient_distances[k], nutrient_weightings[k])
+
+    # time_limit is in seconds. The limit applies to each solve, 0 or None meaning no limit
+    def solve(self, time_limit=None):
+        self.solver.SetTimeLimit(int(1000 * time_limit) if time_limit else 0)
+        return self.solver.Solve()
+
+    def get_solution(self):
+        return (
+            np.array([quantity.solution_value() for quantity in self.quantities]),
+            np.array([lost_water.solution_value() for lost_water in self.lost_water]),
+        )
+
+
+# Quantity estimate of each ingredient is the sum of its leaf ingredients
+def set_quantity_estimates(recipe, quantities, lost_water):
+    cumulative_quantities = np.concatenate(([0], np.cumsum(quantities)))
+    for ingredient, leaf_start, leaf_end in zip(recipe['ingredients'], recipe['leaf_starts'], recipe['leaf_ends']):
+        ingredient['quantity_estimate'] = float(cumulative_quantities[leaf_end] - cumulative_quantities[leaf_start])
+    for leaf, leaf_lost_water in zip(recipe['leaves'], lost_water):
+        leaf['lost_water'] = float(leaf_lost_water)
+    return float(cumulative_quantities[-1])
 
-        nutrient_total = nutrient['product_total']
-
-        nutrient_distance = solver.NumVar(0, solver.infinity(), nutrient_key)
 
-        # not sure this is right as if one ingredient is way over and another is way under
-        # then will give a good result
-        negative_constraint = solver.Constraint(-solver.infinity(), nutrient_total)
-        negative_constraint.SetCoefficient(nutrient_distance, -1)
-        positive_constraint = solver.Constraint(nutrient_total, solver.infinity())
-        positive_constraint.SetCoefficient(nutrient_distance, 1)
-        add_nutrient_distance(ingredient_numvars, nutrient_key, positive_constraint, negative_constraint, weighting)
-
-        print("nutrient_key:", nutrient_key, "nutrient_total:", nutrient_total, "weighting:", weighting)
-        objective.SetCoefficient(nutrient_distance, weighting)
-
-    add_objective_to_minimize_maximum_distance_between_ingredients(solver, objective, 0.005, ingredient_numvars)
-
-    objective.SetMinimization()
+def set_percent_estimate(ingredients, total_quantity):
+    for ingredient in ingredients:
+        ingredient['percent_estimate'] = 100 * ingredient['quantity_estimate'] / total_quantity
 
-    # Have had to keep increasing this until we get a solution for a good set of products
-    # Not sure what the correct approach is here
-    solver.SetSolverSpecificParametersAsString("solution_feasibility_tolerance:1e5")
 
-    # Following may be an alternative (haven't tried yet)
-    #solver_parameters = pywraplp.MPSolverParameters()
-    #solver_parameters.SetDoubleParam(pywraplp.MPSolverParameters.PRIMAL_TOLERANCE, 0.001)
-    #status = solver.Solve(solver_parameters)
-    
-    #solver.EnableOutput()
+# estimate_recipe_glop() uses a linear solver to estimate the quantities of all leaf ingredients (ingredients that don't have child ingredient)
+# The solver is used to minimise the difference between the sum of the nutrients in the leaf ingredients and the total nutrients in the product
+def estimate_recipe_glop(product, penalties=False, compiled=None, deadline=None):
+    current = time.perf_counter()
+    compiled = get_compiled_recipe(product, compiled)
+    prepare_nutrients(product, compiled=compiled)
+    recipe_estimator = product['recipe_estimator']
 
-    status = solver.Solve()
+    with span("build"):
+        recipe = flatten_product(product, compiled)
+        model = GlopModel(recipe)
+    time_limit = remaining(deadline)
+    with span("solve"):
+        # At least 1 ms, as 0 would be no limit
+        status = model.solve(None if time_limit is None else max(time_limit, 0.001))
+    set_outcome("solver_status", STATUS_NAMES.get(status, str(status)))
 
     # Check that the problem has an optimal solution.
-    if status == solver.OPTIMAL:
-        print('An optimal solution was found in', solver.iterations(), 'iterations')
+    if status == pywraplp.Solver.OPTIMAL:
+        logger.debug("Product: %s, an optimal solution was found in %s iterations", product.get('code'), model.solver.iterations())
     else:
-        if status == solver.FEASIBLE:
-            print('A potentially suboptimal solution was found in', solver.iterations(), 'iterations')
+        if status == pywraplp.Solver.FEASIBLE:
+            logger.warning("Product: %s, a potentially suboptimal solution was found in %s iterations", product.get('code'), model.solver.iterations())
+            if expired(deadline):
+                set_deadline_exceeded(recipe_estimator, "best_found")
+        elif expired(deadline):
+            logger.warning("Product: %s, the solver ran out of time, using the simple estimate", product.get('code'))
+            fall_back_to_simple(product)
+            recipe_estimator['time'] = time.perf_counter() - current
+            recipe_estimator['status'] = status
+            if penalties:
+                recipe_estimator['penalties'] = get_penalties(product, compiled=compiled)
+            return status
         else:
-            print('The solver could not solve the problem.')
+            logger.warning("Product: %s, the solver could not solve the problem", product.get('code'))
+            return status
+
+    with span("set_percentages"):
+        quantities, lost_water = model.get_solution()
+        total_quantity = set_quantity_estimates(recipe, quantities, lost_water)
+        if (total_quantity == 0):
+            logger.warning("Product: %s, no leaf ingredients found, cannot estimate recipe", product.get('code'))
             return status
 
-    total_quantity = get_quantity_estimate(ingredient_numvars)
-    if (total_quantity == 0):
-        print("No leaf ingredients found, cannot estimate recipe")
-        return status
-    
-    set_percent_estimate(ingredients, total_quantity)
+        set_percent_estimate(recipe['ingredients'], total_quantity)
 
     end = time.perf_counter()
     recipe_estimator['time'] = end - current
     recipe_estimator['status'] = status
-    recipe_estimator['iterations'] = solver.iterations()
+    recipe_estimator['iterations'] = model.solver.iterations()
 
-    print('Time spent in solver: ', recipe_estimator['time'], 'seconds')
+    logger.info("Product: %s, time: %s s, iterations: %s", product.get('code'), recipe_estimator['time'], recipe_estimator['iterations'])
 
     # Calculate objective function so we can compare with SciPy
-    [_, leaf_ingredients, args] = get_objective_function_args(product)
-    quantities = np.array([float(ingredient['quantity_estimate']) for ingredient in leaf_ingredients])
-    objective_function(quantities, *args)
-    recipe_estimator['penalties'] = args[0]
+    if penalties:
+        recipe_estimator['penalties'] = get_penalties(product, compiled=compiled)
 
 
     return status
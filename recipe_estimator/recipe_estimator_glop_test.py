@@ -1,5 +1,8 @@
 import json
-from .recipe_estimator_glop import estimate_recipe_glop
+import numpy as np
+import pytest
+from .prepare_nutrients import prepare_nutrients
+from .recipe_estimator_glop import GlopModel, estimate_recipe_glop, flatten_product
 
 def test_estimate_recipe_accounts_for_lost_water():
     product = {
@@ -371,3 +374,81 @@ def test_estimate_recipe_minimize_maximum_distance_between_ingredients_with_subi
     assert 40 < product['ingredients'][0]['ingredients'][0]['percent_estimate'] < 50 # 44.4
     assert 20 < product['ingredients'][0]['ingredients'][1]['percent_estimate'] < 25 # 22.2
     assert 30 < product['ingredients'][1]['percent_estimate'] < 40 # 33.3
+
+
+def get_nested_product():
+    return {
+        'code' : 1234567890123,
+        'ingredients': [
+            {
+                'id':'en:tomato',
+                'nutrients': {
+                    'fiber': {'percent_nom': 5},
+                    'water': {'percent_nom': 90},
+                }
+            },
+            {
+                'id':'en:sugar-and-salt',
+                'ingredients': [
+                    {'id':'en:sugar', 'nutrients': {'sugars': {'percent_nom': 100}}},
+                    {'id':'en:salt', 'nutrients': {'salt': {'percent_nom': 100}}},
+                ]
+            },
+            {
+                'id':'en:flavouring',
+                'nutrients': {}
+            }
+        ],
+        'nutriments': {
+            'fiber_100g': 5,
+            'sugars_100g': 10,
+        }}
+
+
+def test_flatten_product():
+    product = get_nested_product()
+    prepare_nutrients(product)
+    recipe = flatten_product(product)
+
+    assert [ingredient['id'] for ingredient in recipe['ingredients']] == ['en:tomato', 'en:sugar-and-salt', 'en:sugar', 'en:salt', 'en:flavouring']
+    assert recipe['parents'] == [-1, -1, 1, 1, -1]
+    assert recipe['leaf_starts'] == [0, 1, 1, 2, 3]
+    assert recipe['leaf_ends'] == [1, 3, 2, 3, 4]
+    assert [leaf['id'] for leaf in recipe['leaves']] == ['en:tomato', 'en:sugar', 'en:salt', 'en:flavouring']
+    assert list(recipe['water']) == [90, 0, 0, 0]
+    assert list(recipe['max_quantities']) == [np.inf, np.inf, np.inf, 2]
+    # Salt limit only applies if the product has a salt value
+    assert list(recipe['limits']) == [np.inf, 10, np.inf]
+    assert recipe['limit_coefficients'].tolist() == [[0, 0, 1, 0], [0, 1, 0, 0], [0, 0, 0, 0]]
+
+    fiber = recipe['nutrient_keys'].index('fiber')
+    assert list(recipe['nutrient_matrix'][fiber]) == [0.05, 0, 0, 0]
+
+
+def test_glop_model_update_matches_new_model():
+    product = get_nested_product()
+    prepare_nutrients(product)
+    recipe = flatten_product(product)
+    model = GlopModel(recipe)
+    model.solve()
+
+    recipe['nutrient_totals'] = recipe['nutrient_totals'] * 1.1
+    recipe['water'] = np.array([80.0, 0, 0, 0])
+    recipe['limits'] = np.array([1.0, 10, np.inf])
+    model.update(recipe)
+    model.solve()
+
+    new_model = GlopModel(recipe)
+    new_model.solve()
+    assert model.solver.Objective().Value() == pytest.approx(new_model.solver.Objective().Value())
+    assert model.get_solution()[0] == pytest.approx(new_model.get_solution()[0])
+
+
+def test_glop_model_update_rejects_different_structure():
+    product = get_nested_product()
+    prepare_nutrients(product)
+    model = GlopModel(flatten_product(product))
+
+    product['ingredients'].pop()
+    with pytest.raises(ValueError):
+        model.update(flatten_product(product))
@@ -1,14 +1,43 @@
+import logging
 import time
 import warnings
 import numpy
 from scipy.optimize import nnls
 
 
-from .fitness import get_objective_function_args, objective, NUTRIENT_WITHIN_BOUNDS_PENALTY, TOTAL_MASS_MORE_THAN_100_PENALTY
+from .compiled_recipe import get_compiled_recipe
+from .fitness import get_objective_function_args, get_penalties, NUTRIENT_WITHIN_BOUNDS_PENALTY, TOTAL_MASS_MORE_THAN_100_PENALTY
+from .spans import span
 
-def estimate_recipe(product):
+logger = logging.getLogger(__name__)
+
+
+# Solve with the passive set (non-zero variables) from a previous solution. If the result is still optimal, i.e. all of the
+# passive variables are positive and the gradient shows no benefit from increasing any of the others, then this is the
+# NNLS solution without needing to search for the active set. Returns None if nnls needs to be run
+def warm_start_nnls(A, b, previous_solution):
+    previous_solution = numpy.asarray(previous_solution)
+    if previous_solution.shape != (A.shape[1],):
+        return None
+    passive = previous_solution > 0
+    solution = numpy.zeros(A.shape[1])
+    if passive.any():
+        solution[passive] = numpy.linalg.lstsq(A[:, passive], b, rcond=None)[0]
+        if (solution[passive] <= 0).any():
+            return None
+    residual = b - A @ solution
+    gradient = A.T @ residual
+    if (gradient[~passive] > 1e-10 * max(1, numpy.abs(gradient).max())).any():
+        return None
+    return solution, numpy.linalg.norm(residual)
+
+
+# warm_start can be the solution returned by a previous call for the same ingredients, e.g. after a small edit to the product.
+# The deadline isn't used as NNLS takes well under a millisecond
+def estimate_recipe(product, warm_start=None, penalties=False, compiled=None, deadline=None):
     current = time.perf_counter()
-    [bounds, leaf_ingredients, args] = get_objective_function_args(product)
+    compiled = get_compiled_recipe(product, compiled)
+    [bounds, leaf_ingredients, args] = get_objective_function_args(product, compiled)
     recipe_estimator = product['recipe_estimator']
     nutrients = {nutrient_key: nutrient for nutrient_key, nutrient in recipe_estimator['nutrients'].items() if nutrient['weighting'] > 0}
     num_ingredients = len(leaf_ingredients)
@@ -22,46 +51,29 @@ def estimate_recipe(product):
     # Commented code also adds an extra vector to make the ingredients add up to 100%
     # A = numpy.zeros((num_nutrients + 1, num_ingredients))
     # b = [nutrient['product_total'] * NUTRIENT_WITHIN_BOUNDS_PENALTY for nutrient in nutrients.values()] + [TOTAL_MASS_MORE_THAN_100_PENALTY]
-    A = numpy.zeros((num_nutrients, num_ingredients))
-    b = [nutrient['product_total'] for nutrient in nutrients.values()]
-    for i in range(num_ingredients):
-        for n, nutrient_key in enumerate(nutrients.keys()):
-            A[n,i] = sum([ingredient['nutrients'].get(nutrient_key, {}).get('percent_nom', 0) for ingredient in leaf_ingredients[0:i + 1]]) # * NUTRIENT_WITHIN_BOUNDS_PENALTY
-        # Add extra coefficient to make things add up to 100%, but for the lower ingredients we need to factor
-        # that this will be included in the total for all of the earlier ingredients
-        # A[num_nutrients, i] = (i + 1) * TOTAL_MASS_MORE_THAN_100_PENALTY
+    ingredients_nutrients = compiled.gather(list(nutrients.keys()))
+    # Column i is the sum of the nutrients of ingredients 0 to i
+    A = numpy.cumsum(ingredients_nutrients, axis=1) # * NUTRIENT_WITHIN_BOUNDS_PENALTY
+    b = numpy.array([nutrient['product_total'] for nutrient in nutrients.values()])
+    # Add extra coefficient to make things add up to 100%, but for the lower ingredients we need to factor
+    # that this will be included in the total for all of the earlier ingredients
+    # A[num_nutrients, i] = (i + 1) * TOTAL_MASS_MORE_THAN_100_PENALTY
 
-    (solution, rnorm) = nnls(A, b)
-    solution_x = numpy.array([100 * solution[i:num_ingredients].sum() for i in range(num_ingredients)])
+    with span("solve"):
+        warm_solution = warm_start_nnls(A, b, warm_start) if warm_start is not None else None
+        (solution, rnorm) = warm_solution or nnls(A, b)
+    # Ingredient i is the sum of the differences from i onwards
+    solution_x = 100 * numpy.cumsum(solution[::-1])[::-1]
     product_total_quantity = sum(solution_x)
 
-    def set_percentages(ingredients):
-        total_percent = 0
-        total_quantity = 0
-        for ingredient in ingredients:
-            if "ingredients" in ingredient and len(ingredient["ingredients"]) > 0:
-                percent_estimate, quantity_estimate = set_percentages(ingredient["ingredients"])
-            else:
-                index = ingredient["index"]
-                quantity_estimate = round(solution_x[index], 2)
-                # ingredient["lost_water"] = round(solution.x[index + 1], 2)
-                percent_estimate = round(100 * solution_x[index] / product_total_quantity, 2)
-
-            ingredient["percent_estimate"] = percent_estimate
-            ingredient["quantity_estimate"] = quantity_estimate
-            total_percent += percent_estimate
-            total_quantity += quantity_estimate
-
-        return total_percent, total_quantity
-
-    set_percentages(product["ingredients"])
+    with span("set_percentages"):
+        compiled.write_leaf_estimates(100 * solution_x / product_total_quantity, solution_x)
     recipe_estimator["status"] = 0
     recipe_estimator["status_message"] = f"rnorm: {rnorm}"
 
-    objective(solution_x, *args)
-    recipe_estimator['penalties'] = args[0]
+    if penalties:
+        recipe_estimator['penalties'] = get_penalties(product, solution_x, args)
     recipe_estimator["time"] = round(time.perf_counter() - current, 2)
-    message = f"Product: {product.get('code')}, time: {recipe_estimator['time']} s, rnorm: {rnorm}"
-    print(message)
+    logger.info("Product: %s, time: %s s, rnorm: %s", product.get('code'), recipe_estimator['time'], rnorm)
 
     return solution
@@ -1,6 +1,8 @@
 import json
 import warnings
 
+import pytest
+
 from recipe_estimator.nutrients import prepare_product
 from .recipe_estimator_nnls import estimate_recipe
 
@@ -162,3 +164,26 @@ def test_ingredients_dont_add_up():
     
     assert abs(80 - product['ingredients'][0]['quantity_estimate']) < 2
 
+
+
+def test_estimate_recipe_warm_start_gives_same_result():
+    def make_product(sugars):
+        return {
+            'code': 'test',
+            'ingredients': [
+                {'id': 'one', 'nutrients': {'fiber': {'percent_nom': 10}, 'sugars': {'percent_nom': 5}}},
+                {'id': 'two', 'nutrients': {'fiber': {'percent_nom': 2}, 'sugars': {'percent_nom': 60}}},
+                {'id': 'three', 'nutrients': {'fiber': {'percent_nom': 1}, 'sugars': {'percent_nom': 1}}},
+            ],
+            'nutriments': {'fiber_100g': 6, 'sugars_100g': sugars},
+        }
+
+    previous_solution = estimate_recipe(make_product(20))
+
+    cold = make_product(21)
+    estimate_recipe(cold)
+    warm = make_product(21)
+    estimate_recipe(warm, warm_start=previous_solution)
+
+    assert [i['quantity_estimate'] for i in warm['ingredients']] == [i['quantity_estimate'] for i in cold['ingredients']]
+    assert float(warm['recipe_estimator']['status_message'][7:]) == pytest.approx(float(cold['recipe_estimator']['status_message'][7:]), abs=1e-9)
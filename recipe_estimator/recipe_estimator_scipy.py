@@ -1,15 +1,27 @@
+import logging
 import time
-import warnings
 
-from .fitness import get_objective_function_args, objective
+from .compiled_recipe import get_compiled_recipe
+from .deadline import expired, set_deadline_exceeded
+from .differential_evolution_pool import pool_map, use_pool
+from .fitness import get_objective_function_args, get_penalties, objective, objective_batch
+from .spans import set_outcome, span
+
+logger = logging.getLogger(__name__)
+
+# differential_evolution passes a vectorized population as leaf ingredients x population
+def vectorized_objective(population, *args):
+    return objective_batch(population.T, *args)
+
 
 # estimate_recipe() uses a linear solver to estimate the quantities of all leaf ingredients (ingredients that don't have child ingredient)
 # The solver is used to minimise the difference between the sum of the nutrients in the leaf ingredients and the total nutrients in the product
 # A lot of manual testing was done with product 20023751 which seems to have a lot of local minima.
 # The optimal solution for this product has a total penalty of about 130900
-def estimate_recipe(product):
+def estimate_recipe(product, penalties=False, compiled=None, deadline=None):
     current = time.perf_counter()
-    [bounds, leaf_ingredients, args] = get_objective_function_args(product)
+    compiled = get_compiled_recipe(product, compiled)
+    [bounds, leaf_ingredients, args] = get_objective_function_args(product, compiled)
     MAXITER = 5000
     x0 = [ingredient["initial_estimate"] for ingredient in leaf_ingredients]
 
@@ -119,26 +131,32 @@ def estimate_recipe(product):
     # Following is a bit of a fudge. For tests 0.8 works best but for real products
     # seem to converge more quickly with 0.98
     recombination = 0.8 if len(leaf_ingredients) < 4 else 0.98
-    solution = differential_evolution(
-        objective,
-        bounds,
-        args=args,
-        x0=x0,
-        polish=False, # Don't polish results to help with performance. Results are only slightly less optimal
-        rng=0, # Seed random number generator so we get consistent results between tests
-        workers=-1 if len(leaf_ingredients) > 20 else 1, # Gives a bit of an improvement with more complex products but not worth it for simple ones
-        updating='deferred', # Need to set this if we are going to set workers
-        popsize=15, # Default is 15. Increasing this really slows things down. This is the minimum to currently pass tests. Might be able to reduce this for complex products
-        # init='sobol', # Changing this didn't seem to make much difference
-        # Following three seem to work together. Values were trial and error
-        # Aiming to get best performance while still passing tests
-        tol=0.01, # Much higher than this seems to give poor results on real products
-        atol=100, # Has a marginal impact on accuracy and performance
-        # maxiter=2000,
-        recombination=recombination
-        # mutation=(1.5, 1.9), # Tried increasing this but gave poor results
-    )
-    print(f"{len(leaf_ingredients)}: {recombination}")
+    # Not in the estimation and batch worker processes, which already run one estimate per CPU
+    use_workers = len(leaf_ingredients) > 20 and use_pool()
+    with span("solve"):
+        solution = differential_evolution(
+            objective if use_workers else vectorized_objective,
+            bounds,
+            args=args,
+            x0=x0,
+            polish=False, # Don't polish results to help with performance. Results are only slightly less optimal
+            rng=0, # Seed random number generator so we get consistent results between tests
+            workers=pool_map if use_workers else 1, # Gives a bit of an improvement with more complex products but not worth it for simple ones. Uses a persistent pool rather than one per call
+            vectorized=not use_workers, # Otherwise score the whole population with one call
+            updating='deferred', # Need to set this if we are going to set workers or vectorized
+            popsize=15, # Default is 15. Increasing this really slows things down. This is the minimum to currently pass tests. Might be able to reduce this for complex products
+            # init='sobol', # Changing this didn't seem to make much difference
+            # Following three seem to work together. Values were trial and error
+            # Aiming to get best performance while still passing tests
+            tol=0.01, # Much higher than this seems to give poor results on real products
+            atol=100, # Has a marginal impact on accuracy and performance
+            # maxiter=2000,
+            recombination=recombination,
+            # mutation=(1.5, 1.9), # Tried increasing this but gave poor results
+            # Checked after each generation. Stopping returns the best member of the population so far, which is always within the bounds
+            callback=(lambda intermediate_result: expired(deadline)) if deadline is not None else None,
+        )
+    logger.debug("Product: %s, %s leaf ingredients, recombination: %s", product.get('code'), len(leaf_ingredients), recombination)
     solution_x = solution.x
 
     # # Tried PyGAD but couldn't get it to converge on the best solution
@@ -179,37 +197,19 @@ def estimate_recipe(product):
 
     product_total_quantity = sum(solution_x)
 
-    def set_percentages(ingredients):
-        total_percent = 0
-        total_quantity = 0
-        for ingredient in ingredients:
-            if "ingredients" in ingredient and len(ingredient["ingredients"]) > 0:
-                percent_estimate, quantity_estimate = set_percentages(ingredient["ingredients"])
-            else:
-                index = ingredient["index"]
-                quantity_estimate = round(solution_x[index], 2)
-                # ingredient["lost_water"] = round(solution.x[index + 1], 2)
-                percent_estimate = round(100 * solution_x[index] / product_total_quantity, 2)
-
-            ingredient["percent_estimate"] = percent_estimate
-            ingredient["quantity_estimate"] = quantity_estimate
-            total_percent += percent_estimate
-            total_quantity += quantity_estimate
-
-        return total_percent, total_quantity
-
-    set_percentages(product["ingredients"])
+    with span("set_percentages"):
+        compiled.write_leaf_estimates(100 * solution_x / product_total_quantity, solution_x)
     recipe_estimator = product["recipe_estimator"]
     recipe_estimator["status"] = 0
     recipe_estimator["status_message"] = solution.get('message')
+    set_outcome("solver_status", "success" if solution.success else "failure")
+    if not solution.success and expired(deadline):
+        set_deadline_exceeded(recipe_estimator, "best_found")
     # Note that for some algorithms penalties won't be set to the value from the best solution, so call the objective function again to get it
-    objective(solution_x, *args)
-    recipe_estimator['penalties'] = args[0]
+    if penalties:
+        recipe_estimator['penalties'] = get_penalties(product, solution_x, args)
     recipe_estimator["time"] = round(time.perf_counter() - current, 2)
-    message = f"Product: {product.get('code')}, time: {recipe_estimator['time']} s, status: {solution.get('message')}, iterations: {solution.get('nit')}"
-    if solution.get('success') and solution.get("nit", 0) < MAXITER:
-        print(message)
-    else:
-        warnings.warn(message)
+    level = logging.INFO if solution.get('success') and solution.get("nit", 0) < MAXITER else logging.WARNING
+    logger.log(level, "Product: %s, time: %s s, status: %s, iterations: %s", product.get('code'), recipe_estimator['time'], solution.get('message'), solution.get('nit'))
 
     return solution
@@ -1,9 +1,29 @@
 import json
+import time
 import warnings
 
 from recipe_estimator.nutrients import prepare_product
 from .recipe_estimator_scipy import estimate_recipe
 
+def test_estimate_recipe_stops_at_deadline():
+    product = {
+        'code': 'deadline',
+        'ingredients': [
+            {'id': 'A', 'nutrients': {'fiber': {'percent_nom': 15, 'percent_min': 15, 'percent_max': 15}}},
+            {'id': 'B', 'nutrients': {'fiber': {'percent_nom': 3, 'percent_min': 3, 'percent_max': 3}}},
+        ],
+        'nutriments': {'fiber_100g': 10},
+    }
+
+    solution = estimate_recipe(product, deadline=time.monotonic())
+
+    # Stopped after the first generation with the best point found so far
+    assert solution.nit == 1
+    assert product['recipe_estimator']['status_message'] == 'deadline_exceeded'
+    assert product['recipe_estimator']['deadline_result'] == 'best_found'
+    assert 0 <= product['ingredients'][0]['percent_estimate'] <= 100
+
+
 def test_estimate_recipe_accounts_for_lost_water():
     product = {
         'code': 'test', 
@@ -450,7 +470,7 @@ def test_estimate_recipe_one_matched_in_the_middle():
             'fiber_100g': 10,
         }}
 
-    estimate_recipe(product)
+    estimate_recipe(product, penalties=True)
 
     metrics = product.get('recipe_estimator')
     assert metrics is not None
@@ -1,8 +1,14 @@
+import logging
 import time
-import numpy
 
 
-from .fitness import get_objective_function_args, objective
+from .compiled_recipe import get_compiled_recipe
+from .fitness import get_penalties
+from .prepare_nutrients import prepare_nutrients
+from .spans import span
+
+logger = logging.getLogger(__name__)
+
 
 POWER = -1.7
 def estimate_percentages(ingredients, total = 100.0):
@@ -24,20 +30,21 @@ def estimate_percentages(ingredients, total = 100.0):
     return
     
     
-def estimate_recipe(product):
+# The deadline isn't used as there is no solver. This is the estimate the others fall back to when they run out of time
+def estimate_recipe(product, penalties=False, compiled=None, deadline=None):
     current = time.perf_counter()
-    [bounds, leaf_ingredients, args] = get_objective_function_args(product)
+    compiled = get_compiled_recipe(product, compiled)
+    prepare_nutrients(product, True, compiled)
     recipe_estimator = product['recipe_estimator']
     
-    estimate_percentages(product["ingredients"])
+    with span("solve"):
+        estimate_percentages(product["ingredients"])
     recipe_estimator["status"] = 0
     recipe_estimator["status_message"] = f"OK"
 
-    solution_x = numpy.array([ingredient['quantity_estimate'] for ingredient in leaf_ingredients])
-    objective(solution_x, *args)
-    recipe_estimator['penalties'] = args[0]
+    if penalties:
+        recipe_estimator['penalties'] = get_penalties(product, compiled=compiled)
     recipe_estimator["time"] = round(time.perf_counter() - current, 2)
-    message = f"Product: {product.get('code')}, time: {recipe_estimator['time']} s"
-    print(message)
+    logger.info("Product: %s, time: %s s", product.get('code'), recipe_estimator['time'])
 
     return
@@ -0,0 +1,201 @@
+import functools
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+
+from . import settings
+from .asset_bundle import source_filenames
+from .bulk import json_default
+from .nutrient_map import off_to_ciqual
+
+# Estimation results keyed by a hash of everything that affects them, so re-estimating a product whose ingredients and
+# nutrition facts haven't changed doesn't need to prepare the product and solve again:
+#  - the ingredient tree: ids, stated percents, nesting, and nutrients given in the request
+#  - the product nutrient values read by assign_weightings (and the glop limits), and countries_tags
+#  - the estimation method, its options (such as the cvxpy solver) and whether the penalties were asked for
+#  - RESULT_CACHE_VERSION and a stamp of the taxonomy, CIQUAL and nutrient map assets (see get_asset_version)
+# Only what the estimators add to the product is kept: the estimate fields of each ingredient in pre-order and recipe_estimator.
+# The in-memory tier is an LRU with a limit on the total size of the entries. If a path is given, entries are also kept in
+# an SQLite database which is read on a memory miss, so they are still available after a restart.
+
+# Increase when a change to the estimators changes their results, so earlier results aren't used
+RESULT_CACHE_VERSION = 1
+
+# Ingredient fields set by the estimators that are kept in the cache
+RESULT_FIELDS = ("percent_estimate", "quantity_estimate", "lost_water", "index", "initial_estimate")
+
+
+# Changes if the asset source files or the bundle are changed. Uses the file sizes and modification times rather than
+# hashing the contents, which would take longer than loading them
+@functools.cache
+def get_asset_version():
+    stamp = hashlib.sha256()
+    for filename in source_filenames + [settings.ASSET_BUNDLE]:
+        try:
+            stat = os.stat(filename)
+        except (OSError, TypeError, ValueError):
+            continue
+        stamp.update(f"{os.path.basename(filename)}:{stat.st_size}:{stat.st_mtime_ns};".encode("utf-8"))
+    return stamp.hexdigest()[:16]
+
+
+def canonical_ingredients(ingredients):
+    canonical = []
+    for ingredient in ingredients:
+        entry = [ingredient.get("id"), ingredient.get("percent")]
+        if ingredient.get("ingredients"):
+            entry.append(canonical_ingredients(ingredient["ingredients"]))
+        elif "nutrients" in ingredient:
+            # Nutrients given in the request are used rather than those from CIQUAL
+            entry.append({"nutrients": ingredient["nutrients"]})
+        canonical.append(entry)
+    return canonical
+
+
+# Product nutrient values, from the new nutrition schema and the old nutriments, for the nutrients the estimators use
+def canonical_nutrients(product):
+    aggregated = product.get("nutrition", {}).get("aggregated_set", {}).get("nutrients", {})
+    nutriments = product.get("nutriments", {})
+    canonical = {}
+    for nutrient_key in off_to_ciqual:
+        value = aggregated.get(nutrient_key, {}).get("value")
+        nutriment = nutriments.get(nutrient_key + "_100g")
+        if value is not None or nutriment is not None:
+            canonical[nutrient_key] = [value, nutriment]
+    return canonical
+
+
+def get_result_key(product, method, penalties=False, options=None):
+    inputs = {
+        "version": RESULT_CACHE_VERSION,
+        "assets": get_asset_version(),
+        "method": method,
+        "options": options or {},
+        "penalties": bool(penalties),
+        "ingredients": canonical_ingredients(product.get("ingredients", [])),
+        "nutrients": canonical_nutrients(product),
+        "countries_tags": product.get("countries_tags"),
+    }
+    text = json.dumps(inputs, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str)
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def _flatten_ingredients(ingredients, flattened):
+    for ingredient in ingredients:
+        flattened.append(ingredient)
+        if ingredient.get("ingredients"):
+            _flatten_ingredients(ingredient["ingredients"], flattened)
+    return flattened
+
+
+# The results of an estimated product as JSON text
+def encode_result(product):
+    ingredients = [
+        {field: ingredient[field] for field in RESULT_FIELDS if field in ingredient}
+        for ingredient in _flatten_ingredients(product.get("ingredients", []), [])
+    ]
+    return json.dumps({"ingredients": ingredients, "recipe_estimator": product.get("recipe_estimator", {})}, default=json_default)
+
+
+# Applies cached results to a prepared product with the same key
+def apply_result(product, text):
+    result = json.loads(text)
+    for ingredient, fields in zip(_flatten_ingredients(product.get("ingredients", []), []), result["ingredients"]):
+        ingredient.update(fields)
+    product.setdefault("recipe_estimator", {}).update(result["recipe_estimator"])
+
+
+class ResultCache:
+    def __init__(self, max_size=64 * 1024 * 1024, path=None):
+        self.max_size = max_size
+        self.path = path or None
+        self.results = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = {"memory": 0, "disk": 0}
+        self.misses = 0
+        self.evictions = 0
+        self.connection = None
+
+    @property
+    def enabled(self):
+        return self.max_size > 0
+
+    def get_connection(self):
+        # Opened on first use, and shared by the threads under the lock
+        if self.connection is None and self.path is not None:
+            self.connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, assets TEXT, value TEXT)")
+            # Results for other versions of the assets can't be used again
+            self.connection.execute("DELETE FROM results WHERE assets != ?", (get_asset_version(),))
+        return self.connection
+
+    def get(self, key):
+        with self.lock:
+            text = self.results.get(key)
+            if text is not None:
+                self.results.move_to_end(key)
+                self.hits["memory"] += 1
+                return text
+            connection = self.get_connection()
+            if connection is not None:
+                row = connection.execute("SELECT value FROM results WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    self.hits["disk"] += 1
+                    self.add(key, row[0])
+                    return row[0]
+            self.misses += 1
+            return None
+
+    def put(self, key, text):
+        with self.lock:
+            self.add(key, text)
+            connection = self.get_connection()
+            if connection is not None:
+                connection.execute("INSERT OR REPLACE INTO results (key, assets, value) VALUES (?, ?, ?)", (key, get_asset_version(), text))
+
+    # Called with the lock held
+    def add(self, key, text):
+        if len(text) > self.max_size:
+            return
+        previous = self.results.pop(key, None)
+        if previous is not None:
+            self.size -= len(previous)
+        self.results[key] = text
+        self.size += len(text)
+        while self.size > self.max_size:
+            _, evicted = self.results.popitem(last=False)
+            self.size -= len(evicted)
+            self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.results.clear()
+            self.size = 0
+            connection = self.get_connection()
+            if connection is not None:
+                connection.execute("DELETE FROM results")
+
+    def close(self):
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+
+    def metrics(self):
+        return {
+            "entries": len(self.results),
+            "size": self.size,
+            "max_size": self.max_size,
+            "hits": dict(self.hits),
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+result_cache = ResultCache(settings.RESULT_CACHE_SIZE, settings.RESULT_CACHE_PATH or None)
@@ -0,0 +1,89 @@
+import json
+
+from .result_cache import ResultCache, apply_result, encode_result, get_result_key
+
+
+def get_product():
+    return {
+        'code': '1',
+        'ingredients': [
+            {'id': 'en:tomato', 'percent': 60},
+            {'id': 'en:sauce', 'ingredients': [{'id': 'en:onion'}, {'id': 'en:salt'}]},
+        ],
+        'nutriments': {'sugars_100g': 4, 'salt_100g': 1.2, 'energy_100g': 100},
+        'countries_tags': ['en:france'],
+    }
+
+
+def test_result_key_only_depends_on_estimate_inputs():
+    product = get_product()
+    key = get_result_key(product, 'cvxpy')
+
+    assert get_result_key({**get_product(), 'code': '2', 'product_name': 'Sauce'}, 'cvxpy') == key
+    reordered = get_product()
+    reordered['ingredients'][0] = {'percent': 60, 'id': 'en:tomato', 'percent_estimate': 50}
+    assert get_result_key(reordered, 'cvxpy') == key
+
+    assert get_result_key(product, 'glop') != key
+    assert get_result_key(product, 'cvxpy', penalties=True) != key
+    changed = get_product()
+    changed['ingredients'][0]['percent'] = 50
+    assert get_result_key(changed, 'cvxpy') != key
+    changed = get_product()
+    changed['ingredients'][1]['ingredients'].reverse()
+    assert get_result_key(changed, 'cvxpy') != key
+    changed = get_product()
+    changed['nutriments']['sugars_100g'] = 5
+    assert get_result_key(changed, 'cvxpy') != key
+    changed = get_product()
+    changed['nutrition'] = {'aggregated_set': {'nutrients': {'sugars': {'value': 5}}}}
+    assert get_result_key(changed, 'cvxpy') != key
+    changed = get_product()
+    changed['countries_tags'] = ['en:united-states']
+    assert get_result_key(changed, 'cvxpy') != key
+    changed = get_product()
+    changed['ingredients'][0]['nutrients'] = {'sugars': {'percent_nom': 3}}
+    assert get_result_key(changed, 'cvxpy') != key
+
+
+def test_apply_result_sets_the_estimates():
+    product = get_product()
+    for ingredient, percent_estimate in zip([product['ingredients'][0], product['ingredients'][1], *product['ingredients'][1]['ingredients']], [60, 40, 30, 10]):
+        ingredient['percent_estimate'] = percent_estimate
+    product['recipe_estimator'] = {'status': 0}
+    text = encode_result(product)
+
+    other = get_product()
+    apply_result(other, text)
+
+    assert other == product
+
+
+def test_evicts_least_recently_used_over_size():
+    cache = ResultCache(max_size=10)
+    cache.put('a', '1234')
+    cache.put('b', '1234')
+    assert cache.get('a') == '1234'
+    cache.put('c', '1234')
+
+    assert cache.get('b') is None
+    assert cache.get('a') == '1234'
+    assert cache.get('c') == '1234'
+    # Too big to keep
+    cache.put('d', '12345678901')
+    assert cache.get('d') is None
+    assert cache.metrics() == {'entries': 2, 'size': 8, 'max_size': 10, 'hits': {'memory': 3, 'disk': 0}, 'misses': 2, 'evictions': 1}
+
+
+def test_database_keeps_results_after_restart(tmp_path):
+    path = str(tmp_path / 'results.sqlite')
+    cache = ResultCache(path=path)
+    cache.put('a', json.dumps({'ingredients': []}))
+    cache.close()
+
+    cache = ResultCache(path=path)
+    assert cache.get('a') == json.dumps({'ingredients': []})
+    assert cache.get('a') is not None
+    assert cache.get('b') is None
+    assert cache.metrics()['hits'] == {'memory': 1, 'disk': 1}
+    cache.close()
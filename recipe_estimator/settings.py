@@ -6,3 +6,54 @@ OPENFOODFACTS_URL = os.environ.get(
     'OPENFOODFACTS_URL',
     'https://world.openfoodfacts.net'
 ).rstrip("/")
+
+# Binary asset bundle built by scripts/build_asset_bundle.py
+# Set to an empty string to always load the assets from the JSON / CSV files
+ASSET_BUNDLE = os.environ.get(
+    'ASSET_BUNDLE',
+    os.path.join(os.path.dirname(__file__), 'assets', 'recipe_estimator.bundle')
+)
+
+# Number of worker processes for /api/v3/estimate_recipes. 0 uses one per CPU
+BATCH_WORKERS = int(os.environ.get('BATCH_WORKERS', '0'))
+
+# Pool used to run estimates off the event loop: "thread" or "process"
+ESTIMATION_POOL = os.environ.get('ESTIMATION_POOL', 'thread')
+# Number of estimates that can run at once. 0 uses one per CPU
+ESTIMATION_WORKERS = int(os.environ.get('ESTIMATION_WORKERS', '0'))
+# Number of estimates that can wait for a worker before requests are rejected with a 503
+ESTIMATION_QUEUE_SIZE = int(os.environ.get('ESTIMATION_QUEUE_SIZE', '64'))
+
+# Default time budget in milliseconds for an estimate, which can be changed with the deadline_ms request option. 0 is no deadline
+DEADLINE_MS = float(os.environ.get('DEADLINE_MS', '0'))
+
+# Estimators tried in turn by the auto method, cheapest first
+AUTO_TIERS = os.environ.get('AUTO_TIERS', 'nnls,cvxpy,scipy')
+# The auto method moves on to the next estimator if the nutrient penalty or the ingredient order penalties of an estimate are above these
+AUTO_NUTRIENT_PENALTY = float(os.environ.get('AUTO_NUTRIENT_PENALTY', '1000000'))
+AUTO_ORDER_PENALTY = float(os.environ.get('AUTO_ORDER_PENALTY', '5000000'))
+
+# Number of worker processes used by differential evolution for products with many ingredients. 0 uses one per CPU
+DIFFERENTIAL_EVOLUTION_WORKERS = int(os.environ.get('DIFFERENTIAL_EVOLUTION_WORKERS', '0'))
+
+# Log level for the package: TRACE, DEBUG, INFO, WARNING or ERROR
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+# Per-module levels, e.g. "recipe_estimator_glop=TRACE,nutrients=DEBUG"
+LOG_LEVELS = os.environ.get('LOG_LEVELS', '')
+
+# Directory of test set products, which are used in preference to fetching them from Open Food Facts
+PRODUCT_TEST_SET_DIR = os.environ.get('PRODUCT_TEST_SET_DIR', '../recipe-estimator-metrics/test-sets/input')
+# Timeout in seconds for requests to Open Food Facts
+PRODUCT_TIMEOUT = float(os.environ.get('PRODUCT_TIMEOUT', '10'))
+# Maximum number of requests to Open Food Facts at once
+PRODUCT_MAX_CONNECTIONS = int(os.environ.get('PRODUCT_MAX_CONNECTIONS', '10'))
+# Number of products fetched from Open Food Facts to keep, and for how many seconds
+PRODUCT_CACHE_SIZE = int(os.environ.get('PRODUCT_CACHE_SIZE', '1024'))
+PRODUCT_CACHE_TTL = float(os.environ.get('PRODUCT_CACHE_TTL', '3600'))
+# Directory to also keep fetched products in so they survive a restart. Not used if empty
+PRODUCT_CACHE_DIR = os.environ.get('PRODUCT_CACHE_DIR', '')
+
+# Maximum total size in bytes of the estimation results kept in memory, so products that haven't changed aren't estimated again. 0 disables the cache
+RESULT_CACHE_SIZE = int(os.environ.get('RESULT_CACHE_SIZE', str(64 * 1024 * 1024)))
+# SQLite database to also keep estimation results in so they survive a restart. Not used if empty
+RESULT_CACHE_PATH = os.environ.get('RESULT_CACHE_PATH', '')
@@ -0,0 +1,86 @@
+import contextvars
+import functools
+import time
+
+from .metrics import Histograms, registry
+
+# Timings of the stages of an estimate (prepare_product, build, solve, penalties etc).
+# Code marks a stage with `with span("solve"):` and the time is added to the Spans collector of the current estimate if there is one.
+# Without a collector a span only costs a context variable lookup, so they can be left in library code that is also used from scripts.
+# Timings include any spans nested inside them. Estimators can also record outcomes, such as the solver status, for the metrics
+current_spans = contextvars.ContextVar("spans", default=None)
+
+
+class Spans:
+    def __init__(self):
+        self.timings = {}
+        self.outcomes = {}
+
+    def add(self, name, seconds):
+        self.timings[name] = self.timings.get(name, 0) + seconds
+
+    def __enter__(self):
+        self.token = current_spans.set(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        current_spans.reset(self.token)
+
+
+class span:
+    __slots__ = ("name", "spans", "start")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.spans = current_spans.get()
+        if self.spans is not None:
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.spans is not None:
+            self.spans.add(self.name, time.perf_counter() - self.start)
+
+
+def timed(name):
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# For timings measured another way, e.g. reported by the solver
+def add_span(name, seconds):
+    spans = current_spans.get()
+    if spans is not None:
+        spans.add(name, seconds)
+
+
+def set_outcome(name, value):
+    spans = current_spans.get()
+    if spans is not None:
+        spans.outcomes[name] = value
+
+
+# Histograms of stage timings per endpoint
+class StageHistograms(Histograms):
+    def __init__(self):
+        super().__init__("recipe_estimator_stage_seconds", "Time spent in each stage of an estimate", ("endpoint", "stage"))
+
+    def observe(self, endpoint, timings):
+        for name, seconds in timings.items():
+            self.get(endpoint, name).observe(seconds)
+
+    def snapshot(self):
+        snapshot = {}
+        for (endpoint, name), histogram in self.histograms.items():
+            snapshot.setdefault(endpoint, {})[name] = histogram.snapshot()
+        return snapshot
+
+
+stage_histograms = registry.register(StageHistograms())
@@ -0,0 +1,64 @@
+from fastapi.testclient import TestClient
+
+from .main import app
+from .metrics import Histogram
+from .spans import Spans, StageHistograms, add_span, current_spans, span, timed
+
+
+def test_span_without_collector_does_nothing():
+    with span("solve"):
+        pass
+    add_span("compile", 1)
+    assert current_spans.get() is None
+
+
+def test_spans_accumulate():
+    @timed("prepare")
+    def prepare():
+        with span("inner"):
+            pass
+
+    with Spans() as spans:
+        prepare()
+        prepare()
+        add_span("compile", 0.5)
+        add_span("compile", 0.25)
+    assert current_spans.get() is None
+    assert set(spans.timings) == {"prepare", "inner", "compile"}
+    assert spans.timings["prepare"] >= spans.timings["inner"]
+    assert spans.timings["compile"] == 0.75
+
+
+def test_histogram():
+    histogram = Histogram(buckets=(1, 2, 5))
+    for value in (0.5, 1, 1.5, 3, 10):
+        histogram.observe(value)
+    assert histogram.snapshot() == {"count": 5, "sum": 16, "buckets": {"1": 2, "2": 3, "5": 4, "+Inf": 5}}
+    assert histogram.quantile(0.5) == 2
+    assert histogram.quantile(0.99) == float("inf")
+    assert Histogram().quantile(0.5) is None
+
+
+def test_stage_histograms():
+    stage_histograms = StageHistograms()
+    stage_histograms.observe("/a", {"solve": 0.001, "total": 0.002})
+    stage_histograms.observe("/a", {"solve": 0.003, "total": 0.004})
+    snapshot = stage_histograms.snapshot()
+    assert snapshot["/a"]["solve"]["count"] == 2
+    assert snapshot["/a"]["total"]["sum"] == 0.006
+
+
+def test_estimate_recipe_returns_stages_with_debug():
+    client = TestClient(app)
+    product = {"ingredients": [{"id": "en:sugar"}, {"id": "en:salt"}]}
+
+    response = client.post("/api/v3/estimate_recipe_nnls", json={"product": product, "options": {"debug": True}})
+    stages = response.json()["product"]["recipe_estimator"]["stages"]
+    assert {"prepare_product", "objective_args", "solve", "set_percentages", "penalties", "worker", "queue", "total"} <= set(stages)
+    assert stages["total"] >= stages["worker"] >= stages["solve"]
+
+    response = client.post("/api/v3/estimate_recipe_nnls", json={"product": product})
+    assert "stages" not in response.json()["product"]["recipe_estimator"]
+
+    stages = client.get("/api/v3/metrics").json()["stages"]["/api/v3/estimate_recipe_nnls"]
+    assert stages["total"]["count"] >= 2
@@ -0,0 +1,27 @@
+import json
+import os
+import time
+
+from recipe_estimator import settings
+from recipe_estimator.asset_bundle import write_bundle
+from recipe_estimator.nutrient_map import read_nutrient_map
+from recipe_estimator.nutrients import build_ciqual_code_index, get_ciqual_code_index_stats
+
+# Builds recipe_estimator/assets/recipe_estimator.bundle from the JSON and CSV assets.
+# Needs to be re-run whenever ingredients.json, ciqual_ingredients.json or nutrient_map.csv change
+# (the bundle is ignored if it is older than any of them).
+start = time.perf_counter()
+
+with open(os.path.join(os.path.dirname(__file__), "../recipe_estimator/assets/ciqual_ingredients.json"), "r", encoding="utf-8") as ciqual_file:
+    ciqual_ingredients = json.load(ciqual_file)
+
+with open(os.path.join(os.path.dirname(__file__), "../recipe_estimator/assets/ingredients.json"), "r", encoding="utf-8") as ingredients_file:
+    ingredients_taxonomy = json.load(ingredients_file)
+
+ingredient_codes = build_ciqual_code_index(ingredients_taxonomy)
+write_bundle(settings.ASSET_BUNDLE, ingredient_codes, ciqual_ingredients, read_nutrient_map())
+
+stats = get_ciqual_code_index_stats(ingredient_codes)
+print(f"{stats['ingredients']} ingredients: {stats['direct']} with a ciqual code, {stats['from_parent']} resolved through parents, {stats['unresolved']} unresolved")
+
+print(f"Wrote {settings.ASSET_BUNDLE} ({os.path.getsize(settings.ASSET_BUNDLE) / 1e6:.1f} MB) in {time.perf_counter() - start:.1f} s")
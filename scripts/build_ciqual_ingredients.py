@@ -1,46 +1,85 @@
+import argparse
 import json
 import os
+import resource
+import time
 import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
+
+from recipe_estimator.asset_bundle import write_ciqual_table
 from recipe_estimator.nutrient_map import ciqual_to_off
 
-version = "2025_11_03"
+# Builds recipe_estimator/assets/ciqual_ingredients.json, and a binary copy of it that can be memory-mapped
+# (recipe_estimator.asset_bundle.read_ciqual_table), from the CIQUAL XML files in ciqual/.
+# The files are streamed with iterparse so memory doesn't grow with their size. Each CIQUAL version is read in its
+# own process and the versions are then merged, earlier versions taking precedence.
+# Run with: python -m scripts.build_ciqual_ingredients [--ciqual-dir ciqual] [--output recipe_estimator/assets/ciqual_ingredients.json]
+
+VERSIONS = ["2025_11_03", "2020_07_07"]
+
+base_dir = os.path.join(os.path.dirname(__file__), "..")
+
 
 def parse_value(ciqual_nutrient):
     if not ciqual_nutrient or ciqual_nutrient == '-':
         return 0
     return float(ciqual_nutrient.replace(',','.').replace('<','').replace('traces','0'))
 
-ciqual_ingredients = {}
 
-for version in ["2025_11_03", "2020_07_07"]:
+class LessThanFilter:
+    # The compo file is not valid XML as "less than" values are written as " < ". Escapes them in the bytes read
+    # from the file. A " <" or " " at the end of a chunk is held back in case the rest of the " < " is in the next one
+    def __init__(self, file):
+        self.file = file
+        self.pending = b""
+
+    def read(self, size=-1):
+        while True:
+            chunk = self.file.read(size)
+            data = self.pending + chunk
+            self.pending = b""
+            if chunk and not data.endswith(b" < "):
+                keep = 2 if data.endswith(b" <") else 1 if data.endswith(b" ") else 0
+                data, self.pending = data[:len(data) - keep], data[len(data) - keep:]
+            if data or not chunk:
+                return data.replace(b" < ", b" &lt; ")
+
+
+def iter_rows(source):
+    # Yields each row of a CIQUAL table (<TABLE><ROW><field>text</field>...</ROW>...</TABLE>) as a dict of
+    # field -> text, discarding the row once it has been read
+    depth = 0
+    root = None
+    for event, element in ET.iterparse(source, events=("start", "end")):
+        if event == "start":
+            if root is None:
+                root = element
+            depth += 1
+            continue
+        depth -= 1
+        if depth == 1:
+            yield {field.tag: field.text for field in element}
+            root.clear()
+
+
+def read_version(ciqual_dir, version):
     const_codes = {}
-    const_table = ET.parse(os.path.join(os.path.dirname(__file__), f"../ciqual/const_{version}.xml")).getroot()
-    for const in const_table:
-        const_codes[const.find('const_code').text.strip()] = const.find('const_nom_eng').text.strip().lower()
+    for const in iter_rows(os.path.join(ciqual_dir, f"const_{version}.xml")):
+        const_codes[const['const_code'].strip()] = const['const_nom_eng'].strip().lower()
 
     # Load Ciqual data
     alim_codes = {}
-    alim_table = ET.parse(os.path.join(os.path.dirname(__file__), f"../ciqual/alim_{version}.xml")).getroot()
-    for alim in alim_table:
-        alim_codes[alim.find('alim_code').text.strip()] = alim.find('alim_nom_eng').text.strip()
-
-    # Compo file is not valid XML. Need to fix all of the "less than" entries
-    with open(os.path.join(os.path.dirname(__file__), f"../ciqual/compo_{version}.xml"), encoding="utf8") as compo_file:
-        compo_table = ET.fromstring(compo_file.read().replace(' < ', ' &lt; '))
-
-    # Code below creates the ciqual_stats.csv file
-    # TODO: Need to not do this here anymore as it won't take sugars into account
-    # Note need to uncomment other lines below too
-    # ciqual_csv_file = open(os.path.join(os.path.dirname(__file__), 'assets/ciqual/ciqual_stats.csv'), "w", newline="")
-    # ciqual_csv = csv.writer(ciqual_csv_file)
-    # ciqual_csv.writerow(['alim_code', 'alim_nom_eng', 'nutrient', 'min', 'nom', 'max', 'confidence', 'minus', 'plus'])
+    for alim in iter_rows(os.path.join(ciqual_dir, f"alim_{version}.xml")):
+        alim_codes[alim['alim_code'].strip()] = alim['alim_nom_eng'].strip()
 
     # Populate the nutrients for each ingredient
-    for compo in compo_table:
-        const_code = compo.find('const_code').text.strip()
-        nutrient = ciqual_to_off.get(const_codes.get(const_code))
-        if nutrient is not None:
-            alim_code = compo.find('alim_code').text.strip()
+    ciqual_ingredients = {}
+    with open(os.path.join(ciqual_dir, f"compo_{version}.xml"), "rb") as compo_file:
+        for compo in iter_rows(LessThanFilter(compo_file)):
+            nutrient = ciqual_to_off.get(const_codes.get(compo['const_code'].strip()))
+            if nutrient is None:
+                continue
+            alim_code = compo['alim_code'].strip()
             alim_nom_eng = alim_codes[alim_code]
             ciqual_ingredient = ciqual_ingredients.setdefault(alim_code, {
                 'id': alim_code,
@@ -51,85 +90,127 @@ for version in ["2025_11_03", "2020_07_07"]:
                 'source': version,
             })
             nutrient_key = nutrient['off_id']
-            if nutrient_key not in ciqual_ingredient['nutrients']:
-                factor = nutrient['factor']
-                teneur = compo.find('teneur').text.strip()
-                min = compo.find('min').text
-                max = compo.find('max').text
-                nom_value = parse_value(teneur) / factor
-
-                has_min = True
-                if min is not None:
-                    min_value = parse_value(min.strip()) / factor
-                elif '<' in teneur:
-                    min_value = 0
-                else:
-                    min_value = nom_value
-                    has_min = False
-
-                has_max = True
-                if max is not None:
-                    max_value = parse_value(max.strip()) / factor
-                else:
-                    max_value = nom_value
-                    has_max = False
-
-                confidence = compo.find('code_confiance').text
-                # Looking at the data the code confidence doesn't seem to affect the min / max range
-                #
-                # Confidence | Average Minus | Average Plus
-                #     A      |      42%      |     704%
-                #     B      |      25%      |      36%
-                #     C      |      31%      |      45%
-                #     D      |      36%      |      62%
-                #
-                # Hence we can't really use it to set a percentage range
-                #
-                # Code below creates the ciqual_stats.csv file
-                # ciqual_csv.writerow([alim_code, alim_nom_eng, nutrient_key, min_value, nom_value, max_value,
-                #                      confidence.strip() if confidence is not None else '',
-                #                      round(100 * (nom_value - min_value) / nom_value, 2) if has_min and nom_value > 0 else '',
-                #                      round(100 * (max_value - nom_value) / nom_value, 2) if has_max and nom_value > 0 else ''])
-
-                ciqual_ingredient['nutrients'][nutrient_key] = {
-                    'percent_nom': nom_value,
-                    'percent_min': min_value,
-                    'percent_max': max_value,
-                    'confidence' : confidence.strip() if confidence is not None and teneur != '-' else '-',
-                    'source': version,
-                }
-                if "<" in teneur:
-                    ciqual_ingredient['nutrients'][nutrient_key]["modifier"] = "<"
-
-# Post-process sugars as some items, like fructose, don't quote sugars but do quote the individual parts
-for ciqual_ingredient in ciqual_ingredients.values():
-    nutrients = ciqual_ingredient['nutrients']
-    sugars = nutrients.get('sugars')
-    if sugars and sugars.get('confidence') == '-':
-        # Loop through the other sugars and add them up
-        min = 0
-        max = 0
-        nom = 0
-        con = 0
-        for nutrient in ['fructose', 'galactose', 'lactose', 'maltose', 'sucrose']:
-            sugar = nutrients.get(nutrient)
-            if sugar:
-                min += sugar.get('percent_min', 0)
-                max += sugar.get('percent_max', 0)
-                nom += sugar.get('percent_nom', 0)
-                # For some reason max throws an exception here
-                newcon = '-ABCD'.index(sugar.get('confidence', '-'))
-                if newcon > con:
-                    con = newcon
-
-        sugars['percent_min'] = min
-        sugars['percent_max'] = max
-        sugars['percent_nom'] = nom
-        sugars['confidence'] = '-ABCD'[con]
-
-# Code below creates the ciqual_stats.csv file
-# ciqual_csv_file.close()
-
-filename = os.path.join(os.path.dirname(__file__), "../recipe_estimator/assets/ciqual_ingredients.json")
-with open(filename, 'w', encoding='utf-8') as f:
-  f.write(json.dumps(ciqual_ingredients, ensure_ascii=False, sort_keys=True, indent=2))
+            if nutrient_key in ciqual_ingredient['nutrients']:
+                continue
+
+            factor = nutrient['factor']
+            teneur = compo['teneur'].strip()
+            min = compo.get('min')
+            max = compo.get('max')
+            nom_value = parse_value(teneur) / factor
+
+            if min is not None:
+                min_value = parse_value(min.strip()) / factor
+            elif '<' in teneur:
+                min_value = 0
+            else:
+                min_value = nom_value
+
+            if max is not None:
+                max_value = parse_value(max.strip()) / factor
+            else:
+                max_value = nom_value
+
+            # Looking at the data the code confidence doesn't seem to affect the min / max range
+            #
+            # Confidence | Average Minus | Average Plus
+            #     A      |      42%      |     704%
+            #     B      |      25%      |      36%
+            #     C      |      31%      |      45%
+            #     D      |      36%      |      62%
+            #
+            # Hence we can't really use it to set a percentage range
+            confidence = compo.get('code_confiance')
+            ciqual_ingredient['nutrients'][nutrient_key] = {
+                'percent_nom': nom_value,
+                'percent_min': min_value,
+                'percent_max': max_value,
+                'confidence' : confidence.strip() if confidence is not None and teneur != '-' else '-',
+                'source': version,
+            }
+            if "<" in teneur:
+                ciqual_ingredient['nutrients'][nutrient_key]["modifier"] = "<"
+
+    return ciqual_ingredients
+
+
+def build_version(ciqual_dir, version):
+    # Runs in a worker process, so the peak RSS is just that of reading this version
+    start = time.perf_counter()
+    ciqual_ingredients = read_version(ciqual_dir, version)
+    return ciqual_ingredients, time.perf_counter() - start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def merge_versions(versions):
+    # A food comes from the first version that has it, and its nutrients from the first version that has each of them
+    ciqual_ingredients = {}
+    for version_ingredients in versions:
+        for alim_code, version_ingredient in version_ingredients.items():
+            ciqual_ingredient = ciqual_ingredients.setdefault(alim_code, {**version_ingredient, 'nutrients': {}})
+            for nutrient_key, nutrient in version_ingredient['nutrients'].items():
+                ciqual_ingredient['nutrients'].setdefault(nutrient_key, nutrient)
+    return ciqual_ingredients
+
+
+def add_sugars(ciqual_ingredients):
+    # Post-process sugars as some items, like fructose, don't quote sugars but do quote the individual parts
+    for ciqual_ingredient in ciqual_ingredients.values():
+        nutrients = ciqual_ingredient['nutrients']
+        sugars = nutrients.get('sugars')
+        if sugars and sugars.get('confidence') == '-':
+            # Loop through the other sugars and add them up
+            min = 0
+            max = 0
+            nom = 0
+            con = 0
+            for nutrient in ['fructose', 'galactose', 'lactose', 'maltose', 'sucrose']:
+                sugar = nutrients.get(nutrient)
+                if sugar:
+                    min += sugar.get('percent_min', 0)
+                    max += sugar.get('percent_max', 0)
+                    nom += sugar.get('percent_nom', 0)
+                    # For some reason max throws an exception here
+                    newcon = '-ABCD'.index(sugar.get('confidence', '-'))
+                    if newcon > con:
+                        con = newcon
+
+            sugars['percent_min'] = min
+            sugars['percent_max'] = max
+            sugars['percent_nom'] = nom
+            sugars['confidence'] = '-ABCD'[con]
+
+
+def build(ciqual_dir, output, table_output, versions=VERSIONS):
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=len(versions)) as executor:
+        futures = [executor.submit(build_version, ciqual_dir, version) for version in versions]
+        results = [future.result() for future in futures]
+    for version, (version_ingredients, seconds, max_rss) in zip(versions, results):
+        print(f"{version}: {len(version_ingredients)} foods in {seconds:.2f} s, peak RSS {max_rss / 1024:.1f} MiB")
+
+    ciqual_ingredients = merge_versions([version_ingredients for version_ingredients, _, _ in results])
+    add_sugars(ciqual_ingredients)
+
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(ciqual_ingredients, f, ensure_ascii=False, sort_keys=True, indent=2)
+    write_ciqual_table(table_output, ciqual_ingredients, [nutrient['off_id'] for nutrient in ciqual_to_off.values()])
+
+    # ru_maxrss is in KiB on Linux
+    print(
+        f"{len(ciqual_ingredients)} foods in {time.perf_counter() - start:.2f} s, "
+        f"peak RSS {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MiB "
+        f"(version processes {resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024:.1f} MiB)"
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m scripts.build_ciqual_ingredients", description="Build ciqual_ingredients.json from the CIQUAL XML files")
+    parser.add_argument("--ciqual-dir", default=os.path.join(base_dir, "ciqual"), help="directory of the CIQUAL const, alim and compo XML files")
+    parser.add_argument("--output", default=os.path.join(base_dir, "recipe_estimator/assets/ciqual_ingredients.json"))
+    parser.add_argument("--table-output", help="binary table to write (default: the output with a .table extension)")
+    args = parser.parse_args(argv)
+    build(args.ciqual_dir, args.output, args.table_output or os.path.splitext(args.output)[0] + ".table")
+
+
+if __name__ == "__main__":
+    main()